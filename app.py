@@ -1,6 +1,10 @@
 from datetime import datetime, timedelta, time
+from time import perf_counter
 import os
+import io
+import logging
 import streamlit as st
+import numpy as np
 import pandas as pd
 import json # Importar json para lidar com a coluna plantonistas na escala
 
@@ -8,12 +12,23 @@ from utils import (
     criar_tabelas, listar_plantonistas, cadastrar_plantonista, apagar_plantonista,
     listar_viaturas, cadastrar_viatura, apagar_viatura,
     listar_coordenadores, cadastrar_coordenador, apagar_coordenador,
-    gerar_escala_manual, gerar_escala_automatica, apagar_escala,
-    gerar_historico_excel_por_equipe, gerar_historico_pdf_por_equipe,
-    safe_json_loads, safe_list_load,
-    conectar, gerar_pdf_escala_por_equipe
+    gerar_escala_manual, gerar_escala_automatica, apagar_escala, escalas_arquivadas,
+    conectar,
+    versoes_tabelas, versao_tabela, exportar_escalas_csv,
+    buscar_plantonistas, normalizar_texto,
+    enfileirar_tarefa, obter_tarefa, ler_resultado_tarefa,
+    para_minutos, de_minutos, MINUTOS_DIA, consultar_periodo, periodo_compacto, horas_por_intervalo,
+    UNIDADES, usar_unidade, na_unidade, pasta_relatorios, agregar_unidades,
+    saldo_horas, calendario_mes, versao_mes, meses_pt,
+    atualizar_plantonista, atualizar_viatura, atualizar_coordenador, atualizar_escala, ConflitoEdicao,
+    listar_feriados, cadastrar_feriado, apagar_feriado,
+    manter_horizonte, cadastrar_modelo_escala, listar_modelos_escala, apagar_modelo_escala, salvar_excecao_modelo,
+    HORIZONTE_DIAS
 )
 
+# Início do rerun, para medir quanto a página leva (veja o fim do arquivo)
+_inicio_rerun = perf_counter()
+
 # --- Funções auxiliares ---
 def valida_cpf(cpf):
     # Se CPF for vazio, consideramos válido (opcional)
@@ -62,65 +77,99 @@ def valida_telefone(telefone):
     telefone = ''.join(filter(str.isdigit, telefone))
     return len(telefone) >= 10 and len(telefone) <= 11
 
-# Novas funções para editar registros
-def atualizar_plantonista(id, nome, matricula, cpf, telefone):
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute(
-        'UPDATE plantonistas SET nome = ?, matricula = ?, cpf = ?, telefone = ? WHERE id = ?',
-        (nome, matricula, cpf, telefone, id)
-    )
-    conn.commit()
-    conn.close()
+# A versão é a que o registro tinha quando a edição foi aberta, e não a relida
+# a cada rerun: é ela que atualizar_* confere para recusar a gravação se outra
+# pessoa salvou o mesmo registro nesse meio-tempo
+def versao_em_edicao(chave, registro):
+    guardada = st.session_state.get(f'{chave}_versao')
+    if not guardada or guardada[0] != registro['id']:
+        guardada = (registro['id'], registro['versao'])
+        st.session_state[f'{chave}_versao'] = guardada
+    return guardada[1]
 
-def atualizar_viatura(id, placa, modelo):
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute(
-        'UPDATE viaturas SET placa = ?, modelo = ? WHERE id = ?',
-        (placa, modelo, id)
-    )
-    conn.commit()
-    conn.close()
+def sair_edicao(chave):
+    st.session_state.pop(chave, None)
+    st.session_state.pop(f'{chave}_versao', None)
 
-def atualizar_coordenador(id, nome, matricula, contato):
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute(
-        'UPDATE coordenadores SET nome = ?, matricula = ?, contato = ? WHERE id = ?',
-        (nome, matricula, contato, id)
-    )
-    conn.commit()
-    conn.close()
+logger = logging.getLogger(__name__)
 
-def atualizar_escala(id, data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id):
-    conn = conectar()
-    cursor = conn.cursor()
-    plantonistas_json = json.dumps(plantonistas)
-    cursor.execute(
-        'UPDATE escalas SET data_inicio = ?, data_fim = ?, turno = ?, vagas = ?, plantonistas = ?, viatura_id = ?, coordenador_id = ? WHERE id = ?',
-        (data_inicio, data_fim, turno, vagas, plantonistas_json, viatura_id, coordenador_id, id)
-    )
-    conn.commit()
-    conn.close()
+# Uma vez por processo (e por unidade): esquema do banco e pasta de relatórios
+@st.cache_resource
+def inicializar(unidade):
+    criar_tabelas()
+    os.makedirs(pasta_relatorios(), exist_ok=True)
 
-# Função com cache para melhorar o desempenho
-@st.cache_data(ttl=600)  # Cache por 10 minutos
-def listar_plantonistas_cached():
+# Consultas com cache. A versão da tabela (versoes_tabelas, lida uma vez por
+# rerun) entra na chave: uma escrita em qualquer sessão invalida a entrada, e
+# cliques que não mudam dados não tocam no banco.
+@st.cache_data(max_entries=16)
+def listar_plantonistas_cached(unidade, versao):
     return listar_plantonistas()
 
-@st.cache_data(ttl=600)
-def listar_viaturas_cached():
+# Buscas amplas ("silva") casam com boa parte do cadastro; só os mais
+# relevantes são trazidos
+LIMITE_BUSCA = 100
+
+@st.cache_data(max_entries=64)
+def buscar_plantonistas_cached(termo, limite, unidade, versao):
+    return buscar_plantonistas(termo, limite)
+
+# A chave leva a versão do histórico de cada unidade (veja versoes_historico_unidades)
+@st.cache_data(max_entries=8)
+def agregar_unidades_cached(inicio_min, fim_min, versoes):
+    return agregar_unidades(inicio_min, fim_min)
+
+def versoes_historico_unidades():
+    versoes = []
+    for chave in UNIDADES:
+        with na_unidade(chave):
+            versoes.append(versao_tabela("historico"))
+    return tuple(versoes)
+
+# A chave inclui a versão do mês: só escritas em escalas daquele mês (ou em
+# viaturas/coordenadores) recalculam a grade
+@st.cache_data(max_entries=24)
+def calendario_cached(mes, unidade, versao):
+    return calendario_mes(mes)
+
+@st.cache_data(max_entries=16)
+def listar_viaturas_cached(unidade, versao):
     return listar_viaturas()
 
-@st.cache_data(ttl=600)
-def listar_coordenadores_cached():
+@st.cache_data(max_entries=16)
+def listar_coordenadores_cached(unidade, versao):
     return listar_coordenadores()
 
+@st.cache_data(max_entries=16)
+def limites_escalas_cached(unidade, versao):
+    with conectar() as conn:
+        return tuple(conn.execute('SELECT MIN(inicio_min), MAX(fim_min) FROM escalas').fetchone())
+
+@st.cache_data(max_entries=8)
+def escalas_periodo_cached(inicio_min, fim_min, unidade, versao):
+    """Escalas que começam e terminam em [inicio_min, fim_min), prontas para a
+    tabela do Histórico, e os nomes de todos que aparecem nelas."""
+    filtrado, membros = periodo_compacto('escalas', 'id, inicio_min, fim_min, turno, vagas', inicio_min, fim_min,
+                                         condicao='fim_min < ?', params=(fim_min,))
+    equipes = [[] for _ in range(len(filtrado))]
+    for linha, nome in zip(membros['linha'].tolist(), membros['plantonista'].astype(str).tolist()):
+        equipes[linha].append(nome)
+    filtrado['equipe'] = [', '.join(equipe) for equipe in equipes]
+    nomes = sorted(p for p in membros['plantonista'].cat.categories if p)
+    return filtrado, nomes
+
+@st.cache_data(max_entries=8)
+def historico_periodo_cached(inicio_min, fim_min, unidade, versao):
+    """Histórico do período em formato compacto (veja periodo_compacto)."""
+    df, membros = periodo_compacto('historico', 'id, turno, inicio_min, fim_min, horas_normais, horas_especiais',
+                                   inicio_min, fim_min)
+    df['horas_totais'] = df['horas_normais'] + df['horas_especiais']
+    return df, membros
+
 def obter_plantonista_por_id(id):
     conn = conectar()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM plantonistas WHERE id = ?', (id,))
+    cursor.execute('SELECT id, nome, matricula, cpf, telefone, versao FROM plantonistas WHERE id = ?', (id,))
     resultado = cursor.fetchone()
     conn.close()
     if resultado:
@@ -129,28 +178,30 @@ def obter_plantonista_por_id(id):
             "nome": resultado[1],
             "matricula": resultado[2],
             "cpf": resultado[3],
-            "telefone": resultado[4]
+            "telefone": resultado[4],
+            "versao": resultado[5]
         }
     return None
 
 def obter_viatura_por_id(id):
     conn = conectar()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM viaturas WHERE id = ?', (id,))
+    cursor.execute('SELECT id, placa, modelo, versao FROM viaturas WHERE id = ?', (id,))
     resultado = cursor.fetchone()
     conn.close()
     if resultado:
         return {
             "id": resultado[0],
             "placa": resultado[1],
-            "modelo": resultado[2]
+            "modelo": resultado[2],
+            "versao": resultado[3]
         }
     return None
 
 def obter_coordenador_por_id(id):
     conn = conectar()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM coordenadores WHERE id = ?', (id,))
+    cursor.execute('SELECT id, nome, matricula, contato, versao FROM coordenadores WHERE id = ?', (id,))
     resultado = cursor.fetchone()
     conn.close()
     if resultado:
@@ -158,14 +209,18 @@ def obter_coordenador_por_id(id):
             "id": resultado[0],
             "nome": resultado[1],
             "matricula": resultado[2],
-            "contato": resultado[3]
+            "contato": resultado[3],
+            "versao": resultado[4]
         }
     return None
 
 def obter_escala_por_id(id):
     conn = conectar()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM escalas WHERE id = ?', (id,))
+    cursor.execute(
+        'SELECT id, data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id, inicio_min, fim_min, versao '
+        'FROM escalas WHERE id = ?', (id,)
+    )
     resultado = cursor.fetchone()
     conn.close()
     if resultado:
@@ -177,42 +232,120 @@ def obter_escala_por_id(id):
             "vagas": resultado[4],
             "plantonistas": json.loads(resultado[5]) if resultado[5] else [],
             "viatura_id": resultado[6],
-            "coordenador_id": resultado[7]
+            "coordenador_id": resultado[7],
+            "inicio_min": resultado[8],
+            "fim_min": resultado[9],
+            "versao": resultado[10]
         }
     return None
 
 
 def exportar_relatorio_individual(plantonista_nome):
-    conn = conectar()
-    query = '''
-    SELECT e.data_inicio, e.data_fim, e.turno, e.vagas 
-    FROM escalas e
-    WHERE JSON_EXTRACT(e.plantonistas, '$') LIKE ?
-    ORDER BY e.data_inicio DESC
-    '''
     busca = f'%{plantonista_nome}%'
-    df = pd.read_sql_query(query, conn, params=[busca])
-    
-    # Calcular horas trabalhadas
-    df['horas_trabalhadas'] = (pd.to_datetime(df['data_fim']) - 
-                              pd.to_datetime(df['data_inicio'])).dt.total_seconds() / 3600
+    # Inclui os anos arquivados
+    df = consultar_periodo(
+        'escalas',
+        colunas='data_inicio, data_fim, turno, vagas, (fim_min - inicio_min) / 60.0 AS horas_trabalhadas',
+        condicao="JSON_EXTRACT(plantonistas, '$') LIKE ?",
+        params=(busca,),
+        ordem='inicio_min DESC'
+    )
     
     return df
 
+# Exportações geradas só quando o botão de download é clicado. A versão da
+# tabela entra na chave do cache, então qualquer escrita invalida o arquivo.
+@st.cache_data(max_entries=8)
+def csv_historico(filtro_inicio, filtro_fim, unidade, versao):
+    buffer = io.BytesIO()
+    # Chamada fora da execução do script: a unidade precisa ser reativada
+    with na_unidade(unidade):
+        for bloco in exportar_escalas_csv(filtro_inicio, filtro_fim):
+            buffer.write(bloco)
+    return buffer.getvalue()
+
+@st.cache_data(max_entries=32)
+def csv_relatorio_individual(plantonista_nome, unidade, versao):
+    with na_unidade(unidade):
+        return exportar_relatorio_individual(plantonista_nome).to_csv(index=False).encode('utf-8')
+
+# Acompanhamento das tarefas em segundo plano (PDF/Excel). O id da tarefa fica
+# em st.session_state[chave_sessao]; enquanto ela roda, só o fragmento de
+# progresso é reexecutado a cada 2 segundos.
+@st.fragment(run_every=2)
+def progresso_tarefa(id_tarefa, unidade):
+    # Reexecuções do fragmento não passam pelo topo do script
+    with na_unidade(unidade):
+        tarefa = obter_tarefa(id_tarefa)
+    if tarefa and tarefa['status'] in ('pendente', 'executando'):
+        if tarefa['total']:
+            st.progress(tarefa['feitos'] / tarefa['total'], text=f"Processando {tarefa['feitos']}/{tarefa['total']}...")
+        else:
+            st.progress(0.0, text="Aguardando na fila...")
+    else:
+        st.rerun()
+
+def painel_tarefa(chave_sessao, rotulo, nome_arquivo, mime, key):
+    # Os ids de tarefa são de cada banco, então a chave inclui a unidade
+    chave_sessao = f"{chave_sessao}:{unidade}"
+    id_tarefa = st.session_state.get(chave_sessao)
+    if not id_tarefa:
+        return
+    tarefa = obter_tarefa(id_tarefa)
+    if tarefa is None:
+        st.session_state.pop(chave_sessao, None)
+    elif tarefa['status'] in ('pendente', 'executando'):
+        progresso_tarefa(id_tarefa, unidade)
+    elif tarefa['status'] == 'erro':
+        st.error(f"Falha ao gerar o arquivo: {tarefa['erro']}")
+    else:
+        def ler_resultado():
+            with na_unidade(unidade):
+                return ler_resultado_tarefa(id_tarefa)
+        st.download_button(
+            label=rotulo,
+            data=ler_resultado,
+            file_name=nome_arquivo,
+            mime=mime,
+            key=key
+        )
+
 # --- Configuração ---
 st.set_page_config(page_title="Sistema de Escalas Extra", layout="wide")
-criar_tabelas()
+
+# Modo multiunidade: cada unidade do unidades.json tem banco e modelo próprios
+unidade = None
+if UNIDADES:
+    unidade = st.sidebar.selectbox(
+        "Unidade", list(UNIDADES), format_func=lambda chave: UNIDADES[chave].get("nome", chave), key='unidade'
+    )
+usar_unidade(unidade)
+
+inicializar(unidade)
+# Ocorrências de escalas recorrentes dos próximos dias viram escalas (uma consulta quando não falta nada)
+manter_horizonte()
+versoes = versoes_tabelas()
 st.title("📋 Sistema de Escalas de Serviço Extra")
 
-# Criar pasta de relatórios se não existir
-os.makedirs("relatorios", exist_ok=True)
+# Formas de gerar o PDF das escalas (renderizador de gerar_pdf_escala_por_equipe)
+RENDERIZADORES_PDF = {"fpdf": "Gerador interno (rápido)", "docx": "Modelo Word + LibreOffice"}
+
+# Tempo máximo, em ms, de um rerun sem mudança nos dados (um clique num
+# filtro, troca de aba). Reruns mais lentos vão para o log com a página.
+# Histórico e Dashboard gastam o grosso na renderização (data_editor e
+# multiselect do período inteiro, gráficos), não no banco.
+ORCAMENTO_RERUN_MS = {"Gerenciar": 50, "Gerar Escala": 50, "Calendário": 75, "Histórico": 150, "Dashboard": 120}
 
 # --- Menu Principal ---
-menu = st.sidebar.selectbox("Menu", ["Gerenciar", "Gerar Escala", "Histórico", "Dashboard"])
+menu = st.sidebar.selectbox("Menu", ["Gerenciar", "Gerar Escala", "Histórico", "Calendário", "Dashboard"])
+
+# Edição recusada no rerun anterior porque outra pessoa salvou o registro antes
+if 'conflito_edicao' in st.session_state:
+    st.error(st.session_state.pop('conflito_edicao'))
 
 # --- Gerenciar ---
 if menu == "Gerenciar":
-    aba = st.sidebar.radio("Gerenciar:", ["Plantonistas", "Viaturas", "Coordenadores"])
+    aba = st.sidebar.radio("Gerenciar:", ["Plantonistas", "Viaturas", "Coordenadores", "Feriados", "Escalas Recorrentes"])
     
     def listar_e_apagar(df, apagar_func, entidade, editar_func=None):
         
@@ -225,6 +358,8 @@ if menu == "Gerenciar":
         column_config = {"Apagar": st.column_config.CheckboxColumn("🗑️", help="Marque para apagar")}
         if editar_func:
              column_config["Editar"] = st.column_config.CheckboxColumn("✏️", help="Marque para editar")
+        if "versao" in df.columns:
+             column_config["versao"] = None
 
         edit_df = st.data_editor(
             df,
@@ -241,7 +376,6 @@ if menu == "Gerenciar":
                 for _, row in apagar_linhas.iterrows():
                     apagar_func(row["id"])
                 st.success(f"{entidade}(s) apagado(s)!")
-                st.cache_data.clear() # Limpa o cache após exclusão
                 st.rerun()
             elif not confirmacao and st.button(f"Apagar {entidade}(s) selecionados", key=f'delete_btn_{entidade}'):
                 st.warning("Por favor, confirme a exclusão.")
@@ -273,10 +407,11 @@ if menu == "Gerenciar":
         if editando_id:
             plantonista_atual = obter_plantonista_por_id(editando_id)
             if plantonista_atual:
+                 versao_plantonista = versao_em_edicao('editando_plantonista_id', plantonista_atual)
                  st.info(f"Editando plantonista: {plantonista_atual['nome']}")
             else:
                  st.error("Plantonista não encontrado para edição.")
-                 st.session_state.pop('editando_plantonista_id', None)
+                 sair_edicao('editando_plantonista_id')
                  st.rerun()
 
 
@@ -301,7 +436,7 @@ if menu == "Gerenciar":
                     cancelar = False # Não há botão de cancelar no modo de cadastro
 
             if cancelar:
-                st.session_state.pop('editando_plantonista_id', None)
+                sair_edicao('editando_plantonista_id')
                 st.rerun()
                 
             if enviar:
@@ -313,25 +448,27 @@ if menu == "Gerenciar":
                     st.warning("Telefone inválido! Digite DDD + número.")
                 else:
                     if editando_id:
-                        atualizar_plantonista(editando_id, nome, matricula, cpf, telefone)
-                        st.success("Plantonista atualizado com sucesso!")
-                        st.session_state.pop('editando_plantonista_id', None)
+                        try:
+                            atualizar_plantonista(editando_id, nome, matricula, cpf, telefone, versao_plantonista)
+                            st.success("Plantonista atualizado com sucesso!")
+                        except ConflitoEdicao as e:
+                            st.session_state['conflito_edicao'] = str(e)
+                        sair_edicao('editando_plantonista_id')
                     else:
                         cadastrar_plantonista(nome, matricula, cpf, telefone)
                         st.success("Plantonista cadastrado com sucesso!")
-                    # Limpar o cache para atualizar a lista
-                    st.cache_data.clear()
                     st.rerun()
         
         st.subheader("Lista de Plantonistas")
         # Adicionando campo de busca
-        filtro_plantonista = st.text_input("Filtrar plantonistas por nome:", key='filtro_plantonista_gerenciar')
-        plantonistas_df = listar_plantonistas_cached()
+        filtro_plantonista = st.text_input("Filtrar plantonistas por nome, matrícula ou CPF:", key='filtro_plantonista_gerenciar')
         
         if filtro_plantonista:
-            plantonistas_filtrados = plantonistas_df[plantonistas_df['nome'].str.contains(filtro_plantonista, case=False)]
+            plantonistas_filtrados = buscar_plantonistas_cached(filtro_plantonista, LIMITE_BUSCA, unidade, versoes['plantonistas'])
+            if len(plantonistas_filtrados) == LIMITE_BUSCA:
+                st.caption(f"Mostrando os {LIMITE_BUSCA} resultados mais relevantes; refine a busca para ver outros.")
         else:
-            plantonistas_filtrados = plantonistas_df
+            plantonistas_filtrados = listar_plantonistas_cached(unidade, versoes['plantonistas'])
         
         # Função para editar plantonista
         def editar_plantonista(id):
@@ -350,10 +487,11 @@ if menu == "Gerenciar":
         if editando_id:
             viatura_atual = obter_viatura_por_id(editando_id)
             if viatura_atual:
+                versao_viatura = versao_em_edicao('editando_viatura_id', viatura_atual)
                 st.info(f"Editando viatura: {viatura_atual['placa']} - {viatura_atual['modelo']}")
             else:
                 st.error("Viatura não encontrada para edição.")
-                st.session_state.pop('editando_viatura_id', None)
+                sair_edicao('editando_viatura_id')
                 st.rerun()
         
         with st.form(key='form_viatura'):
@@ -375,7 +513,7 @@ if menu == "Gerenciar":
                     cancelar = False
             
             if cancelar:
-                st.session_state.pop('editando_viatura_id', None)
+                sair_edicao('editando_viatura_id')
                 st.rerun()
                 
             if enviar:
@@ -383,14 +521,15 @@ if menu == "Gerenciar":
                     st.warning("Placa e modelo são obrigatórios.")
                 else:
                     if editando_id:
-                        atualizar_viatura(editando_id, placa, modelo)
-                        st.success("Viatura atualizada com sucesso!")
-                        st.session_state.pop('editando_viatura_id', None)
+                        try:
+                            atualizar_viatura(editando_id, placa, modelo, versao_viatura)
+                            st.success("Viatura atualizada com sucesso!")
+                        except ConflitoEdicao as e:
+                            st.session_state['conflito_edicao'] = str(e)
+                        sair_edicao('editando_viatura_id')
                     else:
                         cadastrar_viatura(placa, modelo)
                         st.success("Viatura cadastrada com sucesso!")
-                    # Limpar o cache para atualizar a lista
-                    st.cache_data.clear()
                     st.rerun()
         
         st.subheader("Lista de Viaturas")
@@ -400,7 +539,7 @@ if menu == "Gerenciar":
             st.session_state['editando_viatura_id'] = id
             st.rerun()
             
-        listar_e_apagar(listar_viaturas_cached(), apagar_viatura, "Viatura", editar_viatura)
+        listar_e_apagar(listar_viaturas_cached(unidade, versoes['viaturas']), apagar_viatura, "Viatura", editar_viatura)
     
     elif aba == "Coordenadores":
         st.header("Cadastrar Coordenador")
@@ -412,10 +551,11 @@ if menu == "Gerenciar":
         if editando_id:
             coordenador_atual = obter_coordenador_por_id(editando_id)
             if coordenador_atual:
+                versao_coordenador = versao_em_edicao('editando_coordenador_id', coordenador_atual)
                 st.info(f"Editando coordenador: {coordenador_atual['nome']}")
             else:
                 st.error("Coordenador não encontrado para edição.")
-                st.session_state.pop('editando_coordenador_id', None)
+                sair_edicao('editando_coordenador_id')
                 st.rerun()
         
         with st.form(key='form_coord'):
@@ -438,7 +578,7 @@ if menu == "Gerenciar":
                     cancelar = False
             
             if cancelar:
-                st.session_state.pop('editando_coordenador_id', None)
+                sair_edicao('editando_coordenador_id')
                 st.rerun()
                 
             if enviar:
@@ -446,14 +586,15 @@ if menu == "Gerenciar":
                     st.warning("Nome e matrícula são obrigatórios.")
                 else:
                     if editando_id:
-                        atualizar_coordenador(editando_id, nome, matricula, contato)
-                        st.success("Coordenador atualizado com sucesso!")
-                        st.session_state.pop('editando_coordenador_id', None)
+                        try:
+                            atualizar_coordenador(editando_id, nome, matricula, contato, versao_coordenador)
+                            st.success("Coordenador atualizado com sucesso!")
+                        except ConflitoEdicao as e:
+                            st.session_state['conflito_edicao'] = str(e)
+                        sair_edicao('editando_coordenador_id')
                     else:
                         cadastrar_coordenador(nome, matricula, contato)
                         st.success("Coordenador cadastrado com sucesso!")
-                    # Limpar o cache para atualizar a lista
-                    st.cache_data.clear()
                     st.rerun()
         
         st.subheader("Lista de Coordenadores")
@@ -463,7 +604,92 @@ if menu == "Gerenciar":
             st.session_state['editando_coordenador_id'] = id
             st.rerun()
             
-        listar_e_apagar(listar_coordenadores_cached(), apagar_coordenador, "Coordenador", editar_coordenador)
+        listar_e_apagar(listar_coordenadores_cached(unidade, versoes['coordenadores']), apagar_coordenador, "Coordenador", editar_coordenador)
+
+    elif aba == "Feriados":
+        st.header("Cadastrar Feriado")
+        st.caption("Feriados e datas especiais contam o dia inteiro como hora especial. "
+                   "Ao salvar ou apagar, as horas do histórico daquele dia são recalculadas.")
+
+        with st.form(key='form_feriado'):
+            data_feriado = st.date_input("Data", datetime.now())
+            descricao = st.text_input("Descrição")
+            if st.form_submit_button("Salvar"):
+                if not descricao:
+                    st.warning("A descrição é obrigatória.")
+                else:
+                    recalculadas = cadastrar_feriado(data_feriado, descricao)
+                    st.success(f"Feriado salvo! {recalculadas} registro(s) do histórico recalculado(s).")
+                    st.rerun()
+
+        st.subheader("Lista de Feriados")
+        listar_e_apagar(listar_feriados(), apagar_feriado, "Feriado")
+
+    elif aba == "Escalas Recorrentes":
+        st.header("Cadastrar Escala Recorrente")
+        st.caption(f"O plantão se repete a cada N dias a partir da primeira data. As ocorrências dos próximos "
+                   f"{HORIZONTE_DIAS} dias viram escalas comuns (editáveis no Histórico); as seguintes aparecem "
+                   f"no Calendário como previstas.")
+
+        viaturas = listar_viaturas_cached(unidade, versoes['viaturas']).to_dict('records')
+        coordenadores = listar_coordenadores_cached(unidade, versoes['coordenadores']).to_dict('records')
+        nomes_plantonistas = listar_plantonistas_cached(unidade, versoes['plantonistas'])['nome'].tolist()
+
+        with st.form(key='form_modelo_escala'):
+            col1, col2 = st.columns(2)
+            with col1:
+                primeira_data = st.date_input("Primeira data", datetime.now())
+                hora_inicio_modelo = st.time_input("Hora de início", time(18, 0))
+                turno_modelo = st.text_input("Turno", "18h às 02h")
+                intervalo_modelo = st.number_input("Repetir a cada (dias)", 1, 365, 7)
+            with col2:
+                vagas_modelo = st.number_input("Vagas", 1, 10, 3)
+                hora_fim_modelo = st.time_input("Hora de fim", time(2, 0))
+                duracao_dias = st.number_input("Termina quantos dias depois do início", 0, 2, 1)
+                tem_fim = st.checkbox("Repetir só até uma data")
+                ate_modelo = st.date_input("Até", datetime.now() + timedelta(days=180))
+            viatura_modelo = st.selectbox("Viatura", viaturas, format_func=lambda x: f"{x['placa']} ({x['modelo']})" if x else "Nenhuma")
+            coordenador_modelo = st.selectbox("Coordenador", coordenadores, format_func=lambda x: f"{x['nome']} ({x['matricula']})" if x else "Nenhum")
+            plantonistas_modelo = st.multiselect("Plantonistas", nomes_plantonistas)
+            if st.form_submit_button("Salvar"):
+                if not plantonistas_modelo:
+                    st.warning("Selecione pelo menos um plantonista.")
+                else:
+                    try:
+                        cadastrar_modelo_escala(
+                            datetime.combine(primeira_data, hora_inicio_modelo).strftime('%Y-%m-%d %H:%M'),
+                            datetime.combine(primeira_data + timedelta(days=duracao_dias), hora_fim_modelo).strftime('%Y-%m-%d %H:%M'),
+                            turno_modelo, vagas_modelo, plantonistas_modelo,
+                            viatura_modelo['id'] if viatura_modelo else None,
+                            coordenador_modelo['id'] if coordenador_modelo else None,
+                            intervalo_dias=intervalo_modelo, ate=ate_modelo if tem_fim else None
+                        )
+                        st.success("Escala recorrente cadastrada!")
+                        st.rerun()
+                    except ValueError as e:
+                        st.error(str(e))
+
+        st.subheader("Escalas Recorrentes")
+        st.caption("Apagar um modelo apaga as escalas dele que ainda não começaram; as passadas ficam no histórico.")
+        modelos = listar_modelos_escala()
+        listar_e_apagar(modelos, apagar_modelo_escala, "Escala Recorrente")
+
+        if not modelos.empty:
+            st.subheader("Exceção em uma Ocorrência")
+            rotulos = {m.id: f"#{m.id} · {m.turno} desde {m.primeira}" for m in modelos.itertuples()}
+            with st.form(key='form_excecao_modelo'):
+                id_modelo = st.selectbox("Escala recorrente", list(rotulos), format_func=rotulos.get)
+                dia_excecao = st.date_input("Data da ocorrência", datetime.now())
+                cancelar_ocorrencia = st.checkbox("Cancelar esta ocorrência")
+                equipe_excecao = st.multiselect("Outra equipe (vazio mantém a do modelo)", nomes_plantonistas)
+                if st.form_submit_button("Salvar exceção"):
+                    try:
+                        salvar_excecao_modelo(id_modelo, dia_excecao, cancelada=cancelar_ocorrencia,
+                                              plantonistas=equipe_excecao or None)
+                        st.success("Exceção salva!")
+                        st.rerun()
+                    except ValueError as e:
+                        st.error(str(e))
 
 # --- Gerar Escala ---
 elif menu == "Gerar Escala":
@@ -474,22 +700,27 @@ elif menu == "Gerar Escala":
     if editando_escala_id:
         escala_atual = obter_escala_por_id(editando_escala_id)
         if escala_atual:
+            versao_escala = versao_em_edicao('editando_escala_id', escala_atual)
             st.info(f"Editando escala de {escala_atual['data_inicio']} a {escala_atual['data_fim']}")
         else:
             st.error("Escala não encontrada para edição.")
-            st.session_state.pop('editando_escala_id', None)
+            sair_edicao('editando_escala_id')
             st.rerun()
 
+    renderizador_pdf = st.radio("Gerar o PDF pelo", list(RENDERIZADORES_PDF), format_func=RENDERIZADORES_PDF.get,
+                                horizontal=True, key='renderizador_pdf_assinatura')
+    por_escala = st.checkbox("Um PDF por escala (ZIP)", key='zip_pdf_assinatura')
     if st.button("📄 Gerar PDF das Escalas com Assinatura", key='gerar_pdf_assinatura'):
-        pdf_bytes = gerar_pdf_escala_por_equipe()
-        st.download_button(
-            label="⬇️ Baixar PDF",
-            data=pdf_bytes,
-            file_name="escalas_completas.pdf",
-            mime="application/pdf",
-            key='download_pdf_assinatura'
-        )
-    st.info("O arquivo Word também foi salvo em 'relatorios/escala_completa.docx' para edição.")
+        if por_escala:
+            st.session_state[f'tarefa_zip_assinatura:{unidade}'] = enfileirar_tarefa("zip_escalas", renderizador=renderizador_pdf)
+        else:
+            st.session_state[f'tarefa_pdf_assinatura:{unidade}'] = enfileirar_tarefa("pdf_escalas", renderizador=renderizador_pdf)
+    if por_escala:
+        painel_tarefa('tarefa_zip_assinatura', "⬇️ Baixar ZIP", "escalas_individuais.zip", "application/zip", 'download_zip_assinatura')
+    else:
+        painel_tarefa('tarefa_pdf_assinatura', "⬇️ Baixar PDF", "escalas_completas.pdf", "application/pdf", 'download_pdf_assinatura')
+    if renderizador_pdf == "docx" and not por_escala:
+        st.info(f"O arquivo Word também é salvo em '{os.path.join(pasta_relatorios(), 'tarefas')}/<número da tarefa>/escala_completa.docx' para edição.")
     
     st.header("Gerar Escala")
     
@@ -503,7 +734,7 @@ elif menu == "Gerar Escala":
         col1, col2 = st.columns(2)
         with col1:
             if editando_escala_id:
-                data_inicio_value = datetime.strptime(escala_atual['data_inicio'], '%Y-%m-%d %H:%M')
+                data_inicio_value = de_minutos(escala_atual['inicio_min'])
                 data_inicio_date = st.date_input("Data de Início", data_inicio_value.date(), key='edit_data_inicio_date')
                 hora_inicio = st.time_input("Hora de Início", data_inicio_value.time(), key='edit_hora_inicio')
                 turno = st.text_input("Turno", escala_atual['turno'], key='edit_turno')
@@ -513,7 +744,7 @@ elif menu == "Gerar Escala":
                 turno = st.text_input("Turno", "18h às 02h", key='new_turno')
         with col2:
             if editando_escala_id:
-                data_fim_value = datetime.strptime(escala_atual['data_fim'], '%Y-%m-%d %H:%M')
+                data_fim_value = de_minutos(escala_atual['fim_min'])
                 data_fim_date = st.date_input("Data de Fim", data_fim_value.date(), key='edit_data_fim_date')
                 hora_fim = st.time_input("Hora de Fim", data_fim_value.time(), key='edit_hora_fim')
                 vagas = st.number_input("Vagas Disponíveis", 1, 10, escala_atual['vagas'], key='edit_vagas')
@@ -525,8 +756,8 @@ elif menu == "Gerar Escala":
         data_inicio = datetime.combine(data_inicio_date, hora_inicio).strftime('%Y-%m-%d %H:%M')
         data_fim = datetime.combine(data_fim_date, hora_fim).strftime('%Y-%m-%d %H:%M')
         
-        viaturas = listar_viaturas_cached().to_dict('records')
-        coordenadores = listar_coordenadores_cached().to_dict('records')
+        viaturas = listar_viaturas_cached(unidade, versoes['viaturas']).to_dict('records')
+        coordenadores = listar_coordenadores_cached(unidade, versoes['coordenadores']).to_dict('records')
         
         # Encontrar o índice da viatura/coordenador selecionado para preencher o selectbox
         viatura_index = 0
@@ -563,12 +794,11 @@ elif menu == "Gerar Escala":
         
         # Adicionando campo de busca para plantonistas
         filtro_plantonista_escala = st.text_input("Filtrar plantonistas:", key='filtro_plantonista_escala')
-        plantonistas_df = listar_plantonistas_cached()
         
         if filtro_plantonista_escala:
-            plantonistas_filtrados = plantonistas_df[plantonistas_df['nome'].str.contains(filtro_plantonista_escala, case=False)]['nome'].tolist()
+            plantonistas_filtrados = buscar_plantonistas_cached(filtro_plantonista_escala, LIMITE_BUSCA, unidade, versoes['plantonistas'])['nome'].tolist()
         else:
-            plantonistas_filtrados = plantonistas_df['nome'].tolist()
+            plantonistas_filtrados = listar_plantonistas_cached(unidade, versoes['plantonistas'])['nome'].tolist()
         
         # Se estiver editando, preencher os plantonistas selecionados
         default_plantonistas = []
@@ -584,23 +814,26 @@ elif menu == "Gerar Escala":
                     if not plantonistas:
                         st.warning("Selecione pelo menos um plantonista.")
                     else:
-                        atualizar_escala(
-                            editando_escala_id, 
-                            data_inicio, 
-                            data_fim, 
-                            turno, 
-                            vagas, 
-                            plantonistas, 
-                            viatura['id'], 
-                            coordenador['id']
-                        )
-                        st.success("Escala atualizada com sucesso!")
-                        st.session_state.pop('editando_escala_id', None)
-                        st.cache_data.clear() # Limpa o cache após atualização
+                        try:
+                            atualizar_escala(
+                                editando_escala_id, 
+                                data_inicio, 
+                                data_fim, 
+                                turno, 
+                                vagas, 
+                                plantonistas, 
+                                viatura['id'], 
+                                coordenador['id'],
+                                versao_escala
+                            )
+                            st.success("Escala atualizada com sucesso!")
+                        except ConflitoEdicao as e:
+                            st.session_state['conflito_edicao'] = str(e)
+                        sair_edicao('editando_escala_id')
                         st.rerun()
             with col_cancelar_edicao:
                 if st.button("Cancelar Edição"):
-                    st.session_state.pop('editando_escala_id', None)
+                    sair_edicao('editando_escala_id')
                     st.rerun()
         else:
             if st.button("Gerar Escala Manual"):
@@ -609,7 +842,6 @@ elif menu == "Gerar Escala":
                 else:
                     gerar_escala_manual(data_inicio, data_fim, turno, vagas, plantonistas, viatura_id=viatura['id'], coordenador_id=coordenador['id'])
                     st.success("Escala manual gerada!")
-                    st.cache_data.clear() # Limpa o cache após geração
                     st.rerun()
     
     # A tab de Escala Automática só aparece se não estiver editando uma escala
@@ -634,37 +866,27 @@ elif menu == "Gerar Escala":
             if st.button("Gerar Escala Automática"):
                 gerar_escala_automatica(data_inicio_auto, data_fim_auto, turno_auto, vagas_auto, viatura_id=viatura_auto['id'], coordenador_id=coordenador_auto['id'])
                 st.success("Escala automática gerada!")
-                st.cache_data.clear() # Limpa o cache após geração
                 st.rerun()
 
 # --- Histórico ---
 elif menu == "Histórico":
     st.header("Histórico de Escalas (Por Equipe)")
     
-    conn = conectar()
-    # Corrigido: Usando data_inicio para filtrar o histórico, assumindo que historico tem essa coluna
-    # Se a coluna for diferente (ex: data_servico), ajuste aqui
-    df = pd.read_sql_query('SELECT * FROM escalas', conn) # Carrega escalas para mostrar histórico
-    conn.close()
-
-    df['equipe'] = df['plantonistas'].apply(safe_json_loads)
-    df['Início'] = pd.to_datetime(df['data_inicio'])
-    df['Fim'] = pd.to_datetime(df['data_fim'])
+    # O período padrão cobre só o banco principal; anos arquivados são lidos
+    # apenas quando o filtro volta até eles
+    limites = limites_escalas_cached(unidade, versoes['escalas'])
     
     # Filtro por data
     col1, col2 = st.columns(2)
-    data_min = df['Início'].min()
-    data_max = df['Fim'].max()
+    data_min = de_minutos(limites[0]) if limites[0] is not None else datetime.today()
+    data_max = de_minutos(limites[1]) if limites[1] is not None else datetime.today()
     
     # Usando chaves únicas para os date_input
-    filtro_inicio = col1.date_input("Data início (filtro)", data_min.date() if pd.notnull(data_min) else datetime.today(), key='hist_filtro_inicio')
-    filtro_fim = col2.date_input("Data fim (filtro)", data_max.date() if pd.notnull(data_max) else datetime.today(), key='hist_filtro_fim')
-    
-    # Filtrando o DataFrame carregado
-    filtrado = df[(df['Início'].dt.date >= filtro_inicio) & (df['Fim'].dt.date <= filtro_fim)].copy() # Use .copy() para evitar SettingWithCopyWarning
+    filtro_inicio = col1.date_input("Data início (filtro)", data_min.date(), key='hist_filtro_inicio')
+    filtro_fim = col2.date_input("Data fim (filtro)", data_max.date(), key='hist_filtro_fim')
     
-    filtrado['Início'] = filtrado['Início'].dt.strftime('%d/%m/%Y %H:%M')
-    filtrado['Fim'] = filtrado['Fim'].dt.strftime('%d/%m/%Y %H:%M')
+    filtrado, plantonistas_filtrados_list = escalas_periodo_cached(para_minutos(filtro_inicio), para_minutos(filtro_fim) + MINUTOS_DIA,
+                                      unidade, versoes['escalas'])
     
     # Adiciona colunas de ação se não existirem
     if "Apagar" not in filtrado.columns:
@@ -673,8 +895,10 @@ elif menu == "Histórico":
         filtrado["Editar"] = False
 
     edit = st.data_editor(
-        filtrado[['id', 'Início', 'Fim', 'turno', 'vagas', 'equipe', 'Apagar', 'Editar']],
+        filtrado[['id', 'inicio', 'fim', 'turno', 'vagas', 'equipe', 'Apagar', 'Editar']],
         column_config={
+            'inicio': st.column_config.DatetimeColumn('Início', format='DD/MM/YYYY HH:mm'),
+            'fim': st.column_config.DatetimeColumn('Fim', format='DD/MM/YYYY HH:mm'),
             'Apagar': st.column_config.CheckboxColumn('🗑️', help='Marque para apagar'),
             'Editar': st.column_config.CheckboxColumn('✏️', help='Marque para editar')
         },
@@ -688,19 +912,26 @@ elif menu == "Histórico":
     if not editar_linhas.empty:
         # Pega o ID da primeira linha marcada para edição
         id_para_editar = editar_linhas.iloc[0]["id"]
-        st.session_state['editando_escala_id'] = id_para_editar
-        st.rerun()
+        if escalas_arquivadas([id_para_editar]):
+            st.warning("Esta escala pertence a um ano arquivado e não pode ser editada.")
+        else:
+            st.session_state['editando_escala_id'] = id_para_editar
+            st.rerun()
     
     # Apagar escalas
     deletar = edit[edit['Apagar']]
     if not deletar.empty:
         confirmacao = st.checkbox("⚠️ Confirmar exclusão das escalas selecionadas?", key='confirm_delete_escala_hist')
         if st.button("Apagar Escalas Selecionadas", key='delete_btn_escala_hist') and confirmacao:
-            for _, row in deletar.iterrows():
-                apagar_escala(row['id'])
-            st.success("Escalas apagadas!")
-            st.cache_data.clear() # Limpa o cache após exclusão
-            st.rerun()
+            # Escalas de anos arquivados são somente leitura
+            arquivadas = escalas_arquivadas(deletar['id'])
+            apagadas = sum(apagar_escala(id_escala) for id_escala in deletar['id'] if id_escala not in arquivadas)
+            if arquivadas:
+                st.warning(f"{len(arquivadas)} escala(s) de anos arquivados não podem ser apagadas.")
+            if apagadas:
+                st.success(f"{apagadas} escala(s) apagada(s)!")
+                if not arquivadas:
+                    st.rerun()
         elif not confirmacao and st.button("Apagar Escalas Selecionadas", key='delete_btn_escala_hist_no_confirm'):
             st.warning("Por favor, confirme a exclusão.")
     
@@ -708,18 +939,22 @@ elif menu == "Histórico":
     col1, col2, col3 = st.columns(3)
     with col1:
         st.download_button("⬇️ Exportar CSV (Por Equipe)", 
-                          data=filtrado.to_csv(index=False).encode('utf-8'), 
+                          data=lambda: csv_historico(filtro_inicio, filtro_fim, unidade, versoes['escalas']), 
                           file_name='historico_equipes.csv', 
                           mime='text/csv',
                           key='download_csv_hist')
     with col2:
-        st.button("📊 Gerar Excel (Por Equipe)", on_click=gerar_historico_excel_por_equipe, key='gerar_excel_hist')
+        if st.button("📊 Gerar Excel (Por Equipe)", key='gerar_excel_hist'):
+            st.session_state[f'tarefa_excel_hist:{unidade}'] = enfileirar_tarefa("historico_excel")
+        painel_tarefa('tarefa_excel_hist', "⬇️ Baixar Excel", "historico_por_equipe.xlsx",
+                      "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 'download_excel_hist')
+        if st.button("🧾 Gerar PDF do Histórico", key='gerar_pdf_hist'):
+            st.session_state[f'tarefa_pdf_hist:{unidade}'] = enfileirar_tarefa("historico_pdf")
+        painel_tarefa('tarefa_pdf_hist', "⬇️ Baixar PDF do Histórico", "historico_por_equipe.pdf", "application/pdf", 'download_pdf_hist')
     
     # Relatório individual
     with col3:
-        # Pega a lista de plantonistas das escalas filtradas
-        plantonistas_filtrados_list = sorted(list(set([p for equipe in filtrado['equipe'] for p in equipe if p])))
-        
+        # plantonistas_filtrados_list: quem aparece nas escalas filtradas (vem do cache junto com elas)
         if plantonistas_filtrados_list:
             st.subheader("Relatório Individual")
             plantonista_selecionado = st.selectbox("Selecione o plantonista", plantonistas_filtrados_list, key='select_plantonista_relatorio')
@@ -729,31 +964,98 @@ elif menu == "Histórico":
                  st.write(f"Relatório para {plantonista_selecionado}:")
                  st.dataframe(relatorio, use_container_width=True)
                  st.download_button("⬇️ Baixar Relatório Individual", 
-                                   data=relatorio.to_csv(index=False).encode('utf-8'),
+                                   data=lambda: csv_relatorio_individual(plantonista_selecionado, unidade, versoes['escalas']),
                                    file_name=f"relatorio_{plantonista_selecionado}.csv",
                                    mime="text/csv",
                                    key='download_relatorio_individual')
         else:
             st.info("Nenhuma escala encontrada no período para gerar relatório individual.")
 
+
+    # Fechamento mensal: extrato de horas de todos os plantonistas do mês
+    st.subheader("Fechamento Mensal")
+    col1, col2 = st.columns(2)
+    with col1:
+        mes_referencia = st.date_input("Mês de referência (qualquer dia do mês)",
+                                       (datetime.now().replace(day=1) - timedelta(days=1)).replace(day=1),
+                                       key='fechamento_mes')
+    with col2:
+        individuais = st.checkbox("Incluir CSV e PDF de cada plantonista (ZIP)", key='fechamento_individuais')
+    mes_fechamento = mes_referencia.strftime('%Y-%m')
+    formato = 'zip' if individuais else 'xlsx'
+    if st.button("🗓️ Gerar Fechamento do Mês", key='gerar_fechamento_btn'):
+        st.session_state[f'tarefa_fechamento_{formato}:{unidade}'] = enfileirar_tarefa(
+            "fechamento_mensal", mes=mes_fechamento, individuais=individuais)
+    if individuais:
+        painel_tarefa('tarefa_fechamento_zip', "⬇️ Baixar Fechamento (ZIP)", f"fechamento_{mes_fechamento}.zip",
+                      "application/zip", 'download_fechamento_zip')
+    else:
+        painel_tarefa('tarefa_fechamento_xlsx', "⬇️ Baixar Fechamento (Excel)", f"fechamento_{mes_fechamento}.xlsx",
+                      "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 'download_fechamento_xlsx')
     
     # Selecionar escalas para gerar PDF
     st.subheader("Gerar PDF de Escalas Selecionadas")
     ids_disponiveis = filtrado['id'].tolist()
     escalas_marcadas = st.multiselect("Selecione as escalas que deseja incluir no PDF:", ids_disponiveis, key='select_escalas_pdf')
+    renderizador_pdf = st.radio("Gerar o PDF pelo", list(RENDERIZADORES_PDF), format_func=RENDERIZADORES_PDF.get,
+                                horizontal=True, key='renderizador_pdf_selecionadas')
+    
+    por_escala = st.checkbox("Um PDF por escala (ZIP)", key='zip_pdf_selecionadas')
     
     if st.button("📄 Gerar PDF das Escalas Selecionadas", key='gerar_pdf_selecionadas_btn'):
         if not escalas_marcadas:
             st.warning("Você precisa selecionar pelo menos uma escala.")
+        elif por_escala:
+            st.session_state[f'tarefa_zip_selecionadas:{unidade}'] = enfileirar_tarefa("zip_escalas", ids=escalas_marcadas, renderizador=renderizador_pdf)
         else:
-            pdf_bytes = gerar_pdf_escala_por_equipe(ids=escalas_marcadas)
-            st.download_button(
-                label="⬇️ Baixar PDF",
-                data=pdf_bytes,
-                file_name="escalas_selecionadas.pdf",
-                mime="application/pdf",
-                key='download_pdf_selecionadas'
-            )
+            st.session_state[f'tarefa_pdf_selecionadas:{unidade}'] = enfileirar_tarefa("pdf_escalas", ids=escalas_marcadas, renderizador=renderizador_pdf)
+    if por_escala:
+        painel_tarefa('tarefa_zip_selecionadas', "⬇️ Baixar ZIP", "escalas_selecionadas.zip", "application/zip", 'download_zip_selecionadas')
+    else:
+        painel_tarefa('tarefa_pdf_selecionadas', "⬇️ Baixar PDF", "escalas_selecionadas.pdf", "application/pdf", 'download_pdf_selecionadas')
+
+# --- Calendário ---
+elif menu == "Calendário":
+    st.header("Calendário de Escalas")
+
+    hoje = datetime.now()
+    col1, col2 = st.columns(2)
+    with col1:
+        mes_calendario = st.selectbox("Mês", list(range(1, 13)), index=hoje.month - 1,
+                                      format_func=lambda m: meses_pt[m].capitalize(), key='calendario_mes')
+    with col2:
+        ano_calendario = st.number_input("Ano", 2000, 2100, hoje.year, key='calendario_ano')
+    mes = f"{ano_calendario}-{mes_calendario:02d}"
+    grade = calendario_cached(mes, unidade, (versao_mes(mes), versoes['viaturas'], versoes['coordenadores'],
+                                             versoes['modelos_escala'], versoes['excecoes_modelo']))
+
+    for coluna, nome in zip(st.columns(7), ["SEG", "TER", "QUA", "QUI", "SEX", "SÁB", "DOM"]):
+        coluna.markdown(f"**{nome}**")
+    dias = list(grade)
+    celulas = [None] * dias[0].weekday() + dias
+    celulas += [None] * (-len(celulas) % 7)
+    for semana in range(0, len(celulas), 7):
+        for coluna, dia in zip(st.columns(7), celulas[semana:semana + 7]):
+            if dia is None:
+                continue
+            with coluna.container(border=True):
+                st.markdown(f"**{dia.day}**")
+                for plantao in grade[dia]:
+                    st.caption(f"**{plantao['inicio']:%H:%M}–{plantao['fim']:%H:%M}** · {plantao['turno']}"
+                               f"{' · 🔁 previsto' if plantao.get('previsto') else ''}  \n"
+                               f"🚓 {plantao['placa']} · 👮 {plantao['coordenador']}  \n"
+                               f"{', '.join(plantao['equipe'])}")
+
+    plantoes_mes = [
+        {"Dia": dia.strftime('%d/%m'), "Início": p['inicio'].strftime('%d/%m/%Y %H:%M'), "Fim": p['fim'].strftime('%d/%m/%Y %H:%M'),
+         "Turno": p['turno'], "Viatura": p['placa'], "Coordenador": p['coordenador'], "Equipe": ', '.join(p['equipe'])}
+        for dia, lista in grade.items() for p in lista
+    ]
+    st.subheader(f"Plantões de {meses_pt[mes_calendario]} de {ano_calendario}")
+    if plantoes_mes:
+        st.dataframe(pd.DataFrame(plantoes_mes), use_container_width=True, hide_index=True)
+    else:
+        st.info("Nenhuma escala neste mês.")
 
 # --- Dashboard ---
 elif menu == "Dashboard":
@@ -767,18 +1069,9 @@ elif menu == "Dashboard":
         data_fim_filtro = st.date_input("Período: Data final", datetime.now(), key='dashboard_filtro_fim')
     
     # Filtrar dados pelo período
-    conn = conectar()
-    # Corrigido: Usando data_inicio para filtrar o histórico
-    # Se a coluna for diferente (ex: data_servico), ajuste aqui
-    df = pd.read_sql_query(
-        'SELECT * FROM historico WHERE data_inicio BETWEEN ? AND ?', # <-- CORREÇÃO AQUI
-        conn, 
-        params=[data_inicio_filtro.strftime('%Y-%m-%d'), data_fim_filtro.strftime('%Y-%m-%d')]
-    )
-    conn.close()
-
-    df['plantonistas_lista'] = df['plantonistas'].apply(safe_list_load)
-    df['horas_totais'] = df['horas_normais'] + df['horas_especiais']
+    # Intervalo semiaberto em minutos: inclui todo o último dia do período
+    df, membros = historico_periodo_cached(para_minutos(data_inicio_filtro), para_minutos(data_fim_filtro) + MINUTOS_DIA,
+                                           unidade, versoes['historico'])
     
     # Métricas globais em cards lado a lado
     col1, col2, col3 = st.columns(3)
@@ -792,30 +1085,28 @@ elif menu == "Dashboard":
     # Gráfico geral
     st.subheader("Distribuição de Horas no Período")
     if not df.empty:
-        st.bar_chart(df[['horas_normais', 'horas_especiais']])
+        # Agregado por dia/semana/mês conforme o período: o navegador recebe no máximo MAX_BARRAS barras
+        por_intervalo, intervalo = horas_por_intervalo(df, data_inicio_filtro, data_fim_filtro)
+        st.caption(f"Horas por {intervalo}")
+        st.bar_chart(por_intervalo)
     else:
         st.info("Nenhum dado de histórico no período selecionado.")
 
     # Ranking dos plantonistas
     st.subheader("Ranking: Plantonistas com Mais Horas Totais no Período")
-    from collections import defaultdict
-    horas_por_plantonista = defaultdict(lambda: {'normais': 0, 'especiais': 0})
-    
-    for _, row in df.iterrows():
-        for nome in row['plantonistas_lista']:
-            horas_por_plantonista[nome]['normais'] += row['horas_normais']
-            horas_por_plantonista[nome]['especiais'] += row['horas_especiais']
-    
-    if horas_por_plantonista:
-        ranking_df = pd.DataFrame([
-            {
-                'Plantonista': nome,
-                'Horas Normais': dados['normais'],
-                'Horas Especiais': dados['especiais'],
-                'Horas Totais': dados['normais'] + dados['especiais']
-            }
-            for nome, dados in horas_por_plantonista.items()
-        ]).sort_values(by='Horas Totais', ascending=False)
+    # Cada membro recebe as horas do seu registro; o groupby usa os códigos da categoria
+    horas_por_plantonista = (
+        membros.join(df[['horas_normais', 'horas_especiais']], on='linha')
+        .groupby('plantonista', observed=True)[['horas_normais', 'horas_especiais']].sum()
+    )
+    
+    if not horas_por_plantonista.empty:
+        ranking_df = pd.DataFrame({
+            'Plantonista': horas_por_plantonista.index.astype(str),
+            'Horas Normais': horas_por_plantonista['horas_normais'].to_numpy(),
+            'Horas Especiais': horas_por_plantonista['horas_especiais'].to_numpy(),
+            'Horas Totais': (horas_por_plantonista['horas_normais'] + horas_por_plantonista['horas_especiais']).to_numpy(),
+        }).sort_values(by='Horas Totais', ascending=False)
         
         st.dataframe(ranking_df.reset_index(drop=True), use_container_width=True)
         
@@ -831,19 +1122,23 @@ elif menu == "Dashboard":
     
     # Filtro individual
     st.subheader("Filtrar Plantonista Individualmente")
-    todos = sorted(horas_por_plantonista.keys())
+    todos = sorted(horas_por_plantonista.index.astype(str))
     
     # Adicionar campo de busca para plantonistas
     filtro_plantonista_dashboard = st.text_input("Buscar plantonista:", key='filtro_plantonista_dashboard')
     if filtro_plantonista_dashboard:
-        todos_filtrados = [p for p in todos if filtro_plantonista_dashboard.lower() in p.lower()]
+        # Primeiro os cadastrados encontrados pelo índice (em ordem de relevância),
+        # depois nomes do histórico que não estão mais no cadastro
+        encontrados = [p for p in buscar_plantonistas_cached(filtro_plantonista_dashboard, LIMITE_BUSCA, unidade, versoes['plantonistas'])['nome'] if p in horas_por_plantonista.index]
+        termo = normalizar_texto(filtro_plantonista_dashboard)
+        todos_filtrados = encontrados + [p for p in todos if p not in encontrados and termo in normalizar_texto(p)]
     else:
         todos_filtrados = todos
     
     if todos_filtrados:
         escolhido = st.selectbox("Plantonista", todos_filtrados, key='select_plantonista_dashboard')
     
-        filtrado_individual = df[df['plantonistas_lista'].apply(lambda l: escolhido in l)]
+        filtrado_individual = df.iloc[np.unique(membros['linha'][membros['plantonista'] == escolhido])]
         if not filtrado_individual.empty:
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -852,16 +1147,65 @@ elif menu == "Dashboard":
                 st.metric("Especiais", f"{filtrado_individual['horas_especiais'].sum():.1f}h")
             with col3:
                 st.metric("Totais", f"{filtrado_individual['horas_totais'].sum():.1f}h")
+
+            # Saldo acumulado lido da tabela saldo_horas (inclui anos arquivados)
+            mes_fim = data_fim_filtro.strftime('%Y-%m')
+            saldo_mes = saldo_horas(mes_fim, mes_fim, [escolhido])
+            saldo_ano = saldo_horas(f"{data_fim_filtro.year}-01", mes_fim, [escolhido])
+            col1, col2 = st.columns(2)
+            with col1:
+                total_mes = (saldo_mes['horas_normais'] + saldo_mes['horas_especiais']).sum()
+                st.metric(f"Saldo em {data_fim_filtro.strftime('%m/%Y')}", f"{total_mes:.1f}h")
+            with col2:
+                total_ano = (saldo_ano['horas_normais'] + saldo_ano['horas_especiais']).sum()
+                st.metric(f"Saldo em {data_fim_filtro.year} até {data_fim_filtro.strftime('%m')}", f"{total_ano:.1f}h")
                 
             st.subheader(f"Distribuição de horas - {escolhido} no Período")
-            st.bar_chart(filtrado_individual[['horas_normais', 'horas_especiais']])
+            por_intervalo, intervalo = horas_por_intervalo(filtrado_individual, data_inicio_filtro, data_fim_filtro)
+            st.caption(f"Horas por {intervalo}")
+            st.bar_chart(por_intervalo)
             
             # Histórico detalhado
             st.subheader("Histórico Detalhado no Período")
-            detalhes = filtrado_individual[['data_inicio', 'data_fim', 'horas_normais', 'horas_especiais', 'horas_totais']] # Usando data_inicio/data_fim
-            detalhes = detalhes.sort_values(by='data_inicio', ascending=False)
-            st.dataframe(detalhes, use_container_width=True)
+            detalhes = filtrado_individual.sort_values(by='inicio_min', ascending=False)
+            detalhes = detalhes[['inicio', 'fim', 'horas_normais', 'horas_especiais', 'horas_totais']]
+            st.dataframe(detalhes, use_container_width=True, column_config={
+                'inicio': st.column_config.DatetimeColumn('data_inicio', format='YYYY-MM-DD HH:mm:ss'),
+                'fim': st.column_config.DatetimeColumn('data_fim', format='YYYY-MM-DD HH:mm:ss'),
+            })
         else:
             st.write("Nenhum dado para este plantonista no período selecionado.")
     else:
         st.info("Nenhum plantonista encontrado no período selecionado.")
+
+    # Consolidado entre unidades: cada banco é consultado em paralelo
+    if len(UNIDADES) > 1:
+        st.subheader("Consolidado de Todas as Unidades no Período")
+        consolidado = agregar_unidades_cached(para_minutos(data_inicio_filtro), para_minutos(data_fim_filtro) + MINUTOS_DIA,
+                                              versoes_historico_unidades())
+        if consolidado.empty:
+            st.info("Nenhum dado nas unidades no período selecionado.")
+        else:
+            consolidado['horas_totais'] = consolidado['horas_normais'] + consolidado['horas_especiais']
+            por_unidade = consolidado.groupby('unidade', as_index=False)[['horas_normais', 'horas_especiais', 'horas_totais']].sum()
+            por_unidade['unidade'] = por_unidade['unidade'].map(lambda chave: UNIDADES[chave].get('nome', chave))
+            st.dataframe(por_unidade, use_container_width=True, hide_index=True)
+
+            ranking_geral = consolidado.groupby('plantonista', as_index=False).agg(
+                horas_normais=('horas_normais', 'sum'),
+                horas_especiais=('horas_especiais', 'sum'),
+                horas_totais=('horas_totais', 'sum'),
+                plantoes=('plantoes', 'sum'),
+                unidades=('unidade', lambda chaves: ', '.join(sorted(set(chaves))))
+            ).sort_values(by='horas_totais', ascending=False)
+            st.dataframe(ranking_geral.reset_index(drop=True), use_container_width=True)
+            st.download_button("⬇️ Exportar Ranking Consolidado",
+                               data=ranking_geral.to_csv(index=False).encode('utf-8'),
+                               file_name="ranking_consolidado.csv",
+                               mime="text/csv",
+                               key='download_ranking_consolidado')
+
+# --- Orçamento de tempo do rerun ---
+duracao_rerun_ms = (perf_counter() - _inicio_rerun) * 1000
+if duracao_rerun_ms > ORCAMENTO_RERUN_MS[menu]:
+    logger.warning("Rerun da página %s levou %.0f ms (orçamento: %d ms)", menu, duracao_rerun_ms, ORCAMENTO_RERUN_MS[menu])
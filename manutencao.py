@@ -0,0 +1,179 @@
+"""Comandos de manutenção do banco de escalas.
+
+Uso:
+    python manutencao.py arquivar 2024
+    python manutencao.py anos-arquivados
+    python manutencao.py reconciliar-saldos [--so-verificar]
+    python manutencao.py reconciliar-historico [--so-verificar]
+    python manutencao.py exportar-parquet analise/ [--completo]
+    python manutencao.py iniciar-reserva                           (uma vez, na cópia do principal)
+    python manutencao.py exportar-delta delta.jsonl --desde 1200   (no principal)
+    python manutencao.py aplicar-delta delta.jsonl                 (no reserva)
+    python manutencao.py posicao-registro
+    python manutencao.py recalcular-horas [--reiniciar] [--lote 5000]
+    python manutencao.py materializar-recorrentes
+    python manutencao.py limpar-tarefas [--dias 7]
+    python manutencao.py --unidade itapipoca arquivar 2024
+"""
+import argparse
+
+from utils import (criar_tabelas, arquivar_ano, anos_arquivados, caminho_arquivo, usar_unidade, reconciliar_saldos,
+                   exportar_parquet, exportar_delta, aplicar_delta, posicao_registro, id_do_no, iniciar_reserva,
+                   recalcular_horas_historico, reconciliar_historico, manter_horizonte, HORIZONTE_DIAS,
+                   limpar_tarefas_antigas, RETENCAO_TAREFAS_DIAS)
+
+
+def cmd_arquivar(args):
+    movidas = arquivar_ano(args.ano)
+    print(f"Ano {args.ano} arquivado em {caminho_arquivo(args.ano)}: "
+          f"{movidas['escalas']} escala(s), {movidas['historico']} registro(s) de histórico.")
+
+
+def cmd_anos_arquivados(args):
+    anos = anos_arquivados()
+    if not anos:
+        print("Nenhum ano arquivado.")
+    for ano in anos:
+        print(f"{ano}: {caminho_arquivo(ano)}")
+
+
+def cmd_reconciliar_saldos(args):
+    divergencias = reconciliar_saldos(corrigir=not args.so_verificar)
+    if divergencias.empty:
+        print("Saldo de horas confere com o histórico.")
+        return
+    print(f"{len(divergencias)} divergência(s) entre saldo_horas e o histórico:")
+    print(divergencias.to_string(index=False))
+    if not args.so_verificar:
+        print("Saldo de horas reconstruído a partir do histórico.")
+
+
+def cmd_reconciliar_historico(args):
+    resultado = reconciliar_historico(corrigir=not args.so_verificar)
+    if not any(resultado.values()):
+        print("Histórico confere com as escalas.")
+        return
+    print(f"{resultado['faltando']} escala(s) sem histórico, {resultado['orfas']} registro(s) sem escala, "
+          f"{resultado['divergentes']} registro(s) divergente(s).")
+    if not args.so_verificar:
+        print("Histórico corrigido a partir das escalas.")
+
+
+def cmd_exportar_parquet(args):
+    snapshot = exportar_parquet(args.pasta, completo=args.completo)
+    print(f"Snapshot {snapshot['numero']} em {args.pasta}")
+    if not snapshot["tabelas"]:
+        print("Nenhuma tabela mudou desde o último snapshot.")
+    for tabela, contagem in snapshot["tabelas"].items():
+        print(f"{tabela}: {contagem['linhas']} linha(s) nova(s) ou alterada(s), {contagem['removidos']} removida(s)")
+
+
+def cmd_iniciar_reserva(args):
+    ultimo, _ = posicao_registro()
+    origem = id_do_no()
+    novo = iniciar_reserva()
+    print(f"Banco reserva agora é {novo}; já contém as alterações de {origem} até a seq {ultimo} "
+          f"(use --desde {ultimo} no primeiro exportar-delta de lá).")
+
+
+def cmd_exportar_delta(args):
+    cabecalho = exportar_delta(args.arquivo, desde_seq=args.desde)
+    print(f"Alterações {cabecalho['desde'] + 1} a {cabecalho['ate']} de {cabecalho['origem']} gravadas em {args.arquivo}.")
+
+
+def cmd_aplicar_delta(args):
+    relatorio = aplicar_delta(args.arquivo)
+    print(f"{relatorio['aplicadas']} alteração(ões) aplicada(s), {relatorio['ignoradas']} já aplicada(s) antes.")
+    for conflito in relatorio["conflitos"]:
+        print(f"CONFLITO seq {conflito['seq']} em {conflito['tabela']} id {conflito['id']} ({conflito['operacao']}): "
+              f"local={conflito['local']} origem={conflito['origem']}")
+
+
+def cmd_posicao_registro(args):
+    ultimo, aplicados = posicao_registro()
+    print(f"Este banco ({id_do_no()}): registro até a seq {ultimo}.")
+    for origem, seq in aplicados.items():
+        print(f"Aplicado de {origem}: até a seq {seq} (use --desde {seq} ao exportar de lá).")
+
+
+def cmd_recalcular_horas(args):
+    def progresso(feitos, total):
+        print(f"\r{feitos}/{total} registro(s) do histórico", end="", flush=True)
+
+    resultado = recalcular_horas_historico(tamanho_lote=args.lote, reiniciar=args.reiniciar, progresso=progresso)
+    print()
+    if resultado['retomado_de']:
+        print(f"Retomado depois do id {resultado['retomado_de']}.")
+    print(f"{resultado['lidas']} registro(s) lido(s), {resultado['alteradas']} com horas alteradas no total.")
+
+
+def cmd_materializar_recorrentes(args):
+    criadas = manter_horizonte()
+    print(f"{criadas} escala(s) criada(s) a partir das escalas recorrentes (horizonte de {HORIZONTE_DIAS} dias).")
+
+
+def cmd_limpar_tarefas(args):
+    apagadas = limpar_tarefas_antigas(args.dias)
+    print(f"{apagadas} tarefa(s) encerrada(s) há mais de {args.dias} dia(s) apagada(s), com seus arquivos.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manutenção do banco de escalas")
+    parser.add_argument("--unidade", help="Chave da unidade no unidades.json (modo multiunidade)")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("arquivar", help="Move um ano encerrado para arquivo/escala_<ano>.db")
+    p.add_argument("ano", type=int)
+    p.set_defaults(func=cmd_arquivar)
+
+    p = sub.add_parser("anos-arquivados", help="Lista os arquivos anuais existentes")
+    p.set_defaults(func=cmd_anos_arquivados)
+
+    p = sub.add_parser("reconciliar-saldos", help="Reconstrói o saldo de horas a partir do histórico e mostra divergências")
+    p.add_argument("--so-verificar", action="store_true", help="Só mostra as divergências, sem corrigir")
+    p.set_defaults(func=cmd_reconciliar_saldos)
+
+    p = sub.add_parser("reconciliar-historico", help="Confere o histórico contra as escalas e corrige as divergências")
+    p.add_argument("--so-verificar", action="store_true", help="Só conta as divergências, sem corrigir")
+    p.set_defaults(func=cmd_reconciliar_historico)
+
+    p = sub.add_parser("exportar-parquet", help="Exporta as tabelas em Parquet (só o que mudou desde o último snapshot)")
+    p.add_argument("pasta")
+    p.add_argument("--completo", action="store_true", help="Descarta os snapshots anteriores e exporta tudo")
+    p.set_defaults(func=cmd_exportar_parquet)
+
+    p = sub.add_parser("iniciar-reserva", help="Dá um id próprio a um banco copiado do principal (rodar uma vez na cópia)")
+    p.set_defaults(func=cmd_iniciar_reserva)
+
+    p = sub.add_parser("exportar-delta", help="Grava as alterações posteriores a uma seq para enviar ao banco reserva")
+    p.add_argument("arquivo")
+    p.add_argument("--desde", type=int, default=0, help="Última seq que o reserva já aplicou (veja posicao-registro nele)")
+    p.set_defaults(func=cmd_exportar_delta)
+
+    p = sub.add_parser("aplicar-delta", help="Aplica um arquivo de exportar-delta (reaplicar não tem efeito)")
+    p.add_argument("arquivo")
+    p.set_defaults(func=cmd_aplicar_delta)
+
+    p = sub.add_parser("posicao-registro", help="Mostra até onde o registro local vai e o que já foi aplicado de outros bancos")
+    p.set_defaults(func=cmd_posicao_registro)
+
+    p = sub.add_parser("recalcular-horas", help="Recalcula as horas de todo o histórico (retoma se foi interrompido)")
+    p.add_argument("--reiniciar", action="store_true", help="Ignora o ponto de retomada e começa do início")
+    p.add_argument("--lote", type=int, default=5000, help="Registros por lote")
+    p.set_defaults(func=cmd_recalcular_horas)
+
+    p = sub.add_parser("materializar-recorrentes", help="Cria as escalas das ocorrências recorrentes dos próximos dias")
+    p.set_defaults(func=cmd_materializar_recorrentes)
+
+    p = sub.add_parser("limpar-tarefas", help="Apaga tarefas encerradas antigas e os arquivos gerados por elas")
+    p.add_argument("--dias", type=int, default=RETENCAO_TAREFAS_DIAS, help="Dias que uma tarefa encerrada é mantida")
+    p.set_defaults(func=cmd_limpar_tarefas)
+
+    args = parser.parse_args()
+    usar_unidade(args.unidade)
+    criar_tabelas()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
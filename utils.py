@@ -1,73 +1,300 @@
 import sqlite3
 import json
 import os
+import re
+import contextvars
+from contextlib import contextmanager, nullcontext
+from itertools import chain, islice
+import csv
+import io
+import unicodedata
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import tempfile
 from docx import Document
 from docx2pdf import convert
 from docx.shared import Inches
+from docx.enum.text import WD_BREAK, WD_ALIGN_PARAGRAPH
+from docx.text.paragraph import Paragraph
+from docx.table import Table
 import subprocess
 import platform
+import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import zipfile
+from pathlib import Path
+import calendar
+import uuid
+import shutil
 from docx.oxml import parse_xml
 from docx.oxml.ns import qn
 from docx.oxml.table import CT_Tbl
+from fpdf import FPDF
 
 # --- Banco ---
 DB_PATH = "escala.db"
+MODELO_PATH = "base_escala.docx"
+ASSINATURA_PATH = "assinatura.png"
+DELEGADO = "DR MARCOS VINÍCIUS CACAU DE LIMA\nDelegado De Polícia Civil"
 
-def conectar():
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-    conn.row_factory = sqlite3.Row
-    return conn
+# --- Unidades ---
+# Com um unidades.json na pasta do app, cada delegacia tem seu próprio banco,
+# modelo de escala e assinatura:
+#   {"itapipoca": {"nome": "DRPC Itapipoca", "banco": "unidades/itapipoca/escala.db",
+#                  "modelo": "unidades/itapipoca/base_escala.docx",
+#                  "assinatura": "unidades/itapipoca/assinatura.png",
+#                  "delegado": "DR FULANO DE TAL\nDelegado De Polícia Civil"}}
+# Sem o arquivo (ou sem as chaves opcionais), valem DB_PATH, MODELO_PATH,
+# ASSINATURA_PATH e DELEGADO.
+UNIDADES_PATH = "unidades.json"
 
-def criar_tabelas():
-    conn = conectar()
-    c = conn.cursor()
-    c.executescript("""
-        CREATE TABLE IF NOT EXISTS plantonistas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            matricula TEXT NOT NULL,
-            cpf TEXT,
-            telefone TEXT
-        );
-        CREATE TABLE IF NOT EXISTS escalas (
+def carregar_unidades(caminho=UNIDADES_PATH):
+    if not os.path.exists(caminho):
+        return {}
+    with open(caminho, encoding="utf-8") as f:
+        return json.load(f)
+
+UNIDADES = carregar_unidades()
+
+# A unidade fica num ContextVar: cada execução do script do Streamlit e cada
+# tarefa em segundo plano enxerga só a sua.
+_unidade_atual = contextvars.ContextVar("unidade_atual", default=None)
+
+def usar_unidade(chave):
+    if chave is not None and chave not in UNIDADES:
+        raise ValueError(f"Unidade desconhecida: {chave}")
+    return _unidade_atual.set(chave)
+
+@contextmanager
+def na_unidade(chave):
+    token = usar_unidade(chave)
+    try:
+        yield
+    finally:
+        _unidade_atual.reset(token)
+
+def unidade_atual():
+    return _unidade_atual.get()
+
+def caminho_banco():
+    unidade = _unidade_atual.get()
+    return UNIDADES[unidade]["banco"] if unidade else DB_PATH
+
+def caminho_modelo():
+    unidade = _unidade_atual.get()
+    return UNIDADES[unidade].get("modelo", MODELO_PATH) if unidade else MODELO_PATH
+
+def caminho_assinatura():
+    unidade = _unidade_atual.get()
+    return UNIDADES[unidade].get("assinatura", ASSINATURA_PATH) if unidade else ASSINATURA_PATH
+
+def delegado():
+    unidade = _unidade_atual.get()
+    return UNIDADES[unidade].get("delegado", DELEGADO) if unidade else DELEGADO
+
+def pasta_relatorios():
+    return os.path.join(os.path.dirname(caminho_banco()), "relatorios")
+
+TABELAS = ("plantonistas", "escalas", "historico", "viaturas", "coordenadores")
+
+# Início e fim ficam gravados como minutos desde 1970-01-01 00:00 (horário
+# local, sem fuso) em colunas INTEGER indexadas. data_inicio/data_fim no
+# formato '%Y-%m-%d %H:%M' continuam disponíveis como colunas geradas.
+_DATA_GERADA = "TEXT GENERATED ALWAYS AS (strftime('%Y-%m-%d %H:%M', {coluna} * 60, 'unixepoch')) VIRTUAL"
+DDL_ESCALAS = f"""
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            data_inicio TEXT NOT NULL,
-            data_fim TEXT NOT NULL,
+            data_inicio {_DATA_GERADA.format(coluna='inicio_min')},
+            data_fim {_DATA_GERADA.format(coluna='fim_min')},
             turno TEXT NOT NULL,
             vagas INTEGER NOT NULL,
             plantonistas TEXT NOT NULL,
             viatura_id INTEGER,
             coordenador_id INTEGER,
+            inicio_min INTEGER NOT NULL,
+            fim_min INTEGER NOT NULL,
+            versao INTEGER NOT NULL DEFAULT 1,
+            modelo_id INTEGER,
+            ocorrencia_min INTEGER,
             FOREIGN KEY (viatura_id) REFERENCES viaturas(id),
             FOREIGN KEY (coordenador_id) REFERENCES coordenadores(id)
-        );
-        CREATE TABLE IF NOT EXISTS historico (
+        """
+DDL_HISTORICO = f"""
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            data_inicio TEXT NOT NULL,
-            data_fim TEXT NOT NULL,
+            data_inicio {_DATA_GERADA.format(coluna='inicio_min')},
+            data_fim {_DATA_GERADA.format(coluna='fim_min')},
             turno TEXT NOT NULL,
             plantonistas TEXT NOT NULL,
             horas_normais REAL,
-            horas_especiais REAL
+            horas_especiais REAL,
+            inicio_min INTEGER NOT NULL,
+            fim_min INTEGER NOT NULL,
+            versao INTEGER NOT NULL DEFAULT 1,
+            escala_id INTEGER
+        """
+COLUNAS_ESCALAS = "id, turno, vagas, plantonistas, viatura_id, coordenador_id, inicio_min, fim_min"
+COLUNAS_HISTORICO = "id, turno, plantonistas, horas_normais, horas_especiais, inicio_min, fim_min"
+# Colunas acrescentadas depois que já existiam arquivos anuais. arquivar_ano
+# as cria nos arquivos que não as têm; em arquivos nunca mais reabertos,
+# iterar_periodo lê NULL no lugar delas.
+COLUNAS_POSTERIORES = {
+    "escalas": {"versao": "INTEGER NOT NULL DEFAULT 1", "modelo_id": "INTEGER", "ocorrencia_min": "INTEGER"},
+    "historico": {"versao": "INTEGER NOT NULL DEFAULT 1", "escala_id": "INTEGER"},
+}
+# Colunas copiadas para os arquivos anuais e lidas no UNION ALL de iterar_periodo
+COLUNAS_ARQUIVO = {
+    "escalas": f"{COLUNAS_ESCALAS}, {', '.join(COLUNAS_POSTERIORES['escalas'])}",
+    "historico": f"{COLUNAS_HISTORICO}, {', '.join(COLUNAS_POSTERIORES['historico'])}",
+}
+COLUNAS_UNIAO = {tabela: f"{colunas}, data_inicio, data_fim" for tabela, colunas in COLUNAS_ARQUIVO.items()}
+
+def conectar():
+    conn = sqlite3.connect(caminho_banco(), detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def criar_tabelas():
+    conn = conectar()
+    # WAL deixa as leituras longas dos relatórios rodarem junto com as
+    # escritas de progresso das tarefas e das telas
+    conn.execute("PRAGMA journal_mode=WAL")
+    c = conn.cursor()
+    c.executescript(f"""
+        CREATE TABLE IF NOT EXISTS plantonistas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            matricula TEXT NOT NULL,
+            cpf TEXT,
+            telefone TEXT,
+            versao INTEGER NOT NULL DEFAULT 1
         );
+        CREATE TABLE IF NOT EXISTS escalas ({DDL_ESCALAS});
+        CREATE TABLE IF NOT EXISTS historico ({DDL_HISTORICO});
         CREATE TABLE IF NOT EXISTS viaturas (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             placa TEXT NOT NULL,
-            modelo TEXT
+            modelo TEXT,
+            versao INTEGER NOT NULL DEFAULT 1
         );
         CREATE TABLE IF NOT EXISTS coordenadores (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nome TEXT NOT NULL,
             matricula TEXT,
-            contato TEXT
+            contato TEXT,
+            versao INTEGER NOT NULL DEFAULT 1
+        );
+        CREATE TABLE IF NOT EXISTS versoes_tabelas (
+            tabela TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL
         );
     """)
+    migrar_datas_inteiras(conn)
+    # Versão de cada linha, para as edições com compare-and-swap
+    for tabela in TABELAS:
+        if "versao" not in [row['name'] for row in conn.execute(f"PRAGMA table_info({tabela})")]:
+            conn.execute(f"ALTER TABLE {tabela} ADD COLUMN versao INTEGER NOT NULL DEFAULT 1")
+    for tabela in TABELAS:
+        criar_triggers_versao(conn, tabela)
+    criar_tabela_feriados(conn)
+    criar_indice_busca(conn)
+    criar_tabela_tarefas(conn)
+    criar_tabela_saldos(conn)
+    criar_historico_derivado(conn)
+    criar_modelos_escala(conn)
+    criar_versoes_meses(conn)
+    criar_registro_alteracoes(conn)
     conn.commit()
     conn.close()
 
+def migrar_datas_inteiras(conn):
+    """Converte bancos antigos, com datas em TEXT, para colunas de minutos."""
+    for tabela, ddl, colunas in (("escalas", DDL_ESCALAS, COLUNAS_ESCALAS),
+                                 ("historico", DDL_HISTORICO, COLUNAS_HISTORICO)):
+        existentes = [row['name'] for row in conn.execute(f"PRAGMA table_xinfo({tabela})")]
+        if "inicio_min" not in existentes:
+            convertidas = colunas.replace(
+                "inicio_min, fim_min",
+                "CAST(strftime('%s', data_inicio) AS INTEGER) / 60, CAST(strftime('%s', data_fim) AS INTEGER) / 60"
+            )
+            conn.execute(f"ALTER TABLE {tabela} RENAME TO {tabela}_texto")
+            conn.execute(f"CREATE TABLE {tabela} ({ddl})")
+            conn.execute(f"INSERT INTO {tabela} ({colunas}) SELECT {convertidas} FROM {tabela}_texto")
+            conn.execute(f"DROP TABLE {tabela}_texto")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabela}_inicio ON {tabela} (inicio_min)")
+    conn.commit()
+
+def criar_triggers_versao(conn, tabela):
+    # Cada escrita incrementa a versão da tabela; caches e exportações usam
+    # esse número como chave em vez de reler os dados para saber se mudaram.
+    for evento in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS versao_{tabela}_{evento.lower()}
+            AFTER {evento} ON {tabela}
+            BEGIN
+                INSERT INTO versoes_tabelas (tabela, versao) VALUES ('{tabela}', 1)
+                ON CONFLICT(tabela) DO UPDATE SET versao = versao + 1;
+            END
+        """)
+
+def versao_tabela(tabela):
+    with conectar() as conn:
+        row = conn.execute("SELECT versao FROM versoes_tabelas WHERE tabela=?", (tabela,)).fetchone()
+    return row['versao'] if row else 0
+
+def versoes_tabelas():
+    """Versão de todas as tabelas numa consulta só (0 para as que nunca mudaram)."""
+    versoes = dict.fromkeys(TABELAS + ("feriados", "modelos_escala", "excecoes_modelo"), 0)
+    with conectar() as conn:
+        versoes.update((row['tabela'], row['versao']) for row in conn.execute("SELECT tabela, versao FROM versoes_tabelas"))
+    return versoes
+
+
+# --- Escrita ---
+# Todas as escritas do app passam por transacao_escrita: uma por vez em cada
+# banco dentro do processo (as sessões do Streamlit são threads) e com BEGIN
+# IMMEDIATE, que pega a trava de escrita no início em vez de falhar com
+# "database is locked" ao tentar promover uma leitura. Transações curtas.
+_locks_escrita = {}
+_lock_locks_escrita = threading.Lock()
+
+class ConflitoEdicao(Exception):
+    """O registro mudou (ou foi apagado) desde que foi aberto para edição."""
+
+@contextmanager
+def transacao_escrita():
+    with _lock_locks_escrita:
+        lock = _locks_escrita.setdefault(caminho_banco(), threading.Lock())
+    with lock:
+        conn = conectar()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+def _atualizar_com_versao(tabela, id_registro, versao, valores):
+    """UPDATE só se a linha ainda está na ``versao`` lida; devolve a nova versão."""
+    atribuicoes = ', '.join(f"{coluna} = ?" for coluna in valores)
+    with transacao_escrita() as conn:
+        cursor = conn.execute(
+            f"UPDATE {tabela} SET {atribuicoes}, versao = versao + 1 WHERE id = ? AND versao = ?",
+            (*valores.values(), id_registro, versao)
+        )
+        if cursor.rowcount == 0:
+            atual = conn.execute(f"SELECT versao FROM {tabela} WHERE id = ?", (id_registro,)).fetchone()
+            if atual is None:
+                raise ConflitoEdicao("O registro foi apagado por outra pessoa enquanto você editava.")
+            raise ConflitoEdicao("O registro foi alterado por outra pessoa enquanto você editava. "
+                                 "Abra a edição de novo para ver os dados atuais.")
+        if tabela == "escalas":
+            _derivar_historico(conn, [id_registro])
+    return versao + 1
+
 
 # --- Plantonistas ---
 def listar_plantonistas():
@@ -75,50 +302,557 @@ def listar_plantonistas():
         return pd.read_sql_query("SELECT * FROM plantonistas", conn)
 
 def cadastrar_plantonista(nome, matricula, cpf, telefone):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("INSERT INTO plantonistas (nome, matricula, cpf, telefone) VALUES (?, ?, ?, ?)", (nome, matricula, cpf, telefone))
 
 def apagar_plantonista(id_plantonista):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("DELETE FROM plantonistas WHERE id=?", (id_plantonista,))
 
+def atualizar_plantonista(id_plantonista, nome, matricula, cpf, telefone, versao):
+    return _atualizar_com_versao("plantonistas", id_plantonista, versao,
+                                 {"nome": nome, "matricula": matricula, "cpf": cpf, "telefone": telefone})
+
+# Índice FTS5 com tokenizador trigram sobre nome, matrícula e CPF. O texto é
+# guardado sem acentos e em minúsculas (normalizar_texto), então "joao"
+# encontra "JOÃO". Gatilhos só de SQL anotam em plantonistas_busca_pendentes
+# os ids que mudaram, e a busca reindexa em Python apenas essas linhas; assim
+# a tabela continua gravável por qualquer cliente SQLite.
+def criar_indice_busca(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS plantonistas_busca USING fts5(nome, matricula, cpf, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        # SQLite sem FTS5/trigram: buscar_plantonistas usa LIKE sem índice
+        return
+    conn.execute("CREATE TABLE IF NOT EXISTS plantonistas_busca_pendentes (id INTEGER PRIMARY KEY)")
+    # Gatilhos da primeira versão, que dependiam da função sem_acento do
+    # conectar(), e a versão com que a segunda montava o índice inteiro
+    for evento in ("insert", "update", "delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS plantonistas_busca_{evento}")
+    conn.execute("DROP TABLE IF EXISTS plantonistas_busca_versao")
+    novo = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'plantonistas_busca_fila_insert'"
+    ).fetchone() is None
+    for evento, ids in (("insert", ["NEW.id"]), ("update", ["OLD.id", "NEW.id"]), ("delete", ["OLD.id"])):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS plantonistas_busca_fila_{evento}
+            AFTER {evento.upper()} ON plantonistas
+            BEGIN
+                INSERT OR IGNORE INTO plantonistas_busca_pendentes (id) VALUES {', '.join(f'({i})' for i in ids)};
+            END
+        """)
+    if novo:
+        # Antes dos gatilhos não havia fila: monta o índice inteiro uma vez
+        conn.execute("DELETE FROM plantonistas_busca")
+        conn.execute("INSERT OR IGNORE INTO plantonistas_busca_pendentes (id) SELECT id FROM plantonistas")
+        _atualizar_indice_busca(conn)
+
+def _documento_busca(valor):
+    # Matrícula e CPF também são indexados sem pontuação ("07502094377")
+    texto = normalizar_texto(valor or '')
+    return f"{texto} {texto.replace('.', '').replace('-', '')}"
+
+def _atualizar_indice_busca(conn):
+    """Reindexa só os plantonistas anotados em plantonistas_busca_pendentes."""
+    ids = [row[0] for row in conn.execute("SELECT id FROM plantonistas_busca_pendentes")]
+    for i in range(0, len(ids), 500):
+        lote = ids[i:i + 500]
+        marcadores = ','.join(['?'] * len(lote))
+        conn.execute(f"DELETE FROM plantonistas_busca WHERE rowid IN ({marcadores})", lote)
+        conn.executemany(
+            "INSERT INTO plantonistas_busca (rowid, nome, matricula, cpf) VALUES (?, ?, ?, ?)",
+            [(row['id'], normalizar_texto(row['nome'] or ''), _documento_busca(row['matricula']), _documento_busca(row['cpf']))
+             for row in conn.execute(f"SELECT id, nome, matricula, cpf FROM plantonistas WHERE id IN ({marcadores})", lote)]
+        )
+        conn.execute(f"DELETE FROM plantonistas_busca_pendentes WHERE id IN ({marcadores})", lote)
+
+def buscar_plantonistas(termo, limite=None):
+    """Plantonistas cujo nome, matrícula ou CPF contém todas as palavras de ``termo``.
+
+    A busca ignora acentos e maiúsculas. Resultados que começam pelo termo
+    vêm primeiro, depois a ordem de relevância do bm25.
+    """
+    palavras = normalizar_texto(termo).split()
+    if not palavras:
+        return listar_plantonistas()
+    # Matrícula e CPF estão indexados também sem '.'/'-': cada palavra vale
+    # como foi digitada ou sem essa pontuação ("075.020" encontra 07502094377)
+    variantes = [sorted({p, p.replace('.', '').replace('-', '')} - {''}) for p in palavras]
+    # O trigram só indexa sequências de 3+ caracteres; palavras menores viram LIKE
+    longas = [v for v in variantes if min(map(len, v)) >= 3]
+    curtas = [v for v in variantes if min(map(len, v)) < 3]
+    condicoes, params = [], []
+    if longas:
+        condicoes.append("plantonistas_busca MATCH ?")
+        # Grupos entre parênteses precisam de AND explícito na sintaxe do FTS5
+        params.append(" AND ".join("(" + " OR ".join('"' + p.replace('"', '""') + '"' for p in v) + ")" for v in longas))
+    for v in curtas:
+        condicoes.append("(" + " OR ".join(["b.nome LIKE ? OR b.matricula LIKE ? OR b.cpf LIKE ?"] * len(v)) + ")")
+        params.extend(f"%{p}%" for p in v for _ in range(3))
+    ordem = "bm25(plantonistas_busca)" if longas else "b.nome"
+    # Ordena e limita só os ids do índice; a junção com plantonistas fica
+    # para as linhas que vão ser devolvidas
+    query = f"""
+        WITH achados AS MATERIALIZED (
+            SELECT b.rowid AS id, b.nome LIKE ? AS prefixo, {ordem} AS relevancia
+            FROM plantonistas_busca b
+            WHERE {' AND '.join(condicoes)}
+            ORDER BY prefixo DESC, relevancia {'LIMIT ?' if limite else ''}
+        )
+        SELECT p.* FROM achados a JOIN plantonistas p ON p.id = a.id
+        ORDER BY a.prefixo DESC, a.relevancia
+    """
+    params.insert(0, normalizar_texto(termo).strip() + '%')
+    if limite:
+        params.append(limite)
+    with conectar() as conn:
+        try:
+            pendente = conn.execute("SELECT 1 FROM plantonistas_busca_pendentes LIMIT 1").fetchone()
+        except sqlite3.OperationalError:
+            pendente = None  # sem FTS5: vai direto para o LIKE abaixo
+    if pendente:
+        with transacao_escrita() as conn:
+            _atualizar_indice_busca(conn)
+    with conectar() as conn:
+        try:
+            return pd.read_sql_query(query, conn, params=params)
+        except pd.errors.DatabaseError:
+            df = pd.read_sql_query("SELECT * FROM plantonistas", conn)
+    texto = df['nome'].map(lambda nome: normalizar_texto(nome or '')) + ' ' + \
+        df['matricula'].map(_documento_busca) + ' ' + df['cpf'].map(_documento_busca)
+    mascara = pd.Series(True, index=df.index)
+    for v in variantes:
+        qualquer = pd.Series(False, index=df.index)
+        for p in v:
+            qualquer |= texto.str.contains(p, regex=False)
+        mascara &= qualquer
+    return df[mascara].head(limite) if limite else df[mascara]
+
 # --- Escalas ---
 
 def gerar_escala_manual(data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id):
     plantonistas_str = json.dumps(plantonistas, ensure_ascii=False)
-    horas_normais, horas_especiais = calcular_horas_extras(data_inicio, data_fim)
+    inicio_min, fim_min = para_minutos(data_inicio), para_minutos(data_fim)
 
-    with conectar() as conn:
-        conn.execute(
+    with transacao_escrita() as conn:
+        id_escala = conn.execute(
             """
-            INSERT INTO escalas (data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id)
+            INSERT INTO escalas (inicio_min, fim_min, turno, vagas, plantonistas, viatura_id, coordenador_id)
             VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (data_inicio, data_fim, turno, vagas, plantonistas_str, viatura_id, coordenador_id)
-        )
-        conn.execute(
-            """
-            INSERT INTO historico (data_inicio, data_fim, turno, plantonistas, horas_normais, horas_especiais)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (data_inicio, data_fim, turno, plantonistas_str, horas_normais, horas_especiais)
-        )
+            (inicio_min, fim_min, turno, vagas, plantonistas_str, viatura_id, coordenador_id)
+        ).lastrowid
+        _derivar_historico(conn, [id_escala])
 
 
-def gerar_escala_automatica(data_inicio, data_fim, turno, vagas):
+def gerar_escala_automatica(data_inicio, data_fim, turno, vagas, viatura_id=None, coordenador_id=None):
+    """Escala os plantonistas com menos horas no mês de ``data_inicio``."""
     df = listar_plantonistas()
-    selecionados = df['nome'].tolist()[:vagas]
-    gerar_escala_manual(data_inicio, data_fim, turno, vagas, selecionados)
+    mes = datetime.strptime(data_inicio, '%Y-%m-%d %H:%M').strftime('%Y-%m')
+    saldos = saldo_horas(mes, mes).set_index('plantonista')
+    df['horas'] = df['nome'].map(saldos['horas_normais'] + saldos['horas_especiais']).fillna(0)
+    selecionados = df.sort_values('horas', kind='stable')['nome'].tolist()[:vagas]
+    gerar_escala_manual(data_inicio, data_fim, turno, vagas, selecionados, viatura_id, coordenador_id)
+
+def atualizar_escala(id_escala, data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id, versao):
+    return _atualizar_com_versao("escalas", id_escala, versao, {
+        "inicio_min": para_minutos(data_inicio), "fim_min": para_minutos(data_fim), "turno": turno, "vagas": vagas,
+        "plantonistas": json.dumps(plantonistas, ensure_ascii=False),
+        "viatura_id": viatura_id, "coordenador_id": coordenador_id,
+    })
 
 def apagar_escala(id_escala):
+    """Apaga a escala do banco principal; devolve False se ela não estava lá.
+
+    Escalas de anos arquivados são somente leitura e não são apagadas.
+    """
+    with transacao_escrita() as conn:
+        apagada = conn.execute("DELETE FROM escalas WHERE id=?", (id_escala,)).rowcount > 0
+        _derivar_historico(conn, [id_escala])
+    return apagada
+
+def escalas_arquivadas(ids):
+    """Dos ``ids``, os que não estão no banco principal (só nos arquivos anuais)."""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return set()
+    with conectar() as conn:
+        principais = {row['id'] for row in conn.execute(
+            f"SELECT id FROM escalas WHERE id IN ({','.join(['?'] * len(ids))})", ids
+        )}
+    return set(ids) - principais
+
+# --- Escalas recorrentes ---
+# Um modelo guarda uma vez o plantão que se repete (equipe, viatura, turno) e a
+# regra: a primeira ocorrência e o intervalo em dias (7 = toda semana no mesmo
+# dia e hora). As ocorrências viram linhas de escalas (modelo_id,
+# ocorrencia_min) só até HORIZONTE_DIAS à frente, quando alguém abre o app ou
+# roda a manutenção; daí em diante são calculadas na hora por
+# ocorrencias_modelos. excecoes_modelo guarda o que muda numa ocorrência
+# (cancelada, outra equipe, outro horário). Uma ocorrência já materializada é
+# uma escala comum: editar ou apagar a escala vale como exceção.
+HORIZONTE_DIAS = 28
+COLUNAS_OCORRENCIA = ["inicio_min", "fim_min", "turno", "vagas", "plantonistas", "viatura_id", "coordenador_id"]
+# O id existe para o registro de alterações, que identifica as linhas por ele
+DDL_EXCECOES_MODELO = """
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            modelo_id INTEGER NOT NULL,
+            ocorrencia_min INTEGER NOT NULL,
+            cancelada INTEGER NOT NULL DEFAULT 0,
+            inicio_min INTEGER,
+            fim_min INTEGER,
+            turno TEXT,
+            vagas INTEGER,
+            plantonistas TEXT,
+            viatura_id INTEGER,
+            coordenador_id INTEGER,
+            versao INTEGER NOT NULL DEFAULT 1,
+            UNIQUE (modelo_id, ocorrencia_min)
+        """
+
+def criar_modelos_escala(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS modelos_escala (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            turno TEXT NOT NULL,
+            vagas INTEGER NOT NULL,
+            plantonistas TEXT NOT NULL,
+            viatura_id INTEGER,
+            coordenador_id INTEGER,
+            inicio_min INTEGER NOT NULL,
+            duracao_min INTEGER NOT NULL,
+            intervalo_dias INTEGER NOT NULL CHECK (intervalo_dias > 0),
+            ate_min INTEGER,
+            materializado_ate INTEGER NOT NULL,
+            versao INTEGER NOT NULL DEFAULT 1
+        );
+    """)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS excecoes_modelo ({DDL_EXCECOES_MODELO})")
+    # Bancos com a primeira versão da tabela, de chave (modelo_id, ocorrencia_min) e sem id
+    colunas = [row['name'] for row in conn.execute("PRAGMA table_info(excecoes_modelo)")]
+    if "id" not in colunas:
+        conn.execute("ALTER TABLE excecoes_modelo RENAME TO excecoes_modelo_sem_id")
+        conn.execute(f"CREATE TABLE excecoes_modelo ({DDL_EXCECOES_MODELO})")
+        conn.execute(f"INSERT INTO excecoes_modelo ({', '.join(colunas)}) "
+                     f"SELECT {', '.join(colunas)} FROM excecoes_modelo_sem_id ORDER BY modelo_id, ocorrencia_min")
+        conn.execute("DROP TABLE excecoes_modelo_sem_id")
+    elif "versao" not in colunas:
+        conn.execute("ALTER TABLE excecoes_modelo ADD COLUMN versao INTEGER NOT NULL DEFAULT 1")
+    existentes = [row['name'] for row in conn.execute("PRAGMA table_info(escalas)")]
+    for coluna in ("modelo_id", "ocorrencia_min"):
+        if coluna not in existentes:
+            conn.execute(f"ALTER TABLE escalas ADD COLUMN {coluna} INTEGER")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_escalas_ocorrencia ON escalas (modelo_id, ocorrencia_min)")
+    criar_triggers_versao(conn, "modelos_escala")
+    criar_triggers_versao(conn, "excecoes_modelo")
+
+def _inicios_ocorrencias(modelo, inicio_min, fim_min):
+    """Começos (originais) das ocorrências do modelo em [inicio_min, fim_min)."""
+    passo = modelo['intervalo_dias'] * MINUTOS_DIA
+    if modelo['ate_min'] is not None:
+        fim_min = min(fim_min, modelo['ate_min'])
+    primeira = max(0, -(-(inicio_min - modelo['inicio_min']) // passo))
+    ultima = -(-(fim_min - modelo['inicio_min']) // passo)
+    return range(modelo['inicio_min'] + primeira * passo, modelo['inicio_min'] + max(primeira, ultima) * passo, passo)
+
+def _expandir_modelo(modelo, inicio_min, fim_min, excecoes):
+    """Escalas (dicts com COLUNAS_OCORRENCIA, modelo_id e ocorrencia_min) das
+    ocorrências em [inicio_min, fim_min), com as exceções aplicadas."""
+    for ocorrencia in _inicios_ocorrencias(modelo, inicio_min, fim_min):
+        escala = {coluna: modelo[coluna] for coluna in COLUNAS_OCORRENCIA[2:]}
+        escala.update(inicio_min=ocorrencia, fim_min=ocorrencia + modelo['duracao_min'],
+                      modelo_id=modelo['id'], ocorrencia_min=ocorrencia)
+        excecao = excecoes.get((modelo['id'], ocorrencia))
+        if excecao is not None:
+            if excecao['cancelada']:
+                continue
+            escala.update((coluna, excecao[coluna]) for coluna in COLUNAS_OCORRENCIA if excecao[coluna] is not None)
+        yield escala
+
+def _modelos_e_excecoes(conn, inicio_min, fim_min):
+    """Modelos com ocorrências não materializadas em [inicio_min, fim_min) e as exceções do período."""
+    modelos = conn.execute(
+        """
+        SELECT * FROM modelos_escala
+        WHERE inicio_min < ? AND materializado_ate < ? AND (ate_min IS NULL OR ate_min > MAX(?, materializado_ate))
+        """,
+        (fim_min, fim_min, inicio_min)
+    ).fetchall()
+    excecoes = {
+        (row['modelo_id'], row['ocorrencia_min']): row
+        for row in conn.execute("SELECT * FROM excecoes_modelo WHERE ocorrencia_min >= ? AND ocorrencia_min < ?",
+                                (inicio_min, fim_min))
+    }
+    return modelos, excecoes
+
+def ocorrencias_modelos(inicio_min, fim_min):
+    """Ocorrências ainda não materializadas que começam (pela regra) em [inicio_min, fim_min).
+
+    Só as ocorrências do período são calculadas, sem tocar em escalas; as
+    anteriores ao horizonte já estão lá como escalas comuns.
+    """
+    with conectar() as conn:
+        modelos, excecoes = _modelos_e_excecoes(conn, inicio_min, fim_min)
+    return [escala for modelo in modelos
+            for escala in _expandir_modelo(modelo, max(inicio_min, modelo['materializado_ate']), fim_min, excecoes)]
+
+def materializar_modelos(ate_min):
+    """Cria as escalas das ocorrências que começam antes de ``ate_min``; devolve quantas.
+
+    Cada modelo guarda até onde já foi materializado, então uma ocorrência
+    apagada ou editada depois não é recriada.
+    """
+    inseridas = 0
+    colunas = COLUNAS_OCORRENCIA + ["modelo_id", "ocorrencia_min"]
+    with transacao_escrita() as conn:
+        desde = conn.execute("SELECT MIN(materializado_ate) FROM modelos_escala").fetchone()[0]
+        if desde is None:
+            return 0
+        modelos, excecoes = _modelos_e_excecoes(conn, desde, ate_min)
+        for modelo in modelos:
+            escalas = _expandir_modelo(modelo, modelo['materializado_ate'], ate_min, excecoes)
+            inseridas += conn.executemany(
+                f"INSERT OR IGNORE INTO escalas ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})",
+                [tuple(escala[coluna] for coluna in colunas) for escala in escalas]
+            ).rowcount
+            _derivar_historico(conn, [row[0] for row in conn.execute(
+                "SELECT id FROM escalas WHERE modelo_id = ? AND ocorrencia_min >= ? AND ocorrencia_min < ?",
+                (modelo['id'], modelo['materializado_ate'], ate_min)
+            )])
+            conn.execute("UPDATE modelos_escala SET materializado_ate = ? WHERE id = ?", (ate_min, modelo['id']))
+    return inseridas
+
+def _fim_horizonte():
+    return (para_minutos(datetime.now()) // MINUTOS_DIA + HORIZONTE_DIAS + 1) * MINUTOS_DIA
+
+def manter_horizonte():
+    """Materializa as ocorrências dos próximos HORIZONTE_DIAS, se faltar alguma.
+
+    Barato quando não há nada a fazer (uma consulta), então pode rodar a cada rerun.
+    """
+    alvo = _fim_horizonte()
     with conectar() as conn:
-        c = conn.cursor()
-        c.execute("SELECT data_inicio, data_fim, turno FROM escalas WHERE id=?", (id_escala,))
-        escala = c.fetchone()
-        if escala:
-            data_inicio, data_fim, turno = escala
-            c.execute("DELETE FROM escalas WHERE id=?", (id_escala,))
-            c.execute("DELETE FROM historico WHERE data_inicio=? AND data_fim=? AND turno=?", (data_inicio, data_fim, turno))
+        pendente = conn.execute(
+            "SELECT 1 FROM modelos_escala WHERE materializado_ate < ? AND (ate_min IS NULL OR materializado_ate < ate_min) LIMIT 1",
+            (alvo,)
+        ).fetchone()
+    return materializar_modelos(alvo) if pendente else 0
+
+def cadastrar_modelo_escala(data_inicio, data_fim, turno, vagas, plantonistas, viatura_id, coordenador_id,
+                            intervalo_dias=7, ate=None):
+    """Cadastra um plantão recorrente; ``data_inicio``/``data_fim`` são os da primeira ocorrência.
+
+    Repete a cada ``intervalo_dias``; com ``ate`` (data), a última ocorrência
+    começa nesse dia ou antes. As ocorrências do horizonte já viram escalas.
+    """
+    inicio_min, fim_min = para_minutos(data_inicio), para_minutos(data_fim)
+    if fim_min <= inicio_min:
+        raise ValueError("O fim do plantão deve ser depois do início.")
+    if intervalo_dias < 1:
+        raise ValueError("O intervalo deve ser de pelo menos um dia.")
+    ate_min = para_minutos(para_data(ate)) + MINUTOS_DIA if ate else None
+    with transacao_escrita() as conn:
+        id_modelo = conn.execute(
+            """
+            INSERT INTO modelos_escala (turno, vagas, plantonistas, viatura_id, coordenador_id,
+                                        inicio_min, duracao_min, intervalo_dias, ate_min, materializado_ate)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (turno, vagas, json.dumps(plantonistas, ensure_ascii=False), viatura_id, coordenador_id,
+             inicio_min, fim_min - inicio_min, intervalo_dias, ate_min, inicio_min)
+        ).lastrowid
+    manter_horizonte()
+    return id_modelo
+
+def listar_modelos_escala():
+    with conectar() as conn:
+        return pd.read_sql_query("""
+            SELECT id, turno, vagas, plantonistas,
+                   strftime('%Y-%m-%d %H:%M', inicio_min * 60, 'unixepoch') AS primeira,
+                   duracao_min / 60.0 AS horas, intervalo_dias,
+                   strftime('%Y-%m-%d', (ate_min - 1) * 60, 'unixepoch') AS ate,
+                   strftime('%Y-%m-%d', materializado_ate * 60, 'unixepoch') AS escalas_ate,
+                   versao
+            FROM modelos_escala ORDER BY id
+        """, conn)
+
+def apagar_modelo_escala(id_modelo):
+    """Apaga o modelo, suas exceções e as escalas dele que ainda não começaram."""
+    agora = para_minutos(datetime.now())
+    with transacao_escrita() as conn:
+        apagadas = conn.execute("DELETE FROM escalas WHERE modelo_id = ? AND inicio_min >= ? RETURNING id",
+                                (id_modelo, agora)).fetchall()
+        _derivar_historico(conn, [row[0] for row in apagadas])
+        conn.execute("DELETE FROM excecoes_modelo WHERE modelo_id = ?", (id_modelo,))
+        conn.execute("DELETE FROM modelos_escala WHERE id = ?", (id_modelo,))
+
+def salvar_excecao_modelo(id_modelo, dia, cancelada=False, data_inicio=None, data_fim=None, turno=None,
+                          vagas=None, plantonistas=None, viatura_id=None, coordenador_id=None):
+    """Cancela ou altera a ocorrência do modelo que começa em ``dia``; devolve o começo dela.
+
+    Substitui a exceção anterior da mesma ocorrência; campos None ficam com o
+    valor do modelo. Se a ocorrência já virou escala, a escala é apagada ou
+    regravada (ou recriada, se tinha sido cancelada) na mesma transação.
+    """
+    dia_min = para_minutos(para_data(dia))
+    excecao = {
+        "cancelada": int(bool(cancelada)),
+        "inicio_min": para_minutos(data_inicio) if data_inicio else None,
+        "fim_min": para_minutos(data_fim) if data_fim else None,
+        "turno": turno, "vagas": vagas,
+        "plantonistas": json.dumps(plantonistas, ensure_ascii=False) if plantonistas is not None else None,
+        "viatura_id": viatura_id, "coordenador_id": coordenador_id,
+    }
+    with transacao_escrita() as conn:
+        modelo = conn.execute("SELECT * FROM modelos_escala WHERE id = ?", (id_modelo,)).fetchone()
+        if modelo is None:
+            raise ValueError("Modelo de escala não encontrado.")
+        ocorrencia = next(iter(_inicios_ocorrencias(modelo, dia_min, dia_min + MINUTOS_DIA)), None)
+        if ocorrencia is None:
+            raise ValueError(f"O modelo não tem ocorrência em {para_data(dia)}.")
+        conn.execute(
+            f"""
+            INSERT INTO excecoes_modelo (modelo_id, ocorrencia_min, {', '.join(excecao)})
+            VALUES (?, ?, {', '.join('?' * len(excecao))})
+            ON CONFLICT(modelo_id, ocorrencia_min) DO UPDATE SET
+                {', '.join(f"{coluna} = excluded.{coluna}" for coluna in excecao)},
+                versao = versao + 1
+            """,
+            (id_modelo, ocorrencia, *excecao.values())
+        )
+        if ocorrencia < modelo['materializado_ate']:
+            if cancelada:
+                apagadas = conn.execute("DELETE FROM escalas WHERE modelo_id = ? AND ocorrencia_min = ? RETURNING id",
+                                        (id_modelo, ocorrencia)).fetchall()
+                _derivar_historico(conn, [row[0] for row in apagadas])
+            # Sem nada a gravar se cancelada
+            for escala in _expandir_modelo(modelo, ocorrencia, ocorrencia + 1, {(id_modelo, ocorrencia): excecao}):
+                colunas = COLUNAS_OCORRENCIA + ["modelo_id", "ocorrencia_min"]
+                id_escala = conn.execute(
+                    f"""
+                    INSERT INTO escalas ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})
+                    ON CONFLICT(modelo_id, ocorrencia_min) DO UPDATE SET
+                        {', '.join(f"{coluna} = excluded.{coluna}" for coluna in COLUNAS_OCORRENCIA)},
+                        versao = versao + 1
+                    RETURNING id
+                    """,
+                    tuple(escala[coluna] for coluna in colunas)
+                ).fetchone()
+                _derivar_historico(conn, [id_escala[0]])
+    return ocorrencia
+
+# --- Histórico derivado ---
+# Cada escala do banco principal tem exatamente uma linha no histórico
+# (historico.escala_id). Toda função que grava em escalas chama
+# _derivar_historico na mesma transação, que recalcula as horas em Python;
+# não há gatilho com função Python, então o banco continua gravável por
+# qualquer cliente SQLite (e reconciliar_historico acerta o que for editado
+# por fora). arquivar_ano e aplicar_delta movem ou recebem as duas tabelas prontas.
+COLUNAS_DERIVADAS = ["inicio_min", "fim_min", "turno", "plantonistas", "horas_normais", "horas_especiais"]
+
+def criar_historico_derivado(conn):
+    if "escala_id" not in [row['name'] for row in conn.execute("PRAGMA table_info(historico)")]:
+        conn.execute("ALTER TABLE historico ADD COLUMN escala_id INTEGER")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_historico_escala ON historico (escala_id)")
+    # Gatilhos da primeira versão, que dependiam de funções registradas no conectar()
+    for evento in ("insert", "update", "delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS historico_escalas_{evento}")
+    # Linhas sem escala_id: bancos anteriores à ligação (inclusive os
+    # recriados por migrar_datas_inteiras, que já nascem com a coluna)
+    if conn.execute("SELECT 1 FROM historico WHERE escala_id IS NULL LIMIT 1").fetchone():
+        _vincular_historico(conn)
+        _reconciliar_historico(conn, corrigir=True)
+        conn.commit()
+
+def _derivar_historico(conn, ids_escalas):
+    """Regrava a linha do histórico de cada escala de ``ids_escalas``, ou a
+    apaga se a escala não existe mais. Roda dentro da transação de quem gravou."""
+    ids = list(ids_escalas)
+    feriados = _ler_feriados(conn)
+    for i in range(0, len(ids), 500):
+        lote = ids[i:i + 500]
+        marcadores = ', '.join('?' * len(lote))
+        escalas = conn.execute(
+            f"SELECT id, inicio_min, fim_min, turno, plantonistas FROM escalas WHERE id IN ({marcadores})", lote
+        ).fetchall()
+        existentes = {row['id'] for row in escalas}
+        conn.executemany("DELETE FROM historico WHERE escala_id = ?", [(i,) for i in lote if i not in existentes])
+        conn.executemany(
+            f"""
+            INSERT INTO historico (escala_id, {', '.join(COLUNAS_DERIVADAS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(escala_id) DO UPDATE SET
+                {', '.join(f"{coluna} = excluded.{coluna}" for coluna in COLUNAS_DERIVADAS)}
+            """,
+            [(row['id'], row['inicio_min'], row['fim_min'], row['turno'], row['plantonistas'],
+              *horas_do_intervalo(row['inicio_min'], row['fim_min'], feriados)) for row in escalas]
+        )
+
+def _vincular_historico(conn):
+    """Liga cada linha do histórico sem escala_id a uma escala ainda sem
+    histórico com os mesmos dados, uma para uma."""
+    livres = {}
+    for row in conn.execute("""
+            SELECT id, inicio_min, fim_min, turno, plantonistas FROM escalas
+            WHERE id NOT IN (SELECT escala_id FROM historico WHERE escala_id IS NOT NULL)
+            ORDER BY id DESC"""):
+        livres.setdefault(tuple(row)[1:], []).append(row['id'])
+    pares = []
+    for row in conn.execute("SELECT id, inicio_min, fim_min, turno, plantonistas FROM historico WHERE escala_id IS NULL ORDER BY id"):
+        ids = livres.get(tuple(row)[1:])
+        if ids:
+            pares.append((ids.pop(), row['id']))
+    conn.executemany("UPDATE historico SET escala_id = ? WHERE id = ?", pares)
+
+def _reconciliar_historico(conn, corrigir):
+    escalas = pd.read_sql_query("SELECT id AS escala_id, inicio_min, fim_min, turno, plantonistas FROM escalas", conn)
+    historico = pd.read_sql_query(f"SELECT id, escala_id, {', '.join(COLUNAS_DERIVADAS)} FROM historico", conn)
+    escalas['horas_normais'], escalas['horas_especiais'] = horas_vetorizadas(
+        escalas['inicio_min'], escalas['fim_min'], _ler_feriados(conn)
+    )
+    # Uma coluna toda NULL vem como object; as duas chaves precisam do mesmo tipo
+    escalas['escala_id'] = escalas['escala_id'].astype("Int64")
+    historico['escala_id'] = historico['escala_id'].astype("Int64")
+    juntos = escalas.merge(historico, on='escala_id', how='outer', suffixes=('', '_atual'), indicator=True)
+    # O outer join deixa em float as colunas inteiras com lacunas
+    for coluna in ("id", "escala_id", "inicio_min", "fim_min", "inicio_min_atual", "fim_min_atual"):
+        juntos[coluna] = juntos[coluna].astype("Int64")
+
+    faltando = juntos[juntos['_merge'] == 'left_only']
+    orfas = juntos[juntos['_merge'] == 'right_only']
+    ambos = juntos[juntos['_merge'] == 'both']
+    difere = pd.Series(False, index=ambos.index)
+    for coluna in ("inicio_min", "fim_min", "turno", "plantonistas"):
+        difere |= ambos[coluna] != ambos[f"{coluna}_atual"]
+    for coluna in ("horas_normais", "horas_especiais"):
+        difere |= ~np.isclose(ambos[coluna].astype(float), ambos[f"{coluna}_atual"].astype(float))
+    divergentes = ambos[difere]
+
+    if corrigir:
+        def valores(df, colunas):
+            return list(zip(*(df[coluna].astype(object).tolist() for coluna in colunas)))
+        conn.executemany("DELETE FROM historico WHERE id = ?", valores(orfas, ["id"]))
+        conn.executemany(
+            f"UPDATE historico SET {', '.join(f'{coluna} = ?' for coluna in COLUNAS_DERIVADAS)} WHERE id = ?",
+            valores(divergentes, COLUNAS_DERIVADAS + ["id"])
+        )
+        conn.executemany(
+            f"INSERT INTO historico (escala_id, {', '.join(COLUNAS_DERIVADAS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            valores(faltando, ["escala_id"] + COLUNAS_DERIVADAS)
+        )
+    return {"faltando": len(faltando), "orfas": len(orfas), "divergentes": len(divergentes)}
+
+def reconciliar_historico(corrigir=True):
+    """Confere o histórico do banco principal contra as escalas e as regras de horas.
+
+    Conta as escalas sem linha no histórico (faltando), as linhas sem escala
+    (orfas) e as que diferem da escala ou das horas calculadas (divergentes).
+    Com ``corrigir``, acerta tudo numa transação, em lote. As funções de
+    escrita já mantêm o histórico em dia; isto cobre bancos editados por fora
+    do app ou mudanças nas regras de horas.
+    """
+    with transacao_escrita() as conn:
+        resultado = _reconciliar_historico(conn, corrigir)
+    return resultado
 
 # --- Viaturas ---
 def listar_viaturas():
@@ -126,63 +860,744 @@ def listar_viaturas():
         return pd.read_sql_query("SELECT * FROM viaturas", conn)
 
 def cadastrar_viatura(placa, modelo):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("INSERT INTO viaturas (placa, modelo) VALUES (?, ?)", (placa, modelo))
 
 def apagar_viatura(id_viatura):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("DELETE FROM viaturas WHERE id=?", (id_viatura,))
 
+def atualizar_viatura(id_viatura, placa, modelo, versao):
+    return _atualizar_com_versao("viaturas", id_viatura, versao, {"placa": placa, "modelo": modelo})
+
 # --- Coordenadores ---
 def listar_coordenadores():
     with conectar() as conn:
         return pd.read_sql_query("SELECT * FROM coordenadores", conn)
 
 def cadastrar_coordenador(nome, matricula, contato):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("INSERT INTO coordenadores (nome, matricula, contato) VALUES (?, ?, ?)", (nome, matricula, contato))
 
 def apagar_coordenador(id_coordenador):
-    with conectar() as conn:
+    with transacao_escrita() as conn:
         conn.execute("DELETE FROM coordenadores WHERE id=?", (id_coordenador,))
 
-# --- Histórico ---
-def gerar_historico_excel_por_equipe():
+def atualizar_coordenador(id_coordenador, nome, matricula, contato, versao):
+    return _atualizar_com_versao("coordenadores", id_coordenador, versao,
+                                 {"nome": nome, "matricula": matricula, "contato": contato})
+
+# --- Feriados ---
+# Feriados e datas especiais contam o dia inteiro como hora especial, como o
+# fim de semana. O cálculo de horas consulta um conjunto em memória com os dias
+# (desde 1970) de cada banco, recarregado só quando a versão da tabela muda.
+_cache_feriados = {}
+_lock_cache_feriados = threading.Lock()
+
+def criar_tabela_feriados(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS feriados (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data TEXT NOT NULL UNIQUE,
+            descricao TEXT
+        )
+    """)
+    criar_triggers_versao(conn, "feriados")
+
+def _ler_feriados(conn):
+    return frozenset(para_minutos(row[0]) // MINUTOS_DIA for row in conn.execute("SELECT data FROM feriados"))
+
+def _feriados_do_banco(caminho, versao):
+    with _lock_cache_feriados:
+        guardado = _cache_feriados.get(caminho)
+        if guardado and guardado[0] == versao:
+            return guardado[1]
+    conn = sqlite3.connect(caminho)
+    try:
+        dias = _ler_feriados(conn)
+    finally:
+        conn.close()
+    with _lock_cache_feriados:
+        _cache_feriados[caminho] = (versao, dias)
+    return dias
+
+def dias_feriados():
+    """frozenset com o dia (minutos // MINUTOS_DIA) de cada feriado do banco atual."""
+    return _feriados_do_banco(caminho_banco(), versao_tabela("feriados"))
+
+def listar_feriados():
     with conectar() as conn:
-        df = pd.read_sql_query("SELECT * FROM escalas", conn)
-    df['equipe'] = df['plantonistas'].apply(safe_json_loads)
-    df[['data_inicio', 'data_fim', 'turno', 'vagas', 'equipe']].to_excel("relatorios/historico_por_equipe.xlsx", index=False)
+        return pd.read_sql_query("SELECT * FROM feriados ORDER BY data", conn)
+
+def cadastrar_feriado(data, descricao):
+    """Cadastra (ou renomeia) o feriado de ``data`` e recalcula as horas daquele dia."""
+    data = para_data(data)
+    with transacao_escrita() as conn:
+        conn.execute(
+            "INSERT INTO feriados (data, descricao) VALUES (?, ?) ON CONFLICT(data) DO UPDATE SET descricao = excluded.descricao",
+            (data, descricao)
+        )
+    return recalcular_horas_dias([para_minutos(data) // MINUTOS_DIA])
+
+def apagar_feriado(id_feriado):
+    with transacao_escrita() as conn:
+        row = conn.execute("DELETE FROM feriados WHERE id=? RETURNING data", (id_feriado,)).fetchone()
+    return recalcular_horas_dias([para_minutos(row['data']) // MINUTOS_DIA]) if row else 0
 
-def gerar_historico_pdf_por_equipe():
-    from fpdf import FPDF
+def criar_tabela_recalculo(conn):
+    # Ponto de retomada de recalcular_horas_historico: o último id gravado
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recalculo_horas (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ultimo_id INTEGER NOT NULL,
+            alteradas INTEGER NOT NULL,
+            iniciado_em TEXT NOT NULL
+        )
+    """)
+
+def recalcular_horas_historico(tamanho_lote=5000, reiniciar=False, progresso=None):
+    """Recalcula as horas de todo o histórico do banco principal, em lotes por id.
+
+    Para quando as regras de horas mudam. Cada lote é lido em ordem de id,
+    calculado de uma vez com horas_vetorizadas e gravado com executemany na
+    mesma transação que avança o ponto de retomada, então uma execução
+    interrompida continua do último lote gravado (``reiniciar`` começa do
+    zero). Uma linha editada entre a leitura e a gravação do lote não é
+    sobrescrita. Devolve {'lidas', 'alteradas', 'retomado_de'}.
+    """
+    feriados = dias_feriados()
+    with transacao_escrita() as conn:
+        criar_tabela_recalculo(conn)
+        if reiniciar:
+            conn.execute("DELETE FROM recalculo_horas")
+        ponto = conn.execute("SELECT ultimo_id, alteradas FROM recalculo_horas").fetchone()
+        if not ponto:
+            conn.execute("INSERT INTO recalculo_horas (id, ultimo_id, alteradas, iniciado_em) VALUES (1, 0, 0, ?)",
+                         (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    retomado_de, alteradas = (ponto['ultimo_id'], ponto['alteradas']) if ponto else (0, 0)
+    with conectar() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM historico WHERE id > ?", (retomado_de,)).fetchone()[0]
+
+    ultimo_id, lidas = retomado_de, 0
+    while True:
+        with conectar() as conn:
+            lote = pd.read_sql_query(
+                "SELECT id, inicio_min, fim_min, horas_normais, horas_especiais FROM historico WHERE id > ? ORDER BY id LIMIT ?",
+                conn, params=(ultimo_id, tamanho_lote)
+            )
+        if lote.empty:
+            break
+        normais, especiais = horas_vetorizadas(lote['inicio_min'], lote['fim_min'], feriados)
+        mudou = ~(np.isclose(normais, lote['horas_normais']) & np.isclose(especiais, lote['horas_especiais']))
+        novas = lote.assign(horas_normais=normais, horas_especiais=especiais)[mudou]
+        ultimo_id = int(lote['id'].iloc[-1])
+        with transacao_escrita() as conn:
+            cursor = conn.executemany(
+                "UPDATE historico SET horas_normais = ?, horas_especiais = ? WHERE id = ? AND inicio_min = ? AND fim_min = ?",
+                zip(*(novas[coluna].tolist() for coluna in ('horas_normais', 'horas_especiais', 'id', 'inicio_min', 'fim_min')))
+            )
+            alteradas += max(cursor.rowcount, 0)
+            conn.execute("UPDATE recalculo_horas SET ultimo_id = ?, alteradas = ?", (ultimo_id, alteradas))
+        lidas += len(lote)
+        if progresso:
+            progresso(lidas, total)
+
+    with transacao_escrita() as conn:
+        conn.execute("DELETE FROM recalculo_horas")
+    return {'lidas': lidas, 'alteradas': alteradas, 'retomado_de': retomado_de}
+
+def recalcular_horas_dias(dias, tamanho_lote=500):
+    """Recalcula horas_normais/horas_especiais do histórico que toca algum dos ``dias``.
+
+    Só lê as linhas que começam perto desses dias (pelo índice de inicio_min)
+    e grava as que mudaram em lotes de ``tamanho_lote``, cada um na sua
+    transação curta, sem segurar as outras escritas. Os anos arquivados não
+    são alterados. Devolve quantas linhas mudaram.
+    """
+    dias = set(dias)
+    if not dias:
+        return 0
+    feriados = dias_feriados()
+    limite_inferior, limite_superior = min(dias) * MINUTOS_DIA, (max(dias) + 1) * MINUTOS_DIA
+    with conectar() as conn:
+        duracao_maxima = conn.execute("SELECT COALESCE(MAX(fim_min - inicio_min), 0) FROM historico").fetchone()[0]
+        linhas = conn.execute(
+            """
+            SELECT id, inicio_min, fim_min, horas_normais, horas_especiais FROM historico
+            WHERE inicio_min >= ? AND inicio_min < ? AND fim_min > ?
+            """,
+            (limite_inferior - duracao_maxima, limite_superior, limite_inferior)
+        ).fetchall()
+    alteradas = []
+    for linha in linhas:
+        inicio_min, fim_min = linha['inicio_min'], linha['fim_min']
+        if dias.isdisjoint(range(inicio_min // MINUTOS_DIA, (fim_min - 1) // MINUTOS_DIA + 1)):
+            continue
+        horas = horas_do_intervalo(inicio_min, fim_min, feriados)
+        if horas != (linha['horas_normais'], linha['horas_especiais']):
+            alteradas.append((*horas, linha['id'], inicio_min, fim_min))
+    gravadas = 0
+    for i in range(0, len(alteradas), tamanho_lote):
+        # Só grava se o horário ainda é o que foi lido: uma escala editada
+        # no meio do caminho já teve as horas recalculadas por _derivar_historico
+        with transacao_escrita() as conn:
+            gravadas += conn.executemany(
+                "UPDATE historico SET horas_normais = ?, horas_especiais = ? WHERE id = ? AND inicio_min = ? AND fim_min = ?",
+                alteradas[i:i + tamanho_lote]
+            ).rowcount
+    return gravadas
+
+# --- Arquivo anual ---
+# Anos encerrados saem do escala.db para arquivo/escala_<ano>.db. As consultas
+# por período anexam (ATTACH) só os arquivos dos anos que o período alcança,
+# então o dia a dia lê apenas os dados quentes.
+LIMITE_ANEXOS = 9  # o SQLite aceita no máximo 10 bancos anexados por conexão
+
+def caminho_arquivo(ano):
+    return os.path.join(os.path.dirname(caminho_banco()), "arquivo", f"escala_{ano}.db")
+
+def anos_arquivados():
+    pasta = os.path.dirname(caminho_arquivo(0))
+    if not os.path.isdir(pasta):
+        return []
+    return sorted(int(m.group(1)) for m in (re.fullmatch(r"escala_(\d+)\.db", nome) for nome in os.listdir(pasta)) if m)
+
+def _limites_ano(ano):
+    return para_minutos(datetime(ano, 1, 1)), para_minutos(datetime(ano + 1, 1, 1))
+
+def arquivar_ano(ano):
+    """Move escalas e histórico que começam em ``ano`` para o arquivo anual.
+
+    Pode ser executado de novo para o mesmo ano (linhas já arquivadas são
+    substituídas). Devolve quantas linhas saíram de cada tabela.
+    """
+    if ano >= datetime.now().year:
+        raise ValueError("Só é possível arquivar anos já encerrados.")
+    inicio, fim = _limites_ano(ano)
+    caminho = caminho_arquivo(ano)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    with sqlite3.connect(caminho) as arquivo:
+        arquivo.executescript(f"""
+            CREATE TABLE IF NOT EXISTS escalas ({DDL_ESCALAS});
+            CREATE TABLE IF NOT EXISTS historico ({DDL_HISTORICO});
+            CREATE INDEX IF NOT EXISTS idx_escalas_inicio ON escalas (inicio_min);
+            CREATE INDEX IF NOT EXISTS idx_historico_inicio ON historico (inicio_min);
+        """)
+        for tabela, posteriores in COLUNAS_POSTERIORES.items():
+            existentes = {row[1] for row in arquivo.execute(f"PRAGMA table_info({tabela})")}
+            for coluna, tipo in posteriores.items():
+                if coluna not in existentes:
+                    arquivo.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
+    arquivo.close()
+
+    conn = conectar()
+    try:
+        conn.execute("ATTACH DATABASE ? AS arquivo", (caminho,))
+        movidas = {}
+        with conn:
+            # Linhas arquivadas continuam contando no saldo de horas
+            conn.execute("INSERT OR IGNORE INTO arquivamento_em_curso (ano) VALUES (?)", (ano,))
+            for tabela, colunas in COLUNAS_ARQUIVO.items():
+                conn.execute(
+                    f"INSERT OR REPLACE INTO arquivo.{tabela} ({colunas}) "
+                    f"SELECT {colunas} FROM main.{tabela} WHERE inicio_min >= ? AND inicio_min < ?",
+                    (inicio, fim)
+                )
+                movidas[tabela] = conn.execute(
+                    f"DELETE FROM main.{tabela} WHERE inicio_min >= ? AND inicio_min < ?", (inicio, fim)
+                ).rowcount
+            conn.execute("DELETE FROM arquivamento_em_curso WHERE ano = ?", (ano,))
+        conn.execute("DETACH DATABASE arquivo")
+    finally:
+        conn.close()
+    return movidas
+
+def _selecao_uniao(conn, esquema, tabela):
+    """COLUNAS_UNIAO de ``tabela`` em ``esquema``, com NULL nas colunas que ele não tem."""
+    existentes = {row['name'] for row in conn.execute(f"PRAGMA {esquema}.table_xinfo({tabela})")}
+    return ", ".join(coluna if coluna in existentes else f"NULL AS {coluna}"
+                     for coluna in COLUNAS_UNIAO[tabela].split(", "))
+
+def iterar_periodo(tabela, colunas="*", inicio_min=None, fim_min=None, condicao=None, params=(),
+                   ordem="inicio_min, id", tamanho_lote=5000, juncao="", agrupar=None):
+    """Percorre em lotes as linhas de ``tabela`` que começam em [inicio_min, fim_min).
+
+    Sem limites, inclui todo o histórico. Arquivos anuais fora do período não
+    são abertos. ``condicao``/``params`` acrescentam um filtro SQL extra, e a
+    tabela pode ser referenciada como ``t`` em ``juncao`` e ``agrupar``. Com
+    ``agrupar``, cada grupo de arquivos anexados devolve agregados parciais.
+    """
+    anos = [
+        ano for ano in anos_arquivados()
+        if (inicio_min is None or _limites_ano(ano)[1] > inicio_min)
+        and (fim_min is None or _limites_ano(ano)[0] < fim_min)
+    ]
+    filtros, valores = [], []
+    if inicio_min is not None:
+        filtros.append("inicio_min >= ?")
+        valores.append(inicio_min)
+    if fim_min is not None:
+        filtros.append("inicio_min < ?")
+        valores.append(fim_min)
+    if condicao:
+        filtros.append(f"({condicao})")
+        valores.extend(params)
+    where = f"WHERE {' AND '.join(filtros)}" if filtros else ""
+    if agrupar:
+        where += f" GROUP BY {agrupar}"
+
+    # Grupos de até LIMITE_ANEXOS arquivos, em ordem de ano; o banco principal
+    # entra no último grupo
+    grupos = [anos[i:i + LIMITE_ANEXOS] for i in range(0, len(anos), LIMITE_ANEXOS)] or [[]]
     with conectar() as conn:
-        df = pd.read_sql_query("SELECT * FROM escalas", conn)
-    pdf = FPDF()
+        for i, grupo in enumerate(grupos):
+            esquemas = [f"arquivo_{ano}" for ano in grupo]
+            for ano, esquema in zip(grupo, esquemas):
+                conn.execute(f"ATTACH DATABASE ? AS {esquema}", (caminho_arquivo(ano),))
+            fontes = esquemas + (["main"] if i == len(grupos) - 1 else [])
+            uniao = " UNION ALL ".join(f"SELECT {_selecao_uniao(conn, esquema, tabela)} FROM {esquema}.{tabela}"
+                                       for esquema in fontes)
+            ordenacao = f"ORDER BY {ordem}" if ordem else ""
+            cursor = conn.execute(f"SELECT {colunas} FROM ({uniao}) AS t {juncao} {where} {ordenacao}", valores)
+            while True:
+                lote = cursor.fetchmany(tamanho_lote)
+                if not lote:
+                    break
+                yield lote
+            cursor.close()
+            for esquema in esquemas:
+                conn.execute(f"DETACH DATABASE {esquema}")
+
+def consultar_periodo(tabela, colunas="*", inicio_min=None, fim_min=None, condicao=None, params=(), ordem="inicio_min, id"):
+    """Como iterar_periodo, mas devolve um DataFrame."""
+    linhas = [linha for lote in iterar_periodo(tabela, colunas, inicio_min, fim_min, condicao, params, ordem) for linha in lote]
+    with conectar() as conn:
+        nomes = [d[0] for d in conn.execute(f"SELECT {colunas} FROM (SELECT {COLUNAS_UNIAO[tabela]} FROM {tabela}) LIMIT 0").description]
+    return pd.DataFrame.from_records([tuple(linha) for linha in linhas], columns=nomes)
+
+COLUNAS_CATEGORICAS = ("turno", "placa", "nome")
+
+def periodo_compacto(tabela, colunas, inicio_min=None, fim_min=None, condicao=None, params=()):
+    """Como consultar_periodo, mas em formato compacto e com a equipe à parte.
+
+    Devolve (registros, membros). ``registros`` tem as ``colunas`` pedidas
+    (que devem incluir inicio_min e fim_min), turno/placa como categoria e
+    ``inicio``/``fim`` em datetime64. ``membros`` tem uma linha por
+    plantonista de cada registro: ``linha`` (posição em registros, int32) e
+    ``plantonista`` (categoria: códigos inteiros, cada nome guardado uma vez),
+    no lugar de uma coluna de listas Python.
+    """
+    registros = consultar_periodo(tabela, f"{colunas}, plantonistas", inicio_min, fim_min, condicao, params)
+    listas = [safe_list_load(p) for p in registros.pop("plantonistas")]
+    for coluna in COLUNAS_CATEGORICAS:
+        if coluna in registros:
+            registros[coluna] = registros[coluna].astype("category")
+    registros["inicio"] = pd.to_datetime(registros["inicio_min"], unit="m")
+    registros["fim"] = pd.to_datetime(registros["fim_min"], unit="m")
+
+    tamanhos = np.fromiter(map(len, listas), dtype=np.int64, count=len(listas))
+    membros = pd.DataFrame({
+        "linha": np.repeat(np.arange(len(listas), dtype=np.int32), tamanhos),
+        "plantonista": pd.Categorical([str(nome) for nome in chain.from_iterable(listas)]),
+    })
+    return registros, membros
+
+# Gráficos: no máximo MAX_BARRAS barras, com o menor intervalo que couber.
+# (frequência do groupby, frequência de period_range para contar, nome)
+MAX_BARRAS = 120
+INTERVALOS_GRAFICO = (("D", "D", "dia"), ("W-MON", "W-SUN", "semana"), ("MS", "M", "mês"), ("YS", "Y", "ano"))
+
+def horas_por_intervalo(df, inicio, fim, max_barras=MAX_BARRAS):
+    """Soma horas_normais/horas_especiais de ``df`` (com coluna ``inicio``) por dia,
+    semana, mês ou ano: o menor intervalo que dê até ``max_barras`` barras em [inicio, fim].
+
+    Devolve (frame indexado pelo começo de cada intervalo, nome do intervalo).
+    Entre o primeiro e o último registro, intervalos vazios aparecem com zero.
+    """
+    freq, nome = next(((freq, nome) for freq, periodo, nome in INTERVALOS_GRAFICO
+                       if len(pd.period_range(inicio, fim, freq=periodo)) <= max_barras),
+                      (INTERVALOS_GRAFICO[-1][0], INTERVALOS_GRAFICO[-1][2]))
+    somas = df.groupby(pd.Grouper(key="inicio", freq=freq, closed="left", label="left"))[
+        ["horas_normais", "horas_especiais"]].sum()
+    return somas, nome
+
+# --- Histórico ---
+def gerar_historico_excel_por_equipe(caminho=None):
+    caminho = caminho or os.path.join(pasta_relatorios(), "historico_por_equipe.xlsx")
+    df = consultar_periodo("escalas")
+    df['equipe'] = df['plantonistas'].apply(safe_json_loads)
+    df[['data_inicio', 'data_fim', 'turno', 'vagas', 'equipe']].to_excel(caminho, index=False)
+    return caminho
+
+def exportar_escalas_csv(data_inicio, data_fim, tamanho_lote=5000):
+    """Gera o CSV das escalas do período em blocos de bytes.
+
+    As linhas vêm de iterar_periodo em lotes, sem montar o DataFrame inteiro,
+    e incluem os arquivos anuais se o período alcançá-los. Quem chama decide se junta os blocos ou os grava direto em arquivo.
+    """
+    fim_exclusivo = para_minutos(data_fim) + MINUTOS_DIA
+    lotes = iterar_periodo(
+        "escalas", "id, inicio_min, fim_min, turno, vagas, plantonistas",
+        para_minutos(data_inicio), fim_exclusivo, condicao="fim_min < ?", params=(fim_exclusivo,),
+        tamanho_lote=tamanho_lote
+    )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['id', 'Início', 'Fim', 'turno', 'vagas', 'equipe'])
+    for lote in lotes:
+        for id_escala, inicio, fim, turno, vagas, plantonistas in lote:
+            writer.writerow([
+                id_escala,
+                de_minutos(inicio).strftime('%d/%m/%Y %H:%M'),
+                de_minutos(fim).strftime('%d/%m/%Y %H:%M'),
+                turno, vagas, safe_json_loads(plantonistas)
+            ])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+# Colunas da tabela do PDF de histórico: (título, largura em mm, alinhamento)
+COLUNAS_HISTORICO_PDF = [
+    ("Início", 28, 'C'),
+    ("Fim", 28, 'C'),
+    ("Turno", 24, 'C'),
+    ("Vagas", 12, 'C'),
+    ("Equipe", 82, 'L'),
+    ("Horas", 16, 'R'),
+]
+
+class _BufferPDF:
+    # Substitui a string usada pelo FPDF como buffer: concatenar com += um
+    # documento de vários MB a cada objeto torna o fechamento quadrático.
+    def __init__(self):
+        self.partes = []
+        self.tamanho = 0
+
+    def __iadd__(self, texto):
+        self.partes.append(texto)
+        self.tamanho += len(texto)
+        return self
+
+    def __len__(self):
+        return self.tamanho
+
+    def __str__(self):
+        return ''.join(self.partes)
+
+
+class PDFGrande(FPDF):
+    """FPDF com buffer em partes, para relatórios com milhares de páginas."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = _BufferPDF()
+
+    def output(self, name='', dest=''):
+        if self.state < 3:
+            self.close()
+        conteudo = str(self.buffer).encode('latin-1')
+        if dest.upper() == 'S' or not name:
+            return conteudo
+        with open(name, 'wb') as f:
+            f.write(conteudo)
+        return ''
+
+def _texto_pdf(texto):
+    # A fonte padrão do FPDF só aceita latin-1
+    return str(texto).encode('latin-1', 'replace').decode('latin-1')
+
+def _cabecalho_tabela_historico(pdf):
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 8, txt=_texto_pdf("Histórico de Escalas por Equipe"), ln=True, align='C')
+    pdf.set_font("Arial", 'B', 8)
+    pdf.set_fill_color(220, 220, 220)
+    for titulo, largura, _ in COLUNAS_HISTORICO_PDF:
+        pdf.cell(largura, 6, _texto_pdf(titulo), border=1, align='C', fill=1)
+    pdf.ln()
+    pdf.set_font("Arial", size=8)
+
+def _subtotal_tabela_historico(pdf, rotulo, horas):
+    largura_rotulo = sum(largura for _, largura, _ in COLUNAS_HISTORICO_PDF[:-1])
+    pdf.set_font("Arial", 'B', 8)
+    pdf.cell(largura_rotulo, 6, _texto_pdf(rotulo), border=1, align='R')
+    pdf.cell(COLUNAS_HISTORICO_PDF[-1][1], 6, f"{horas:.2f}", border=1, align='R')
+    pdf.ln()
+    pdf.set_font("Arial", size=8)
+
+def gerar_historico_pdf_por_equipe(tamanho_lote=1000, caminho=None, progresso=None):
+    """Gera relatorios/historico_por_equipe.pdf como tabela paginada.
+
+    As escalas, inclusive as dos arquivos anuais, são lidas em lotes de
+    ``tamanho_lote`` linhas, então a memória usada não depende do tamanho da
+    tabela. Cada página repete o
+    cabeçalho e termina com o subtotal de horas das escalas nela listadas.
+    ``progresso(feitos, total)`` é chamado a cada lote.
+    """
+    caminho = caminho or os.path.join(pasta_relatorios(), "historico_por_equipe.pdf")
+    altura_linha = 4
+    pdf = PDFGrande()
+    pdf.set_auto_page_break(False)
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt="Histórico de Escalas por Equipe", ln=True, align='C')
-    for _, row in df.iterrows():
-        equipe = safe_json_loads(row['plantonistas'])
-        pdf.cell(0, 10, f"{row['data_inicio']} - {row['data_fim']} | {row['turno']} | Vagas: {row['vagas']} | {equipe}", ln=True)
-    os.makedirs("relatorios", exist_ok=True)
-    pdf.output("relatorios/historico_por_equipe.pdf")
+    _cabecalho_tabela_historico(pdf)
+    # Espaço reservado no pé da página para a linha de subtotal
+    limite_pagina = pdf.h - pdf.b_margin - 6 - 6
+
+    horas_pagina = horas_total = 0.0
+    pagina = 1
+    feitos = 0
+    total = sum(linha[0] for lote in iterar_periodo("escalas", "COUNT(*)", ordem=None) for linha in lote)
+    lotes = iterar_periodo(
+        "escalas", "data_inicio, data_fim, turno, vagas, plantonistas, (fim_min - inicio_min) / 60.0",
+        tamanho_lote=tamanho_lote
+    )
+    for lote in lotes:
+        for data_inicio, data_fim, turno, vagas, plantonistas, horas in lote:
+            valores = [data_inicio, data_fim, turno, vagas, safe_json_loads(plantonistas), f"{horas:.2f}"]
+            linhas_equipe = pdf.multi_cell(COLUNAS_HISTORICO_PDF[4][1], altura_linha, _texto_pdf(valores[4]), split_only=True) or ['']
+            altura = altura_linha * len(linhas_equipe)
+
+            if pdf.get_y() + altura > limite_pagina:
+                _subtotal_tabela_historico(pdf, f"Subtotal da página {pagina}", horas_pagina)
+                pdf.add_page()
+                pagina += 1
+                horas_pagina = 0.0
+                _cabecalho_tabela_historico(pdf)
+
+            x, y = pdf.get_x(), pdf.get_y()
+            for indice, ((_, largura, alinhamento), valor) in enumerate(zip(COLUNAS_HISTORICO_PDF, valores)):
+                if indice == 4 and len(linhas_equipe) > 1:
+                    pdf.rect(x, y, largura, altura)
+                    for i, linha in enumerate(linhas_equipe):
+                        pdf.set_xy(x, y + i * altura_linha)
+                        pdf.cell(largura, altura_linha, linha, align=alinhamento)
+                    pdf.set_xy(x + largura, y)
+                else:
+                    pdf.cell(largura, altura, _texto_pdf(valor), border=1, align=alinhamento)
+                x += largura
+            pdf.set_xy(pdf.l_margin, y + altura)
+
+            horas_pagina += horas
+            horas_total += horas
+        feitos += len(lote)
+        if progresso:
+            progresso(feitos, total)
+
+    _subtotal_tabela_historico(pdf, f"Subtotal da página {pagina}", horas_pagina)
+    _subtotal_tabela_historico(pdf, "Total geral", horas_total)
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    pdf.output(caminho)
+    return caminho
+
+# --- Fechamento mensal ---
+# Extrato de horas de todos os plantonistas do mês, numa única leitura do
+# histórico: a equipe de cada linha é expandida com json_each no próprio SQL.
+COLUNAS_FECHAMENTO_PDF = [
+    ("Início", 32, 'C'),
+    ("Fim", 32, 'C'),
+    ("Turno", 50, 'C'),
+    ("Normais", 28, 'R'),
+    ("Especiais", 28, 'R'),
+]
+
+def _limites_mes(mes):
+    inicio = datetime.strptime(mes, '%Y-%m')
+    fim = (inicio + timedelta(days=32)).replace(day=1)
+    return para_minutos(inicio), para_minutos(fim)
+
+def plantoes_do_mes(mes):
+    """Plantões de cada plantonista no mês 'AAAA-MM', agrupados por nome.
+
+    Devolve {nome: [(inicio_min, fim_min, turno, horas_normais, horas_especiais), ...]}
+    em ordem de início. Inclui o arquivo anual se o mês já foi arquivado.
+    """
+    inicio, fim = _limites_mes(mes)
+    plantoes = {}
+    lotes = iterar_periodo(
+        "historico",
+        "j.value, t.inicio_min, t.fim_min, t.turno, COALESCE(t.horas_normais, 0), COALESCE(t.horas_especiais, 0)",
+        inicio, fim,
+        juncao=f"JOIN {_EQUIPE_SQL.format(linha='t')} AS j", ordem="t.inicio_min, t.id"
+    )
+    for lote in lotes:
+        for nome, *plantao in lote:
+            plantoes.setdefault(nome, []).append(tuple(plantao))
+    return plantoes
+
+def _resumo_fechamento(plantoes):
+    resumo = pd.DataFrame(
+        [(nome, sum(p[3] for p in lista), sum(p[4] for p in lista), len(lista)) for nome, lista in plantoes.items()],
+        columns=["plantonista", "horas_normais", "horas_especiais", "plantoes"]
+    )
+    resumo["horas_totais"] = resumo["horas_normais"] + resumo["horas_especiais"]
+    return resumo.sort_values("plantonista").reset_index(drop=True)
+
+def _tabela_plantoes(lista):
+    return pd.DataFrame(
+        [(de_minutos(i).strftime('%d/%m/%Y %H:%M'), de_minutos(f).strftime('%d/%m/%Y %H:%M'), turno, normais, especiais)
+         for i, f, turno, normais, especiais in lista],
+        columns=["inicio", "fim", "turno", "horas_normais", "horas_especiais"]
+    )
+
+def _csv_plantonista(lista):
+    return _tabela_plantoes(lista).to_csv(index=False).encode('utf-8')
+
+def _pdf_plantonista(mes, nome, lista):
+    pdf = PDFGrande()
+    pdf.add_page()
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 8, txt=_texto_pdf(f"Fechamento de {mes[5:]}/{mes[:4]} - {nome}"), ln=True, align='C')
+    pdf.set_font("Arial", 'B', 9)
+    pdf.set_fill_color(220, 220, 220)
+    for titulo, largura, _ in COLUNAS_FECHAMENTO_PDF:
+        pdf.cell(largura, 6, _texto_pdf(titulo), border=1, align='C', fill=1)
+    pdf.ln()
+    pdf.set_font("Arial", size=9)
+    for inicio, fim, turno, normais, especiais in lista:
+        valores = [de_minutos(inicio).strftime('%d/%m/%Y %H:%M'), de_minutos(fim).strftime('%d/%m/%Y %H:%M'),
+                   turno, f"{normais:.2f}", f"{especiais:.2f}"]
+        for (_, largura, alinhamento), valor in zip(COLUNAS_FECHAMENTO_PDF, valores):
+            pdf.cell(largura, 6, _texto_pdf(valor), border=1, align=alinhamento)
+        pdf.ln()
+    pdf.set_font("Arial", 'B', 9)
+    largura_rotulo = sum(largura for _, largura, _ in COLUNAS_FECHAMENTO_PDF[:3])
+    pdf.cell(largura_rotulo, 6, _texto_pdf(f"Total ({len(lista)} plantões)"), border=1, align='R')
+    pdf.cell(COLUNAS_FECHAMENTO_PDF[3][1], 6, f"{sum(p[3] for p in lista):.2f}", border=1, align='R')
+    pdf.cell(COLUNAS_FECHAMENTO_PDF[4][1], 6, f"{sum(p[4] for p in lista):.2f}", border=1, align='R')
+    return pdf.output(dest='S')
+
+def _nome_arquivo(nome, usados):
+    base = re.sub(r'[^a-z0-9]+', '_', normalizar_texto(nome)).strip('_') or 'plantonista'
+    nome_final, n = base, 2
+    while nome_final in usados:
+        nome_final, n = f"{base}_{n}", n + 1
+    usados.add(nome_final)
+    return nome_final
+
+def gerar_fechamento_mensal(mes, pasta_saida=None, individuais=False, progresso=None):
+    """Fechamento do mês 'AAAA-MM': um XLSX com o resumo e a lista de plantões de todos.
+
+    Com ``individuais``, devolve um ZIP com o XLSX e um CSV e um PDF por
+    plantonista, gerados em paralelo; senão devolve o caminho do XLSX.
+    """
+    pasta_saida = pasta_saida or pasta_relatorios()
+    os.makedirs(pasta_saida, exist_ok=True)
+    plantoes = plantoes_do_mes(mes)
+    if not plantoes:
+        raise ValueError(f"Nenhum plantão registrado em {mes}.")
+
+    caminho_xlsx = os.path.join(pasta_saida, f"fechamento_{mes}.xlsx")
+    detalhes = pd.concat(
+        [_tabela_plantoes(lista).assign(plantonista=nome) for nome, lista in sorted(plantoes.items())],
+        ignore_index=True
+    )
+    with pd.ExcelWriter(caminho_xlsx) as excel:
+        _resumo_fechamento(plantoes).to_excel(excel, sheet_name="Resumo", index=False)
+        detalhes[["plantonista", "inicio", "fim", "turno", "horas_normais", "horas_especiais"]].to_excel(
+            excel, sheet_name="Plantões", index=False)
+    if not individuais:
+        return caminho_xlsx
+
+    # Os arquivos são montados em paralelo e gravados no ZIP por esta thread,
+    # já que o ZipFile não aceita escritas concorrentes
+    caminho_zip = os.path.join(pasta_saida, f"fechamento_{mes}.zip")
+    usados = set()
+    with zipfile.ZipFile(caminho_zip, "w", zipfile.ZIP_DEFLATED) as zip_saida, \
+            ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="fechamento") as executor:
+        zip_saida.write(caminho_xlsx, os.path.basename(caminho_xlsx))
+        futuros = {}
+        for nome, lista in plantoes.items():
+            base = _nome_arquivo(nome, usados)
+            futuros[executor.submit(_csv_plantonista, lista)] = f"individuais/{base}.csv"
+            futuros[executor.submit(_pdf_plantonista, mes, nome, lista)] = f"individuais/{base}.pdf"
+        for feitos, futuro in enumerate(as_completed(futuros), start=1):
+            zip_saida.writestr(futuros[futuro], futuro.result())
+            if progresso:
+                progresso(feitos, len(futuros))
+    return caminho_zip
 
 # --- Utilitários ---
-def calcular_horas_extras(data_inicio, data_fim):
-    di = datetime.strptime(data_inicio, '%Y-%m-%d %H:%M')
-    df = datetime.strptime(data_fim, '%Y-%m-%d %H:%M')
-    atual = di
-    horas_normais = horas_especiais = 0
-    while atual < df:
-        if atual.weekday() >= 5:
-            horas_especiais += 1 / 60
+_EPOCA = datetime(1970, 1, 1)
+MINUTOS_DIA = 24 * 60
+
+def para_minutos(valor):
+    """Converte datetime, date ou texto ISO ('2025-05-16 18:00') em minutos desde 1970."""
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor)
+    elif not isinstance(valor, datetime):
+        valor = datetime.combine(valor, datetime.min.time())
+    return int((valor - _EPOCA).total_seconds()) // 60
+
+def de_minutos(minutos):
+    return _EPOCA + timedelta(minutes=int(minutos))
+
+def para_data(valor):
+    """Normaliza date, datetime ou texto ISO para 'AAAA-MM-DD'."""
+    return de_minutos(para_minutos(valor)).strftime('%Y-%m-%d')
+
+# Horas especiais: sábado, domingo, feriados e a madrugada (00h–06h) dos
+# outros dias. 1970-01-01 (dia 0) foi uma quinta, então o dia da semana de um
+# dia d é (d + 3) % 7, com segunda = 0.
+FIM_MADRUGADA_MIN = 6 * 60
+
+def minutos_por_tipo(inicio_min, fim_min, feriados=frozenset()):
+    """(minutos normais, minutos especiais) de [inicio_min, fim_min), somando dia a dia."""
+    if fim_min <= inicio_min:
+        return 0, 0
+    especiais = 0
+    for dia in range(inicio_min // MINUTOS_DIA, (fim_min - 1) // MINUTOS_DIA + 1):
+        comeco = dia * MINUTOS_DIA
+        de, ate = max(inicio_min, comeco), min(fim_min, comeco + MINUTOS_DIA)
+        if (dia + 3) % 7 >= 5 or dia in feriados:
+            especiais += ate - de
         else:
-            if 6 <= atual.hour < 24:
-                horas_normais += 1 / 60
-            else:
-                horas_especiais += 1 / 60
-        atual += timedelta(minutes=1)
-    return round(horas_normais, 2), round(horas_especiais, 2)
+            especiais += max(0, min(ate, comeco + FIM_MADRUGADA_MIN) - de)
+    return fim_min - inicio_min - especiais, especiais
+
+def horas_do_intervalo(inicio_min, fim_min, feriados=frozenset()):
+    normais, especiais = minutos_por_tipo(inicio_min, fim_min, feriados)
+    return round(normais / 60, 2), round(especiais / 60, 2)
+
+def calcular_horas_extras(data_inicio, data_fim):
+    return horas_do_intervalo(para_minutos(data_inicio), para_minutos(data_fim), dias_feriados())
+
+def horas_vetorizadas(inicios, fins, feriados=frozenset()):
+    """Versão em numpy de horas_do_intervalo para arrays de inicio_min/fim_min.
+
+    Monta uma vez os minutos especiais de cada dia do período coberto e a soma
+    acumulada deles; os especiais de um intervalo são a diferença dessa soma
+    entre o fim e o início, sem laço por linha.
+    """
+    inicios = np.asarray(inicios, dtype=np.int64)
+    fins = np.maximum(np.asarray(fins, dtype=np.int64), inicios)
+    if not len(inicios):
+        return np.zeros(0), np.zeros(0)
+    primeiro = inicios.min() // MINUTOS_DIA
+    dias = np.arange(primeiro, fins.max() // MINUTOS_DIA + 1)
+    dia_especial = ((dias + 3) % 7 >= 5) | np.isin(dias, np.fromiter(feriados, np.int64, len(feriados)))
+    acumulado = np.concatenate(([0], np.cumsum(np.where(dia_especial, MINUTOS_DIA, FIM_MADRUGADA_MIN))))
+
+    def especiais_ate(minutos):
+        indice = minutos // MINUTOS_DIA - primeiro
+        resto = minutos % MINUTOS_DIA
+        return acumulado[indice] + np.where(dia_especial[indice], resto, np.minimum(resto, FIM_MADRUGADA_MIN))
+
+    especiais = especiais_ate(fins) - especiais_ate(inicios)
+    return np.round((fins - inicios - especiais) / 60, 2), np.round(especiais / 60, 2)
+
+def calcular_horas_lote(intervalos):
+    """Horas (normais, especiais) de cada (inicio_min, fim_min), lendo os feriados uma vez."""
+    inicios, fins = zip(*intervalos) if intervalos else ((), ())
+    normais, especiais = horas_vetorizadas(inicios, fins, dias_feriados())
+    return list(zip(normais.tolist(), especiais.tolist()))
+
+def normalizar_texto(texto):
+    # Minúsculas e sem acentos: "CONCEIÇÃO" -> "conceicao"
+    if texto is None:
+        return ''
+    decomposto = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).lower()
 
 def safe_json_loads(x):
     try:
@@ -199,19 +1614,29 @@ def safe_list_load(x):
         return [x] if x else []
 
 
+# O LibreOffice não aceita duas conversões simultâneas com o mesmo perfil.
+# Threads que definem _perfil_libreoffice.pasta usam um perfil só delas e
+# convertem em paralelo; as demais usam o perfil padrão, uma de cada vez.
+_lock_conversao = threading.Lock()
+_perfil_libreoffice = threading.local()
+
 def docx_para_pdf(docx_path, pdf_dir):
     sistema = platform.system()
     
     executable = "soffice" if sistema == "Windows" else "libreoffice"
+    perfil = getattr(_perfil_libreoffice, "pasta", None)
+    opcoes = [f"-env:UserInstallation={Path(perfil).as_uri()}"] if perfil else []
 
     try:
-        subprocess.run([
-            executable,
-            "--headless",
-            "--convert-to", "pdf",
-            "--outdir", pdf_dir,
-            docx_path
-        ], check=True)
+        with (nullcontext() if perfil else _lock_conversao):
+            subprocess.run([
+                executable,
+                *opcoes,
+                "--headless",
+                "--convert-to", "pdf",
+                "--outdir", pdf_dir,
+                docx_path
+            ], check=True)
 
         # Renomeia o PDF gerado para um nome padrão
         generated_pdf = os.path.join(pdf_dir, os.path.basename(docx_path).replace(".docx", ".pdf"))
@@ -246,96 +1671,1106 @@ data_hoje = f"{hoje.day} de {meses_pt[hoje.month]} de {hoje.year}"
 
 
 
-def gerar_pdf_escala_por_equipe(ids=None):
-    conn = conectar()
-    query = "SELECT * FROM escalas"
+def _anexar_documento(destino, origem):
+    """Copia o corpo de `origem` para o fim de `destino`, começando numa nova página.
+
+    As imagens são recadastradas no destino; o python-docx reaproveita partes
+    de mesmo conteúdo, então a assinatura repetida em cada escala entra uma vez só.
+    """
+    destino.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+    fim_corpo = destino.element.body.sectPr
+    for elemento in list(origem.element.body):
+        if elemento.tag == qn('w:sectPr'):
+            continue
+        for blip in elemento.iter(qn('a:blip')):
+            rid = blip.get(qn('r:embed'))
+            if rid:
+                imagem = origem.part.related_parts[rid]
+                novo_rid, _ = destino.part.get_or_add_image(io.BytesIO(imagem.blob))
+                blip.set(qn('r:embed'), novo_rid)
+        if fim_corpo is not None:
+            fim_corpo.addprevious(elemento)
+        else:
+            destino.element.body.append(elemento)
+
+
+def _dados_escalas(conn, ids=None):
+    """Valores dos placeholders do modelo e linhas da equipe de cada escala.
+
+    As escalas vêm do banco principal e dos arquivos anuais, como no Histórico.
+    """
     if ids:
-        placeholders = ','.join(['?'] * len(ids))
-        query += f" WHERE id IN ({placeholders})"
-        df = pd.read_sql_query(query, conn, params=ids)
+        ids = [int(i) for i in ids]
+        df = consultar_periodo("escalas", condicao=f"id IN ({','.join(['?'] * len(ids))})", params=ids, ordem="id")
     else:
-        df = pd.read_sql_query(query, conn)
+        df = consultar_periodo("escalas", ordem="id")
 
-    df['plantonistas'] = df['plantonistas'].apply(safe_list_load)
-    plantonistas_db = pd.read_sql_query('SELECT * FROM plantonistas', conn)
+    if df.empty:
+        raise ValueError("Nenhuma escala encontrada para gerar o PDF.")
 
-    os.makedirs("relatorios", exist_ok=True)
+    df['plantonistas'] = df['plantonistas'].apply(safe_list_load)
+    plantonistas_db = {}
+    for p in conn.execute("SELECT nome, matricula, cpf, telefone FROM plantonistas ORDER BY id"):
+        plantonistas_db.setdefault(p['nome'], p)
+    placas = dict(conn.execute("SELECT id, placa FROM viaturas").fetchall())
+    coordenadores = dict(conn.execute("SELECT id, nome FROM coordenadores").fetchall())
 
     hoje = datetime.now()
-    data_hoje = f"{hoje.day} de {meses_pt[hoje.month]} de {hoje.year}"
-  # Ex: 19 de maio de 2025
+    data_hoje = f"{hoje.day} de {meses_pt[hoje.month]} de {hoje.year}"  # Ex: 19 de maio de 2025
 
+    escalas = []
+    for _, row in df.iterrows():
+        data_inicio = de_minutos(row['inicio_min'])
+        data_fim = de_minutos(row['fim_min'])
+        valores = {
+            "{{dia_semana}}": dias_semana[data_inicio.strftime('%A')],
+            "{{data}}": data_inicio.strftime('%d/%m/%Y'),
+            "{{dia_semana_fim}}": dias_semana[data_fim.strftime('%A')],
+            "{{data_fim}}": data_fim.strftime('%d/%m/%Y'),
+            "{{turno}}": row['turno'],
+            "{{placa}}": placas.get(row['viatura_id']) or '---',
+            "{{total}}": str(len(row['plantonistas'])),
+            "{{coordenador}}": coordenadores.get(row['coordenador_id']) or '---',
+            "{{data_hoje}}": data_hoje,
+        }
+        equipe = []
+        for nome in row['plantonistas']:
+            dados = plantonistas_db.get(nome)
+            equipe.append([f"OIP {nome}"] + [(dados[campo] if dados else None) or '---'
+                                             for campo in ('matricula', 'cpf', 'telefone')])
+        turno = re.sub(r'[^a-z0-9]+', '_', normalizar_texto(row['turno'] or '')).strip('_') or 'turno'
+        escalas.append({'valores': valores, 'equipe': equipe,
+                        'arquivo': f"escala_{data_inicio:%Y-%m-%d}_{turno}_{row['id']}.pdf"})
+    return escalas
+
+def _preencher(texto, valores):
+    for marcador, valor in valores.items():
+        texto = texto.replace(marcador, valor)
+    return texto
+
+def _renderizar_escalas_docx(escalas, modelo, assinatura, pasta_saida, progresso=None):
+    """Preenche o modelo DOCX e converte pelo LibreOffice."""
+    merged = None
+    for feitos, escala in enumerate(escalas, start=1):
+        doc = Document(io.BytesIO(modelo))
+
+        for p in doc.paragraphs:
+            p.text = _preencher(p.text, escala['valores'])
+
+        tabela = next((t for t in doc.tables if "Matrícula" in t.cell(0, 1).text), None)
+
+        if tabela:
+            for dados in escala['equipe']:
+                linha = tabela.add_row().cells
+                for celula, valor in zip(linha, dados):
+                    celula.paragraphs[0].add_run(valor)
+
+        if assinatura:
+            doc.add_paragraph("")
+            doc.add_picture(io.BytesIO(assinatura['imagem']), width=Inches(2.5))
+            doc.add_paragraph(assinatura['delegado'])
+
+        if merged is None:
+            merged = doc
+        else:
+            _anexar_documento(merged, doc)
+        if progresso:
+            progresso(feitos, len(escalas))
+
+    final_docx_path = os.path.join(pasta_saida, "escala_completa.docx")
+    merged.save(final_docx_path)
+    return docx_para_pdf(final_docx_path, pasta_saida)
+
+# Tradução de unidades do Word para o FPDF (mm)
+_EMU_POR_MM = 36000
+_ALINHAMENTOS_PDF = {WD_ALIGN_PARAGRAPH.CENTER: 'C', WD_ALIGN_PARAGRAPH.RIGHT: 'R', WD_ALIGN_PARAGRAPH.JUSTIFY: 'J'}
+
+def _layout_modelo(modelo):
+    """Lê do modelo DOCX o que o renderizador FPDF desenha: parágrafos (texto,
+    alinhamento, negrito e tamanho), a tabela da equipe, margens e a imagem do cabeçalho.
+
+    Assim os dois renderizadores usam o mesmo texto e os mesmos placeholders.
+    """
+    doc = Document(io.BytesIO(modelo))
+    blocos = []
+    for elemento in doc.element.body.iterchildren():
+        if elemento.tag == qn('w:p'):
+            p = Paragraph(elemento, doc)
+            tamanho = next((r.font.size.pt for r in p.runs if r.font.size), 10)
+            negrito = any(r.bold for r in p.runs)
+            blocos.append(('paragrafo', p.text, _ALINHAMENTOS_PDF.get(p.alignment, 'L'), negrito, tamanho))
+        elif elemento.tag == qn('w:tbl'):
+            t = Table(elemento, doc)
+            if "Matrícula" in t.cell(0, 1).text:
+                larguras = [(c.width or 0) / _EMU_POR_MM for c in t.columns]
+                blocos.append(('equipe', [c.text for c in t.rows[0].cells], larguras))
+
+    secao = doc.sections[0]
+    margens = tuple((m or 0) / _EMU_POR_MM for m in (secao.left_margin, secao.top_margin, secao.right_margin, secao.bottom_margin))
+    imagem = None
+    extensao = None
+    if not secao.header.is_linked_to_previous:
+        for parte in secao.header.part.related_parts.values():
+            if parte.content_type in ('image/jpeg', 'image/png'):
+                imagem, extensao = parte.blob, parte.content_type.split('/')[1]
+                break
+    return blocos, margens, (imagem, extensao)
+
+class _PDFEscala(PDFGrande):
+    """Página de escala com a imagem do cabeçalho do modelo em todas as páginas."""
+    imagem_cabecalho = None
+
+    def header(self):
+        if self.imagem_cabecalho:
+            largura = self.w - self.l_margin - self.r_margin
+            self.image(self.imagem_cabecalho, x=self.l_margin, y=10, w=largura)
+        self.set_y(self.t_margin)
+
+def _renderizar_escalas_fpdf(escalas, modelo, assinatura, pasta_saida, progresso=None):
+    """Desenha as escalas direto em PDF, sem Word nem LibreOffice."""
+    blocos, (esquerda, topo, direita, base), (imagem, extensao) = _layout_modelo(modelo)
+    final_pdf_path = os.path.join(pasta_saida, "escala_completa.pdf")
+
+    # O FPDF 1.7 só carrega imagens de arquivo; cada uma é lida uma vez por documento
     with tempfile.TemporaryDirectory() as tmpdir:
-        docx_paths = []
-
-        for idx, row in df.iterrows():
-            doc = Document("base_escala.docx")
-
-            data_inicio = datetime.strptime(row['data_inicio'], '%Y-%m-%d %H:%M')
-            data_fim = datetime.strptime(row['data_fim'], '%Y-%m-%d %H:%M')
-
-            dia_semana = dias_semana[data_inicio.strftime('%A')]
-            dia_semana_fim = dias_semana[data_fim.strftime('%A')]
-
-            data_formatada = data_inicio.strftime('%d/%m/%Y')
-            data_fim_formatada = data_fim.strftime('%d/%m/%Y')
-            turno = row['turno']
-            total = len(row['plantonistas'])
-
-            placa = '---'
-            if row['viatura_id']:
-                viatura_row = conn.execute("SELECT placa FROM viaturas WHERE id = ?", (row['viatura_id'],)).fetchone()
-                placa = viatura_row['placa'] if viatura_row else '---'
-
-            coordenador = '---'
-            if row['coordenador_id']:
-                coord_row = conn.execute("SELECT nome FROM coordenadores WHERE id = ?", (row['coordenador_id'],)).fetchone()
-                coordenador = coord_row['nome'] if coord_row else '---'
-
-            for p in doc.paragraphs:
-                p.text = p.text.replace("{{dia_semana}}", dia_semana)
-                p.text = p.text.replace("{{data}}", data_formatada)
-                p.text = p.text.replace("{{dia_semana_fim}}", dia_semana_fim)
-                p.text = p.text.replace("{{data_fim}}", data_fim_formatada)
-                p.text = p.text.replace("{{turno}}", turno)
-                p.text = p.text.replace("{{placa}}", placa)
-                p.text = p.text.replace("{{total}}", str(total))
-                p.text = p.text.replace("{{coordenador}}", coordenador)
-                p.text = p.text.replace("{{data_hoje}}", data_hoje)
-
-            tabela = next((t for t in doc.tables if "Matrícula" in t.cell(0, 1).text), None)
-
-            if tabela:
-                for nome in row['plantonistas']:
-                    match = plantonistas_db[plantonistas_db['nome'] == nome]
-                    dados = match.iloc[0] if not match.empty else {}
-
-                    linha = tabela.add_row().cells
-                    linha[0].paragraphs[0].add_run(f"OIP {nome}")
-                    linha[1].paragraphs[0].add_run(dados.get('matricula', '---'))
-                    linha[2].paragraphs[0].add_run(dados.get('cpf', '---'))
-                    if len(linha) > 3:
-                        linha[3].paragraphs[0].add_run(dados.get('telefone', '---'))
-
-            assinatura_path = "assinatura.png"
-            if os.path.exists(assinatura_path):
-                doc.add_paragraph("")
-                doc.add_picture(assinatura_path, width=Inches(2.5))
-                doc.add_paragraph("DR MARCOS VINÍCIUS CACAU DE LIMA\nDelegado De Polícia Civil")
-
-            temp_docx = os.path.join(tmpdir, f"escala_{row['id']}.docx")
-            doc.save(temp_docx)
-            docx_paths.append(temp_docx)
-
-        final_docx_path = os.path.join("relatorios", "escala_completa.docx")
-        merged = Document(docx_paths[0])
-        for other_path in docx_paths[1:]:
-            sub_doc = Document(other_path)
-            for element in sub_doc.element.body:
-                merged.element.body.append(element)
-        merged.save(final_docx_path)
-
-        final_pdf_path = docx_para_pdf(final_docx_path, "relatorios")
-
-        with open(final_pdf_path, "rb") as f:
-            return f.read()
+        pdf = _PDFEscala()
+        pdf.set_margins(esquerda, topo, direita)
+        pdf.set_auto_page_break(True, margin=max(base, 10))
+        if imagem:
+            pdf.imagem_cabecalho = os.path.join(tmpdir, f"cabecalho.{extensao}")
+            with open(pdf.imagem_cabecalho, "wb") as f:
+                f.write(imagem)
+        largura_util = pdf.w - esquerda - direita
+
+        for feitos, escala in enumerate(escalas, start=1):
+            pdf.add_page()
+            for bloco in blocos:
+                if bloco[0] == 'paragrafo':
+                    _, texto, alinhamento, negrito, tamanho = bloco
+                    texto = _preencher(texto, escala['valores']).strip()
+                    if not texto:
+                        pdf.ln(tamanho * 0.35)
+                        continue
+                    pdf.set_font("Arial", 'B' if negrito else '', tamanho)
+                    pdf.multi_cell(0, tamanho * 0.5, _texto_pdf(texto), align=alinhamento)
+                else:
+                    _, titulos, larguras = bloco
+                    escala_largura = largura_util / (sum(larguras) or 1)
+                    larguras = [l * escala_largura if sum(larguras) else largura_util / len(titulos) for l in larguras]
+                    pdf.set_font("Arial", 'B', 9)
+                    pdf.set_fill_color(220, 220, 220)
+                    for titulo, largura in zip(titulos, larguras):
+                        pdf.cell(largura, 6, _texto_pdf(titulo), border=1, align='C', fill=1)
+                    pdf.ln()
+                    pdf.set_font("Arial", size=9)
+                    for dados in escala['equipe']:
+                        for valor, largura in zip(dados, larguras):
+                            pdf.cell(largura, 6, _texto_pdf(valor), border=1)
+                        pdf.ln()
+
+            if assinatura:
+                pdf.ln(4)
+                pdf.image(assinatura['caminho'], x=pdf.l_margin, w=63.5)
+                pdf.set_font("Arial", 'B', 10)
+                pdf.multi_cell(0, 5, _texto_pdf(assinatura['delegado']))
+            if progresso:
+                progresso(feitos, len(escalas))
+
+        pdf.output(final_pdf_path, 'F')
+    return final_pdf_path
+
+RENDERIZADORES_ESCALA = {
+    "docx": _renderizar_escalas_docx,
+    "fpdf": _renderizar_escalas_fpdf,
+}
+
+def gerar_pdf_escala_por_equipe(ids=None, pasta_saida=None, progresso=None, renderizador="docx"):
+    """Gera o PDF das escalas a partir do modelo DOCX.
+
+    renderizador="docx" preenche o Word e converte pelo LibreOffice (também
+    salva escala_completa.docx); "fpdf" desenha o mesmo layout direto em PDF,
+    sem depender do LibreOffice.
+    """
+    if renderizador not in RENDERIZADORES_ESCALA:
+        raise ValueError(f"Renderizador desconhecido: {renderizador}")
+    pasta_saida = pasta_saida or pasta_relatorios()
+    escalas, modelo, assinatura = _preparar_escalas(ids)
+    os.makedirs(pasta_saida, exist_ok=True)
+
+    final_pdf_path = RENDERIZADORES_ESCALA[renderizador](escalas, modelo, assinatura, pasta_saida, progresso)
+
+    with open(final_pdf_path, "rb") as f:
+        return f.read()
+
+def _preparar_escalas(ids=None):
+    """Dados das escalas, modelo DOCX e assinatura (None se não houver).
+
+    O modelo e a assinatura são lidos do disco uma vez; cada escala é montada
+    a partir dos bytes em memória. A assinatura é um dict com a imagem, o
+    caminho dela e o nome do delegado, todos da unidade atual, porque os
+    renderizadores podem rodar em threads que não enxergam a unidade.
+    """
+    conn = conectar()
+    escalas = _dados_escalas(conn, ids)
+    conn.close()
+    with open(caminho_modelo(), "rb") as f:
+        modelo = f.read()
+    assinatura = None
+    caminho = caminho_assinatura()
+    if os.path.exists(caminho):
+        with open(caminho, "rb") as f:
+            assinatura = {'imagem': f.read(), 'caminho': caminho, 'delegado': delegado()}
+    return escalas, modelo, assinatura
+
+TRABALHADORES_ZIP = min(4, os.cpu_count() or 1)
+
+def gerar_zip_escalas_por_equipe(ids=None, caminho=None, progresso=None, renderizador="docx",
+                                 trabalhadores=TRABALHADORES_ZIP):
+    """Gera um PDF por escala, em paralelo, num ZIP; devolve o caminho do ZIP.
+
+    Cada PDF se chama escala_<data>_<turno>_<id>.pdf e entra no ZIP assim que
+    fica pronto. No máximo ``trabalhadores`` escalas estão em andamento ao
+    mesmo tempo, então a memória não cresce com o número de escalas. Com
+    renderizador="docx", cada trabalhador usa um perfil próprio do LibreOffice
+    para que as conversões não esperem umas pelas outras.
+    """
+    if renderizador not in RENDERIZADORES_ESCALA:
+        raise ValueError(f"Renderizador desconhecido: {renderizador}")
+    caminho = caminho or os.path.join(pasta_relatorios(), "escalas_individuais.zip")
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    escalas, modelo, assinatura = _preparar_escalas(ids)
+    pendentes = iter(escalas)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        def renderizar(escala):
+            if renderizador == "docx" and not hasattr(_perfil_libreoffice, "pasta"):
+                _perfil_libreoffice.pasta = tempfile.mkdtemp(prefix="perfil_", dir=tmpdir)
+            with tempfile.TemporaryDirectory(dir=tmpdir) as pasta:
+                pdf = RENDERIZADORES_ESCALA[renderizador]([escala], modelo, assinatura, pasta)
+                with open(pdf, "rb") as f:
+                    return f.read()
+
+        # Só há uma escala por trabalhador em andamento; o ZIP é gravado por
+        # esta thread, já que o ZipFile não aceita escritas concorrentes
+        with zipfile.ZipFile(caminho, "w", zipfile.ZIP_DEFLATED) as zip_saida, \
+                ThreadPoolExecutor(max_workers=trabalhadores, thread_name_prefix="zip_escalas") as executor:
+            em_andamento = {executor.submit(renderizar, e): e['arquivo'] for e in islice(pendentes, trabalhadores)}
+            feitos = 0
+            while em_andamento:
+                prontos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    zip_saida.writestr(em_andamento.pop(futuro), futuro.result())
+                    feitos += 1
+                    if progresso:
+                        progresso(feitos, len(escalas))
+                for escala in islice(pendentes, len(prontos)):
+                    em_andamento[executor.submit(renderizar, escala)] = escala['arquivo']
+    return caminho
+
+
+
+# --- Tarefas em segundo plano ---
+# Relatórios demorados rodam num pool de threads. O estado de cada tarefa fica
+# na tabela "tarefas", então qualquer sessão do Streamlit pode acompanhar o
+# progresso e baixar o resultado, e pedidos iguais em andamento são reaproveitados.
+MAX_TRABALHADORES = 2
+# Tarefas concluídas ou com erro (e seus arquivos) ficam disponíveis por este
+# tempo; depois limpar_tarefas_antigas apaga a linha e a pasta da tarefa.
+RETENCAO_TAREFAS_DIAS = 7
+
+_executor = None
+_lock_executor = threading.Lock()
+_bancos_tarefas_recuperados = set()
+
+def _tarefa_pdf_escalas(pasta, progresso, ids=None, renderizador="docx"):
+    gerar_pdf_escala_por_equipe(ids=ids, pasta_saida=pasta, progresso=progresso, renderizador=renderizador)
+    return os.path.join(pasta, "escala_completa.pdf")
+
+def _tarefa_zip_escalas(pasta, progresso, ids=None, renderizador="docx"):
+    return gerar_zip_escalas_por_equipe(ids=ids, caminho=os.path.join(pasta, "escalas_individuais.zip"),
+                                        progresso=progresso, renderizador=renderizador)
+
+def _tarefa_historico_excel(pasta, progresso):
+    return gerar_historico_excel_por_equipe(os.path.join(pasta, "historico_por_equipe.xlsx"))
+
+def _tarefa_historico_pdf(pasta, progresso):
+    return gerar_historico_pdf_por_equipe(caminho=os.path.join(pasta, "historico_por_equipe.pdf"), progresso=progresso)
+
+def _tarefa_fechamento_mensal(pasta, progresso, mes, individuais=False):
+    return gerar_fechamento_mensal(mes, pasta_saida=pasta, individuais=individuais, progresso=progresso)
+
+TIPOS_TAREFA = {
+    "pdf_escalas": _tarefa_pdf_escalas,
+    "zip_escalas": _tarefa_zip_escalas,
+    "historico_excel": _tarefa_historico_excel,
+    "historico_pdf": _tarefa_historico_pdf,
+    "fechamento_mensal": _tarefa_fechamento_mensal,
+}
+
+def criar_tabela_tarefas(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tarefas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            parametros TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            feitos INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            arquivo TEXT,
+            erro TEXT,
+            criada_em TEXT NOT NULL,
+            atualizada_em TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_chave ON tarefas (chave, status)")
+
+def _obter_executor():
+    global _executor
+    with _lock_executor:
+        # Cada unidade tem seu banco: a limpeza roda uma vez por banco no processo
+        caminho = caminho_banco()
+        if caminho not in _bancos_tarefas_recuperados:
+            # Tarefas que estavam em andamento quando o processo anterior caiu
+            # nunca vão terminar; marcá-las libera a deduplicação.
+            with conectar() as conn:
+                criar_tabela_tarefas(conn)
+                conn.execute(
+                    "UPDATE tarefas SET status='erro', erro='Interrompida', atualizada_em=? "
+                    "WHERE status IN ('pendente', 'executando')",
+                    (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)
+                )
+            limpar_tarefas_antigas()
+            _bancos_tarefas_recuperados.add(caminho)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_TRABALHADORES, thread_name_prefix="tarefa")
+        return _executor
+
+def _atualizar_tarefa(id_tarefa, **campos):
+    campos['atualizada_em'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    colunas = ', '.join(f"{nome} = ?" for nome in campos)
+    with transacao_escrita() as conn:
+        conn.execute(f"UPDATE tarefas SET {colunas} WHERE id = ?", (*campos.values(), id_tarefa))
+
+def _executar_tarefa(id_tarefa, tipo, parametros):
+    pasta = os.path.join(pasta_relatorios(), "tarefas", str(id_tarefa))
+    os.makedirs(pasta, exist_ok=True)
+    _atualizar_tarefa(id_tarefa, status='executando')
+
+    def progresso(feitos, total):
+        _atualizar_tarefa(id_tarefa, feitos=feitos, total=total)
+
+    try:
+        arquivo = TIPOS_TAREFA[tipo](pasta, progresso, **parametros)
+    except Exception as e:
+        _atualizar_tarefa(id_tarefa, status='erro', erro=str(e))
+    else:
+        _atualizar_tarefa(id_tarefa, status='concluida', arquivo=arquivo)
+
+def limpar_tarefas_antigas(dias=RETENCAO_TAREFAS_DIAS):
+    """Apaga as tarefas encerradas há mais de ``dias`` dias e suas pastas.
+
+    Pastas em relatorios/tarefas sem tarefa correspondente (sobras de limpezas
+    interrompidas) também são removidas. Devolve quantas tarefas foram apagadas.
+    """
+    limite = (datetime.now() - timedelta(days=dias)).strftime('%Y-%m-%d %H:%M:%S')
+    with transacao_escrita() as conn:
+        criar_tabela_tarefas(conn)
+        apagadas = conn.execute(
+            "DELETE FROM tarefas WHERE status IN ('concluida', 'erro') AND atualizada_em < ? RETURNING id",
+            (limite,)
+        ).fetchall()
+        existentes = {row['id'] for row in conn.execute("SELECT id FROM tarefas")}
+        ultimo = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'tarefas'").fetchone()
+    # Só ids já emitidos: uma tarefa criada agora por outro processo fica de fora
+    ultimo = ultimo['seq'] if ultimo else 0
+    pasta = os.path.join(pasta_relatorios(), "tarefas")
+    if os.path.isdir(pasta):
+        for nome in os.listdir(pasta):
+            if nome.isdigit() and int(nome) <= ultimo and int(nome) not in existentes:
+                shutil.rmtree(os.path.join(pasta, nome), ignore_errors=True)
+    return len(apagadas)
+
+def enfileirar_tarefa(tipo, **parametros):
+    """Agenda uma tarefa e devolve seu id.
+
+    Se já existe uma tarefa do mesmo tipo e com os mesmos parâmetros pendente
+    ou executando, devolve o id dela em vez de criar outra.
+    """
+    if tipo not in TIPOS_TAREFA:
+        raise ValueError(f"Tipo de tarefa desconhecido: {tipo}")
+    if parametros.get('ids'):
+        parametros['ids'] = sorted(int(i) for i in parametros['ids'])
+    parametros_json = json.dumps(parametros, sort_keys=True)
+    chave = hashlib.sha1(f"{tipo}:{parametros_json}".encode('utf-8')).hexdigest()
+    executor = _obter_executor()
+
+    agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with _lock_executor, conectar() as conn:
+        existente = conn.execute(
+            "SELECT id FROM tarefas WHERE chave = ? AND status IN ('pendente', 'executando')", (chave,)
+        ).fetchone()
+        if existente:
+            return existente['id']
+        id_tarefa = conn.execute(
+            "INSERT INTO tarefas (tipo, parametros, chave, criada_em, atualizada_em) VALUES (?, ?, ?, ?, ?)",
+            (tipo, parametros_json, chave, agora, agora)
+        ).lastrowid
+    # Leva a unidade atual para a thread do pool
+    executor.submit(contextvars.copy_context().run, _executar_tarefa, id_tarefa, tipo, parametros)
+    return id_tarefa
+
+def obter_tarefa(id_tarefa):
+    with conectar() as conn:
+        row = conn.execute("SELECT * FROM tarefas WHERE id = ?", (id_tarefa,)).fetchone()
+    return dict(row) if row else None
+
+def ler_resultado_tarefa(id_tarefa):
+    tarefa = obter_tarefa(id_tarefa)
+    if not tarefa or tarefa['status'] != 'concluida':
+        return None
+    with open(tarefa['arquivo'], "rb") as f:
+        return f.read()
+
+
+# --- Consolidação entre unidades ---
+def horas_por_plantonista(inicio_min=None, fim_min=None):
+    """Horas normais/especiais e plantões de cada plantonista no período, na unidade atual."""
+    parciais = [
+        linha
+        for lote in iterar_periodo(
+            "historico",
+            "j.value AS plantonista, SUM(t.horas_normais), SUM(t.horas_especiais), COUNT(*)",
+            inicio_min, fim_min,
+            juncao="JOIN json_each(t.plantonistas) AS j", agrupar="j.value", ordem=None
+        )
+        for linha in lote
+    ]
+    df = pd.DataFrame.from_records(
+        [tuple(linha) for linha in parciais],
+        columns=["plantonista", "horas_normais", "horas_especiais", "plantoes"]
+    )
+    # Vários grupos de arquivos anexados geram parciais da mesma pessoa
+    return df.groupby("plantonista", as_index=False).sum()
+
+_bancos_migrados = set()
+_lock_bancos_migrados = threading.Lock()
+
+def _horas_da_unidade(chave, inicio_min, fim_min):
+    with na_unidade(chave):
+        # O banco de outra unidade pode ainda não ter passado pelas migrações;
+        # agregar_unidades chama esta função de várias threads
+        with _lock_bancos_migrados:
+            if caminho_banco() not in _bancos_migrados:
+                criar_tabelas()
+                _bancos_migrados.add(caminho_banco())
+        df = horas_por_plantonista(inicio_min, fim_min)
+    df.insert(0, "unidade", chave)
+    return df
+
+def agregar_unidades(inicio_min=None, fim_min=None, unidades=None):
+    """Consulta o banco de cada unidade em paralelo e junta os agregados parciais.
+
+    Devolve um DataFrame com uma linha por (unidade, plantonista).
+    """
+    unidades = list(unidades or UNIDADES)
+    if not unidades:
+        return _horas_da_unidade(None, inicio_min, fim_min)
+    with ThreadPoolExecutor(max_workers=min(len(unidades), 8), thread_name_prefix="unidade") as executor:
+        parciais = list(executor.map(lambda chave: _horas_da_unidade(chave, inicio_min, fim_min), unidades))
+    return pd.concat(parciais, ignore_index=True)
+
+
+# --- Saldo de horas ---
+# Totais por plantonista e mês ('AAAA-MM') mantidos por gatilhos no
+# histórico, na mesma transação de cada escrita. "Quantas horas X fez no mês
+# ou no ano" vira leitura de no máximo 12 linhas, sem varrer o histórico nem
+# decodificar JSON. Linhas movidas para o arquivo anual continuam contadas.
+_MES_SQL = "strftime('%Y-%m', {linha}.inicio_min * 60, 'unixepoch')"
+_EQUIPE_SQL = "json_each(CASE WHEN json_valid({linha}.plantonistas) THEN {linha}.plantonistas ELSE '[]' END)"
+COLUNAS_SALDO = ["plantonista", "mes", "horas_normais", "horas_especiais", "plantoes"]
+
+def _somar_saldo(linha, sinal=""):
+    return f"""
+        INSERT INTO saldo_horas (plantonista, mes, horas_normais, horas_especiais, plantoes)
+        SELECT j.value, {_MES_SQL.format(linha=linha)}, {sinal}COALESCE({linha}.horas_normais, 0),
+               {sinal}COALESCE({linha}.horas_especiais, 0), {sinal}1
+        FROM {_EQUIPE_SQL.format(linha=linha)} AS j WHERE true
+        ON CONFLICT (plantonista, mes) DO UPDATE SET
+            horas_normais = horas_normais + excluded.horas_normais,
+            horas_especiais = horas_especiais + excluded.horas_especiais,
+            plantoes = plantoes + excluded.plantoes;
+    """
+
+def _limpar_saldo(linha):
+    return f"""
+        DELETE FROM saldo_horas
+        WHERE plantoes = 0 AND mes = {_MES_SQL.format(linha=linha)}
+          AND plantonista IN (SELECT value FROM {_EQUIPE_SQL.format(linha=linha)});
+    """
+
+def criar_tabela_saldos(conn):
+    nova = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'saldo_horas'").fetchone() is None
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS saldo_horas (
+            plantonista TEXT NOT NULL,
+            mes TEXT NOT NULL,
+            horas_normais REAL NOT NULL DEFAULT 0,
+            horas_especiais REAL NOT NULL DEFAULT 0,
+            plantoes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (plantonista, mes)
+        ) WITHOUT ROWID;
+        -- arquivar_ano marca o ano aqui enquanto apaga, para não descontar o saldo
+        CREATE TABLE IF NOT EXISTS arquivamento_em_curso (ano INTEGER PRIMARY KEY);
+        CREATE TRIGGER IF NOT EXISTS saldo_historico_insert AFTER INSERT ON historico
+        BEGIN
+            {_somar_saldo('NEW')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS saldo_historico_delete AFTER DELETE ON historico
+        WHEN NOT EXISTS (SELECT 1 FROM arquivamento_em_curso)
+        BEGIN
+            {_somar_saldo('OLD', '-')}
+            {_limpar_saldo('OLD')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS saldo_historico_update
+        AFTER UPDATE OF plantonistas, horas_normais, horas_especiais, inicio_min ON historico
+        BEGIN
+            {_somar_saldo('OLD', '-')}
+            {_limpar_saldo('OLD')}
+            {_somar_saldo('NEW')}
+        END;
+    """)
+    if nova:
+        _gravar_saldos(conn, _saldos_do_historico())
+
+def _saldos_do_historico():
+    """Recalcula os saldos direto do histórico, incluindo os arquivos anuais."""
+    parciais = [
+        tuple(linha)
+        for lote in iterar_periodo(
+            "historico",
+            f"j.value, {_MES_SQL.format(linha='t')} AS mes, "
+            "SUM(COALESCE(t.horas_normais, 0)), SUM(COALESCE(t.horas_especiais, 0)), COUNT(*)",
+            juncao=f"JOIN {_EQUIPE_SQL.format(linha='t')} AS j", agrupar="j.value, mes", ordem=None
+        )
+        for linha in lote
+    ]
+    df = pd.DataFrame.from_records(parciais, columns=COLUNAS_SALDO)
+    # Vários grupos de arquivos anexados geram parciais do mesmo mês
+    return df.groupby(["plantonista", "mes"], as_index=False).sum()
+
+def _gravar_saldos(conn, saldos):
+    conn.execute("DELETE FROM saldo_horas")
+    conn.executemany(
+        "INSERT INTO saldo_horas (plantonista, mes, horas_normais, horas_especiais, plantoes) VALUES (?, ?, ?, ?, ?)",
+        saldos[COLUNAS_SALDO].itertuples(index=False, name=None)
+    )
+
+def reconciliar_saldos(corrigir=True, tolerancia=0.01):
+    """Compara saldo_horas com o histórico e devolve as linhas divergentes.
+
+    Com ``corrigir``, reconstrói a tabela a partir do histórico. A trava de
+    escrita fica com esta conexão durante toda a operação, então nenhuma
+    escala entra entre o recálculo e a gravação.
+    """
+    conn = conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        esperado = _saldos_do_historico()
+        atual = pd.read_sql_query(f"SELECT {', '.join(COLUNAS_SALDO)} FROM saldo_horas", conn)
+        comparado = esperado.merge(atual, on=["plantonista", "mes"], how="outer",
+                                   suffixes=("_historico", "_saldo")).fillna(0)
+        divergente = (
+            ((comparado["horas_normais_historico"] - comparado["horas_normais_saldo"]).abs() > tolerancia)
+            | ((comparado["horas_especiais_historico"] - comparado["horas_especiais_saldo"]).abs() > tolerancia)
+            | (comparado["plantoes_historico"] != comparado["plantoes_saldo"])
+        )
+        if corrigir:
+            _gravar_saldos(conn, esperado)
+        conn.commit()
+    finally:
+        conn.close()
+    return comparado[divergente].sort_values(["mes", "plantonista"]).reset_index(drop=True)
+
+def _mes(valor):
+    return valor if isinstance(valor, str) else valor.strftime('%Y-%m')
+
+def saldo_horas(mes_inicio, mes_fim=None, plantonistas=None):
+    """Horas normais/especiais e plantões por plantonista de ``mes_inicio`` a ``mes_fim``.
+
+    Os meses podem ser 'AAAA-MM', date ou datetime (ambos inclusivos).
+    """
+    condicoes = ["mes >= ?", "mes <= ?"]
+    params = [_mes(mes_inicio), _mes(mes_fim or mes_inicio)]
+    if plantonistas is not None:
+        plantonistas = list(plantonistas)
+        condicoes.append(f"plantonista IN ({','.join(['?'] * len(plantonistas))})")
+        params.extend(plantonistas)
+    with conectar() as conn:
+        return pd.read_sql_query(f"""
+            SELECT plantonista, SUM(horas_normais) AS horas_normais,
+                   SUM(horas_especiais) AS horas_especiais, SUM(plantoes) AS plantoes
+            FROM saldo_horas WHERE {' AND '.join(condicoes)}
+            GROUP BY plantonista
+        """, conn, params=params)
+
+
+# --- Exportação Parquet ---
+# Cópia colunar do banco para análise. Cada exportação (snapshot) grava em
+# <pasta>/<tabela>/snapshot_<n>.parquet só as linhas novas ou alteradas desde
+# a anterior, e em <tabela>/_removidos/ as chaves que saíram ou foram
+# substituídas. ler_parquet junta os snapshots e devolve o estado atual.
+# A equipe (JSON) vira escalas_plantonistas/historico_plantonistas, uma linha
+# por pessoa, e as datas saem como timestamp.
+TABELAS_PARQUET = TABELAS + ("feriados", "modelos_escala", "excecoes_modelo")
+TABELAS_EQUIPE = {"escalas": "escala_id", "historico": "historico_id"}
+
+def _pyarrow_parquet():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("A exportação Parquet precisa do pacote pyarrow (pip install pyarrow).") from None
+    return pyarrow.parquet
+
+def _tabela_para_parquet(tabela):
+    if tabela in TABELAS_EQUIPE:
+        # Inclui os anos arquivados: arquivar não conta como remoção
+        df = consultar_periodo(tabela, COLUNAS_ARQUIVO[tabela], ordem="id")
+        df.insert(1, "data_inicio", pd.to_datetime(df.pop("inicio_min"), unit="m"))
+        df.insert(2, "data_fim", pd.to_datetime(df.pop("fim_min"), unit="m"))
+    else:
+        with conectar() as conn:
+            df = pd.read_sql_query(f"SELECT * FROM {tabela} ORDER BY id", conn)
+    # Tipos pela declaração da coluna, não pelos valores do momento: uma
+    # viatura_id nula não pode virar float e mudar a impressão digital de tudo
+    with conectar() as conn:
+        tipos = {row['name']: row['type'].upper() for row in conn.execute(f"PRAGMA table_info({tabela})")}
+    for coluna in df.columns:
+        if tipos.get(coluna) == "INTEGER":
+            df[coluna] = df[coluna].astype("Int64")
+        elif tipos.get(coluna) == "REAL":
+            df[coluna] = df[coluna].astype("float64")
+    return df
+
+def _membros(df, chave):
+    equipe = df[["id", "plantonistas"]].assign(plantonista=df["plantonistas"].map(safe_list_load)).explode("plantonista")
+    equipe = equipe.dropna(subset=["plantonista"])
+    membros = pd.DataFrame({chave: equipe["id"].values, "plantonista": equipe["plantonista"].astype(str).values})
+    membros["posicao"] = membros.groupby(chave).cumcount()
+    return membros
+
+def _tabela_arrow(df):
+    import pyarrow
+    return pyarrow.Table.from_pandas(df, preserve_index=False)
+
+def _gravar_parte(pq, pasta, nome, numero, linhas, removidos, chave):
+    destino = os.path.join(pasta, nome)
+    os.makedirs(os.path.join(destino, "_removidos"), exist_ok=True)
+    if len(linhas):
+        pq.write_table(_tabela_arrow(linhas.assign(_snapshot=numero)), os.path.join(destino, f"snapshot_{numero:06d}.parquet"))
+    if len(removidos):
+        pq.write_table(_tabela_arrow(pd.DataFrame({chave: sorted(removidos), "_snapshot": numero})),
+                       os.path.join(destino, "_removidos", f"snapshot_{numero:06d}.parquet"))
+
+def exportar_parquet(pasta, completo=False):
+    """Exporta as tabelas para Parquet em ``pasta``; devolve o resumo do snapshot.
+
+    Sem ``completo``, continua a série existente gravando só o que mudou
+    desde o último snapshot (tabelas com a mesma versão nem são lidas).
+    Com ``completo``, apaga a série e começa do zero.
+    """
+    pq = _pyarrow_parquet()
+    caminho_manifesto = os.path.join(pasta, "manifesto.json")
+    if completo:
+        for nome in list(TABELAS_PARQUET) + [f"{t}_plantonistas" for t in TABELAS_EQUIPE] + ["_estado"]:
+            shutil.rmtree(os.path.join(pasta, nome), ignore_errors=True)
+        if os.path.exists(caminho_manifesto):
+            os.remove(caminho_manifesto)
+    manifesto = {"snapshots": []}
+    if os.path.exists(caminho_manifesto):
+        with open(caminho_manifesto, encoding="utf-8") as f:
+            manifesto = json.load(f)
+    versoes_anteriores = manifesto["snapshots"][-1]["versoes"] if manifesto["snapshots"] else {}
+    numero = len(manifesto["snapshots"]) + 1
+    os.makedirs(os.path.join(pasta, "_estado"), exist_ok=True)
+
+    resumo = {}
+    versoes = {}
+    for tabela in TABELAS_PARQUET:
+        versoes[tabela] = versao_tabela(tabela)
+        if versoes_anteriores.get(tabela) == versoes[tabela]:
+            continue
+        df = _tabela_para_parquet(tabela)
+        # Uma impressão digital por linha, guardada em _estado/, identifica o que mudou
+        atual = pd.DataFrame({"id": df["id"].values, "hash": pd.util.hash_pandas_object(df, index=False).values})
+        caminho_estado = os.path.join(pasta, "_estado", f"{tabela}.parquet")
+        anterior = pd.read_parquet(caminho_estado) if os.path.exists(caminho_estado) else atual.iloc[:0]
+        mudou = ~pd.MultiIndex.from_frame(atual).isin(pd.MultiIndex.from_frame(anterior))
+        removidos = set(anterior["id"]) - set(atual["id"])
+
+        linhas = df[mudou]
+        if tabela in TABELAS_EQUIPE:
+            chave = TABELAS_EQUIPE[tabela]
+            _gravar_parte(pq, pasta, f"{tabela}_plantonistas", numero, _membros(linhas, chave),
+                          removidos | set(linhas["id"]), chave)
+            linhas = linhas.drop(columns="plantonistas")
+        _gravar_parte(pq, pasta, tabela, numero, linhas, removidos, "id")
+        pq.write_table(_tabela_arrow(atual), caminho_estado)
+        resumo[tabela] = {"linhas": int(len(linhas)), "removidos": len(removidos)}
+
+    manifesto["snapshots"].append({
+        "numero": numero,
+        "criado_em": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "versoes": versoes,
+        "tabelas": resumo,
+    })
+    with open(caminho_manifesto, "w", encoding="utf-8") as f:
+        json.dump(manifesto, f, ensure_ascii=False, indent=2)
+    return manifesto["snapshots"][-1]
+
+def ler_parquet(pasta, tabela):
+    """Estado atual de ``tabela`` (ou ``<tabela>_plantonistas``) a partir dos snapshots."""
+    _pyarrow_parquet()
+    base = tabela.removesuffix("_plantonistas")
+    chave = TABELAS_EQUIPE[base] if base != tabela else "id"
+    destino = os.path.join(pasta, tabela)
+    partes = {}
+    for subpasta, tipo in ((destino, "linhas"), (os.path.join(destino, "_removidos"), "removidos")):
+        if os.path.isdir(subpasta):
+            for nome in os.listdir(subpasta):
+                m = re.fullmatch(r"snapshot_(\d+)\.parquet", nome)
+                if m:
+                    partes.setdefault(int(m.group(1)), {})[tipo] = os.path.join(subpasta, nome)
+    estado = None
+    for numero in sorted(partes):
+        linhas = pd.read_parquet(partes[numero]["linhas"]) if "linhas" in partes[numero] else None
+        substituidos = set()
+        if "removidos" in partes[numero]:
+            substituidos |= set(pd.read_parquet(partes[numero]["removidos"])[chave])
+        if linhas is not None and chave == "id":
+            substituidos |= set(linhas["id"])
+        if estado is not None:
+            estado = estado[~estado[chave].isin(substituidos)]
+        if linhas is not None:
+            estado = linhas if estado is None else pd.concat([estado, linhas], ignore_index=True)
+    if estado is None:
+        return pd.DataFrame()
+    return estado.drop(columns="_snapshot").sort_values([chave] + (["posicao"] if chave != "id" else [])).reset_index(drop=True)
+
+
+# --- Calendário ---
+# Cada escala aparece no dia em que começa. versoes_meses guarda um contador
+# por mês ('AAAA-MM'), incrementado por gatilhos quando uma escala daquele
+# mês muda; quem guarda o calendário em cache usa esse número na chave, então
+# editar uma escala de março não invalida o calendário de abril.
+def criar_versoes_meses(conn):
+    somar = lambda linha: f"""
+        INSERT INTO versoes_meses (mes, versao) VALUES ({_MES_SQL.format(linha=linha)}, 1)
+        ON CONFLICT(mes) DO UPDATE SET versao = versao + 1;
+    """
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS versoes_meses (
+            mes TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS versao_mes_escalas_insert AFTER INSERT ON escalas
+        BEGIN {somar('NEW')} END;
+        CREATE TRIGGER IF NOT EXISTS versao_mes_escalas_delete AFTER DELETE ON escalas
+        BEGIN {somar('OLD')} END;
+        CREATE TRIGGER IF NOT EXISTS versao_mes_escalas_update AFTER UPDATE ON escalas
+        BEGIN {somar('OLD')} {somar('NEW')} END;
+    """)
+
+def versao_mes(mes):
+    with conectar() as conn:
+        row = conn.execute("SELECT versao FROM versoes_meses WHERE mes=?", (mes,)).fetchone()
+    return row['versao'] if row else 0
+
+def calendario_mes(mes):
+    """Grade do mês 'AAAA-MM': {date: [plantão, ...]} com todos os dias do mês.
+
+    Cada plantão é um dict com id, inicio, fim (datetime), turno, vagas,
+    equipe (lista), placa e coordenador. Uma única consulta pelo índice de
+    inicio_min, já com viatura e coordenador; meses arquivados vêm do arquivo anual.
+    Ocorrências de escalas recorrentes que ainda não viraram escala entram
+    com id None e previsto=True.
+    """
+    inicio, fim = _limites_mes(mes)
+    ano, numero_mes = map(int, mes.split('-'))
+    grade = {datetime(ano, numero_mes, dia).date(): [] for dia in range(1, calendar.monthrange(ano, numero_mes)[1] + 1)}
+    lotes = iterar_periodo(
+        "escalas",
+        "t.id, t.inicio_min, t.fim_min, t.turno, t.vagas, t.plantonistas, v.placa, c.nome",
+        inicio, fim,
+        juncao="LEFT JOIN viaturas v ON v.id = t.viatura_id LEFT JOIN coordenadores c ON c.id = t.coordenador_id",
+        ordem="t.inicio_min, t.id"
+    )
+    for lote in lotes:
+        for id_escala, inicio_min, fim_min, turno, vagas, plantonistas, placa, coordenador in lote:
+            data_inicio = de_minutos(inicio_min)
+            grade[data_inicio.date()].append({
+                "id": id_escala,
+                "inicio": data_inicio,
+                "fim": de_minutos(fim_min),
+                "turno": turno,
+                "vagas": vagas,
+                "equipe": safe_list_load(plantonistas),
+                "placa": placa or '---',
+                "coordenador": coordenador or '---',
+            })
+
+    # Ocorrências de escalas recorrentes além do horizonte, calculadas só para este mês
+    previstas = ocorrencias_modelos(inicio, fim)
+    if previstas:
+        with conectar() as conn:
+            placas = dict(conn.execute("SELECT id, placa FROM viaturas").fetchall())
+            coordenadores = dict(conn.execute("SELECT id, nome FROM coordenadores").fetchall())
+        for escala in previstas:
+            data_inicio = de_minutos(escala['inicio_min'])
+            if data_inicio.date() not in grade:
+                continue
+            grade[data_inicio.date()].append({
+                "id": None,
+                "inicio": data_inicio,
+                "fim": de_minutos(escala['fim_min']),
+                "turno": escala['turno'],
+                "vagas": escala['vagas'],
+                "equipe": safe_list_load(escala['plantonistas']),
+                "placa": placas.get(escala['viatura_id']) or '---',
+                "coordenador": coordenadores.get(escala['coordenador_id']) or '---',
+                "previsto": True,
+            })
+        for plantoes in grade.values():
+            plantoes.sort(key=lambda plantao: plantao['inicio'])
+    return grade
+
+
+# --- Registro de alterações ---
+# Toda escrita nas tabelas principais entra em registro_alteracoes (seq
+# crescente, imagem da linha antes e depois), preenchido por gatilhos. Um
+# banco reserva recebe só o trecho do registro posterior ao que já aplicou:
+# exportar_delta no principal, aplicar_delta no reserva. Um reserva criado
+# copiando o arquivo do principal passa antes por iniciar_reserva, senão os
+# dois bancos ficam com o mesmo id de nó. Remoções feitas por
+# arquivar_ano não entram; o reserva arquiva os próprios anos. As escalas
+# recorrentes também são replicadas, com as ocorrências já materializadas.
+TABELAS_REGISTRADAS = TABELAS + ("feriados", "modelos_escala", "excecoes_modelo")
+# Chaves únicas além do id: uma linha criada no reserva com a mesma chave
+# de uma que chega da origem é substituída por ela (e entra nos conflitos).
+# Nas escalas, é a ocorrência que o reserva materializou por conta própria.
+CHAVES_UNICAS = {
+    "feriados": ("data",),
+    "excecoes_modelo": ("modelo_id", "ocorrencia_min"),
+    "escalas": ("modelo_id", "ocorrencia_min"),
+}
+
+def criar_registro_alteracoes(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS registro_alteracoes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabela TEXT NOT NULL,
+            operacao TEXT NOT NULL,
+            linha_id INTEGER NOT NULL,
+            dados TEXT,
+            anterior TEXT,
+            criado_em TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS sincronizacao (
+            origem TEXT PRIMARY KEY,
+            ultimo_seq INTEGER NOT NULL,
+            aplicado_em TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS no_local (id TEXT NOT NULL);
+    """)
+    if conn.execute("SELECT 1 FROM no_local").fetchone() is None:
+        conn.execute("INSERT INTO no_local (id) VALUES (?)", (uuid.uuid4().hex,))
+
+    for tabela in TABELAS_REGISTRADAS:
+        colunas = [row['name'] for row in conn.execute(f"PRAGMA table_info({tabela})")]
+        imagem = lambda linha: "json_object(" + ", ".join(f"'{c}', {linha}.{c}" for c in colunas) + ")"
+        gatilhos = {
+            f"registro_{tabela}_insert": f"""CREATE TRIGGER registro_{tabela}_insert AFTER INSERT ON {tabela}
+                BEGIN
+                    INSERT INTO registro_alteracoes (tabela, operacao, linha_id, dados)
+                    VALUES ('{tabela}', 'I', NEW.id, {imagem('NEW')});
+                END""",
+            f"registro_{tabela}_update": f"""CREATE TRIGGER registro_{tabela}_update AFTER UPDATE ON {tabela}
+                BEGIN
+                    INSERT INTO registro_alteracoes (tabela, operacao, linha_id, dados, anterior)
+                    VALUES ('{tabela}', 'U', NEW.id, {imagem('NEW')}, {imagem('OLD')});
+                END""",
+            f"registro_{tabela}_delete": f"""CREATE TRIGGER registro_{tabela}_delete AFTER DELETE ON {tabela}
+                WHEN NOT EXISTS (SELECT 1 FROM arquivamento_em_curso)
+                BEGIN
+                    INSERT INTO registro_alteracoes (tabela, operacao, linha_id, anterior)
+                    VALUES ('{tabela}', 'D', OLD.id, {imagem('OLD')});
+                END""",
+        }
+        # Recria o gatilho só quando as colunas da tabela mudaram
+        for nome, sql in gatilhos.items():
+            atual = conn.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (nome,)).fetchone()
+            if atual is None or atual['sql'] != sql:
+                conn.execute(f"DROP TRIGGER IF EXISTS {nome}")
+                conn.execute(sql)
+
+def iniciar_reserva():
+    """Prepara um banco copiado do principal para ser o reserva; devolve o novo id.
+
+    A cópia traz o id de nó do principal (no_local). Rodar uma vez, logo
+    depois de copiar o arquivo: gera um id próprio, registra que tudo até a
+    última seq da cópia já veio do principal (o primeiro exportar-delta usa
+    --desde com ela) e esvazia o registro, que era o do principal.
+    """
+    with transacao_escrita() as conn:
+        origem = conn.execute("SELECT id FROM no_local").fetchone()['id']
+        ultimo = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM registro_alteracoes").fetchone()[0]
+        conn.execute("""
+            INSERT INTO sincronizacao (origem, ultimo_seq, aplicado_em) VALUES (?, ?, ?)
+            ON CONFLICT(origem) DO UPDATE SET ultimo_seq = MAX(ultimo_seq, excluded.ultimo_seq), aplicado_em = excluded.aplicado_em
+        """, (origem, ultimo, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.execute("DELETE FROM registro_alteracoes")
+        novo = uuid.uuid4().hex
+        conn.execute("UPDATE no_local SET id = ?", (novo,))
+    return novo
+
+def id_do_no():
+    with conectar() as conn:
+        return conn.execute("SELECT id FROM no_local").fetchone()['id']
+
+def posicao_registro():
+    """Último seq do registro local e, por origem, o último seq já aplicado aqui."""
+    with conectar() as conn:
+        ultimo = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM registro_alteracoes").fetchone()[0]
+        aplicados = {row['origem']: row['ultimo_seq'] for row in conn.execute("SELECT origem, ultimo_seq FROM sincronizacao")}
+    return ultimo, aplicados
+
+def exportar_delta(caminho, desde_seq=0):
+    """Grava em ``caminho`` (JSON Lines) as alterações com seq > ``desde_seq``.
+
+    A primeira linha é o cabeçalho com a origem e o intervalo [desde, ate];
+    devolve esse cabeçalho.
+    """
+    conn = conectar()
+    try:
+        # Uma transação de leitura: cabeçalho e linhas vêm do mesmo instante
+        conn.execute("BEGIN")
+        ate = conn.execute("SELECT COALESCE(MAX(seq), ?) FROM registro_alteracoes", (desde_seq,)).fetchone()[0]
+        cabecalho = {
+            "origem": conn.execute("SELECT id FROM no_local").fetchone()['id'],
+            "desde": desde_seq,
+            "ate": ate,
+        }
+        cursor = conn.execute(
+            "SELECT seq, tabela, operacao, linha_id, dados, anterior FROM registro_alteracoes "
+            "WHERE seq > ? AND seq <= ? ORDER BY seq", (desde_seq, ate)
+        )
+        with open(caminho, "w", encoding="utf-8") as f:
+            f.write(json.dumps(cabecalho) + "\n")
+            while True:
+                lote = cursor.fetchmany(1000)
+                if not lote:
+                    break
+                for seq, tabela, operacao, linha_id, dados, anterior in lote:
+                    f.write(json.dumps({
+                        "seq": seq, "tabela": tabela, "operacao": operacao, "linha_id": linha_id,
+                        "dados": json.loads(dados) if dados else None,
+                        "anterior": json.loads(anterior) if anterior else None,
+                    }, ensure_ascii=False) + "\n")
+        conn.rollback()
+    finally:
+        conn.close()
+    return cabecalho
+
+def _mesma_linha(linha, imagem):
+    if linha is None or imagem is None:
+        return linha is None and imagem is None
+    return all(linha[c] == imagem[c] for c in linha.keys() if c in imagem)
+
+def _liberar_chave_unica(conn, tabela, linha_id, dados, colunas, seq, relatorio):
+    """Remove a linha local que ocupa a chave única de ``dados`` com outro id."""
+    chave = CHAVES_UNICAS.get(tabela)
+    if not chave or any(dados.get(c) is None for c in chave):
+        return
+    condicao = " AND ".join(f"{c} = ?" for c in chave)
+    removidas = conn.execute(
+        f"DELETE FROM {tabela} WHERE {condicao} AND id <> ? RETURNING {', '.join(colunas)}",
+        (*(dados[c] for c in chave), linha_id)
+    ).fetchall()
+    for local in removidas:
+        relatorio["conflitos"].append({
+            "seq": seq, "tabela": tabela, "id": local['id'], "operacao": "I",
+            "local": dict(local), "origem": dados,
+        })
+    if tabela == "escalas" and removidas:
+        _derivar_historico(conn, [local['id'] for local in removidas])
+
+def aplicar_delta(caminho):
+    """Aplica um arquivo de exportar_delta neste banco, numa única transação.
+
+    Alterações já aplicadas (seq até o último registrado para a origem) são
+    ignoradas, então reaplicar o mesmo arquivo não muda nada. Quando a linha
+    local não está nem no estado anterior nem no posterior da alteração, ela
+    foi mexida aqui: a alteração da origem prevalece e o caso entra em
+    ``conflitos``. Devolve {'aplicadas', 'ignoradas', 'conflitos'}.
+    """
+    with open(caminho, encoding="utf-8") as f:
+        cabecalho = json.loads(f.readline())
+        alteracoes = [json.loads(linha) for linha in f if linha.strip()]
+
+    relatorio = {"aplicadas": 0, "ignoradas": 0, "conflitos": []}
+    conn = conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT ultimo_seq FROM sincronizacao WHERE origem=?", (cabecalho["origem"],)).fetchone()
+        ultimo = row['ultimo_seq'] if row else None
+        if ultimo is not None and cabecalho["desde"] > ultimo:
+            raise ValueError(
+                f"O delta começa após a seq {cabecalho['desde']}, mas este banco só aplicou até a {ultimo}: "
+                f"exporte de novo com --desde {ultimo}."
+            )
+        colunas = {t: [r['name'] for r in conn.execute(f"PRAGMA table_info({t})")] for t in TABELAS_REGISTRADAS}
+
+        for alteracao in alteracoes:
+            if ultimo is not None and alteracao["seq"] <= ultimo:
+                relatorio["ignoradas"] += 1
+                continue
+            tabela, linha_id = alteracao["tabela"], alteracao["linha_id"]
+            atual = conn.execute(f"SELECT {', '.join(colunas[tabela])} FROM {tabela} WHERE id=?", (linha_id,)).fetchone()
+            if not (_mesma_linha(atual, alteracao["anterior"]) or _mesma_linha(atual, alteracao["dados"])):
+                relatorio["conflitos"].append({
+                    "seq": alteracao["seq"], "tabela": tabela, "id": linha_id, "operacao": alteracao["operacao"],
+                    "local": dict(atual) if atual else None,
+                    "origem": alteracao["dados"] or alteracao["anterior"],
+                })
+
+            if alteracao["operacao"] == "D":
+                conn.execute(f"DELETE FROM {tabela} WHERE id=?", (linha_id,))
+            else:
+                dados = {c: v for c, v in alteracao["dados"].items() if c in colunas[tabela]}
+                _liberar_chave_unica(conn, tabela, linha_id, dados, colunas[tabela], alteracao["seq"], relatorio)
+                # UPDATE em vez de INSERT OR REPLACE: o REPLACE não dispara os
+                # gatilhos de remoção, e o saldo de horas contaria a linha duas vezes
+                if atual is not None:
+                    conn.execute(
+                        f"UPDATE {tabela} SET {', '.join(f'{c} = ?' for c in dados)} WHERE id = ?",
+                        (*dados.values(), linha_id)
+                    )
+                else:
+                    conn.execute(
+                        f"INSERT INTO {tabela} ({', '.join(dados)}) VALUES ({', '.join('?' * len(dados))})",
+                        tuple(dados.values())
+                    )
+            relatorio["aplicadas"] += 1
+
+        conn.execute("""
+            INSERT INTO sincronizacao (origem, ultimo_seq, aplicado_em) VALUES (?, ?, ?)
+            ON CONFLICT(origem) DO UPDATE SET ultimo_seq = MAX(ultimo_seq, excluded.ultimo_seq), aplicado_em = excluded.aplicado_em
+        """, (cabecalho["origem"], cabecalho["ate"], datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return relatorio
+